@@ -162,39 +162,127 @@
 
 
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS, cross_origin
 import os
 from database import Database
-from face_recognition_module import FaceRecognitionModule
-import base64
-import cv2
-import numpy as np
+from inference_pool import InferencePoolBusy
+import settings
+from image_ingest import (
+    ImageRejected, MAX_IMAGE_BYTES, request_fields, read_image_bytes, read_images_bytes,
+    decode_image, iter_jpeg_frames
+)
+import metrics
+from caching import TTLCache
+from streaming import StreamSession
+from shards import ScopeError, parse_scope
 from datetime import datetime
 
 app = Flask(__name__)
 CORS(app)
 
-# Initialize database
-db = Database()
+# Bodies past this size are refused before they are read (batch uploads carry several images)
+app.config['MAX_CONTENT_LENGTH'] = 8 * MAX_IMAGE_BYTES
 
-# Initialize face recognition module
-face_module = FaceRecognitionModule(db)
+# Initialize database
+db = Database(**settings.DATABASE_OPTIONS)
+
+# Initialize face recognition module, with detection and encoding in the inference pool
+inference_pool = settings.create_inference_pool()
+face_module = settings.create_face_module(db, inference_pool)
+
+# Live camera stream sessions
+stream_sessions = TTLCache(settings.STREAM_MAX_SESSIONS, settings.STREAM_SESSION_TTL)
+
+# Gallery size, cache hit rates and queue depths for /metrics
+metrics.register_server(face_module, db, inference_pool, stream_sessions)
+
+@app.errorhandler(ImageRejected)
+def image_rejected(error):
+    """Oversized, empty or undecodable images never reach face detection"""
+    return jsonify({"error": str(error)}), error.status
+
+@app.before_request
+def start_timing():
+    g.request_started = metrics.begin_request()
+
+@app.after_request
+def add_server_timing(response):
+    """Report the stages of this request (decode, detection, matching, database) in Server-Timing"""
+    metrics.end_request(request.endpoint, g.request_started)
+    timing = metrics.server_timing_header()
+    if timing:
+        response.headers['Server-Timing'] = timing
+    return response
+
+@app.errorhandler(InferencePoolBusy)
+def inference_busy(error):
+    """Shed load instead of queueing requests behind a saturated inference pool"""
+    return jsonify({"error": str(error)}), 503, {'Retry-After': '1'}
+
+@app.errorhandler(ScopeError)
+def invalid_scope(error):
+    return jsonify({"error": str(error)}), 400
+
+def load_scope(scope):
+    """Load a scope's members into the face module unless they are still cached and current"""
+    # Other workers and the importer edit rosters and enrol students behind this worker's back:
+    # a roster is reloaded once its updated_at moves on, and students enrolled since are looked up
+    shard = face_module.get_scope(scope)
+    version = db.get_scope_version(scope)
+    if shard is None or shard.expired or shard.version != version:
+        mark = face_module.scope_mark()
+        face_module.set_scope(scope, db.get_scope_members(scope), mark, version)
+        return
+    newcomers = face_module.scope_newcomers(scope)
+    if newcomers:
+        for user_id in db.get_scope_members(scope, among=newcomers):
+            face_module.add_to_scopes(user_id, [scope])
+
+def scope_args(data):
+    """Optional recognition scope (department:<name> or roster:<id>) and whether to fall back to everyone"""
+    scope = data.get('scope') or None
+    if scope is not None:
+        parse_scope(scope)
+        load_scope(scope)
+    fallback = str(data.get('fallback', True)).lower() not in ('0', 'false', 'no')
+    return scope, fallback
+
+# Largest page a client can ask for with ?limit=
+MAX_PAGE_SIZE = 1000
+
+def page_args():
+    """Keyset pagination parameters: ?after=<last key seen>&limit=<page size>"""
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+    return request.args.get('after'), limit
+
+def list_response(key, documents, cursor_field, limit):
+    """JSON page with a next cursor, or a streamed NDJSON body with ?format=ndjson"""
+    if request.args.get('format') == 'ndjson':
+        # One document per line, straight from the database cursor
+        def generate():
+            for document in documents:
+                yield app.json.dumps(document) + '\n'
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    
+    documents = list(documents)
+    body = {key: documents}
+    if limit and len(documents) == limit:
+        body['next_after'] = documents[-1][cursor_field]
+    return jsonify(body), 200
 
 @app.route('/api/verify-face', methods=['POST'])
 @cross_origin()
 def verify_face():
     """Check if a face already exists in the database"""
-    data = request.json
-    image_data = data.get('image')
+    image_bytes = read_image_bytes()
     
-    if not image_data:
+    if not image_bytes:
         return jsonify({"error": "No image provided"}), 400
     
-    # Convert base64 image to OpenCV format
-    encoded_data = image_data.split(',')[1]
-    nparr = np.frombuffer(base64.b64decode(encoded_data), np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    img = decode_image(image_bytes)
     
     # Check if face already exists
     existing_user_id = face_module.recognize_face(img)
@@ -209,73 +297,246 @@ def verify_face():
 @app.route('/api/register', methods=['POST'])
 @cross_origin()
 def register_user():
-    data = request.json
+    data = request_fields()
     name = data.get('name')
     email = data.get('email')
     department = data.get('department')
-    image_data = data.get('image')
+    # One image, or several ("images") of the same person for a more robust enrolment
+    images_bytes = read_images_bytes()
     
-    if not all([name, email, department, image_data]):
+    if not all([name, email, department, images_bytes]):
         return jsonify({"error": "Missing required fields"}), 400
     
+    if len(images_bytes) > settings.MAX_ENROL_IMAGES:
+        return jsonify({"error": f"Provide at most {settings.MAX_ENROL_IMAGES} images"}), 400
+    
     # Check if the user already exists in the database by email
     existing_user = db.get_user_by_email(email)
     if existing_user:
         return jsonify({"error": "Email already registered"}), 409
     
-    # Convert base64 image to OpenCV format
-    encoded_data = image_data.split(',')[1]
-    nparr = np.frombuffer(base64.b64decode(encoded_data), np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    images = [decode_image(image_bytes) for image_bytes in images_bytes]
     
     # Double-check if face already exists (as a safeguard)
-    existing_user_id = face_module.recognize_face(img)
-    if existing_user_id:
+    if any(face_module.recognize_face(img) for img in images):
         return jsonify({"error": "This face is already registered with another account"}), 409
     
-    # Save face encoding and user data
+    # Save face encodings and user data
     user_id = db.add_user(name, email, department)
-    face_module.add_face(user_id, img)
+    samples = face_module.add_faces(user_id, images)
+    face_module.add_to_scopes(user_id, [f"department:{department}"])
     
-    return jsonify({"message": "Student registered successfully", "user_id": user_id}), 201
+    return jsonify({"message": "Student registered successfully", "user_id": user_id, "samples": samples}), 201
 
 @app.route('/api/recognize', methods=['POST'])
 @cross_origin()
 def recognize_face():
-    data = request.json
-    image_data = data.get('image')
+    data = request_fields()
     period = data.get('period')
     subject = data.get('subject')
+    image_bytes = read_image_bytes()
     
-    if not all([image_data, period, subject]):
+    if not all([image_bytes, period, subject]):
         return jsonify({"error": "Missing required fields"}), 400
     
-    # Convert base64 image to OpenCV format
-    encoded_data = image_data.split(',')[1]
-    nparr = np.frombuffer(base64.b64decode(encoded_data), np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    img = decode_image(image_bytes)
     
-    # Recognize face
-    user_id = face_module.recognize_face(img)
+    # Recognize face, among the members of the class first when a scope is given
+    scope, fallback = scope_args(data)
+    user_id = face_module.recognize_face(img, scope=scope, fallback=fallback)
     
-    if user_id:
+    # A match whose student was deleted from the database counts as unrecognized
+    user = db.get_user(user_id) if user_id else None
+    
+    if user:
         # Mark attendance
-        user = db.get_user(user_id)
         attendance_id = db.mark_attendance(user_id, period, subject)
-        return jsonify({
+        response = {
             "recognized": True,
             "user": user,
             "attendance_id": attendance_id,
             "timestamp": datetime.now().isoformat()
-        }), 200
+        }
+        if scope:
+            response["in_scope"] = face_module.in_scope(scope, user_id)
+        return jsonify(response), 200
     else:
         return jsonify({"recognized": False}), 404
 
+@app.route('/api/recognize/batch', methods=['POST'])
+@cross_origin()
+def recognize_faces_batch():
+    """Recognize every face in a group photo or a burst of frames and mark attendance for all of them"""
+    data = request_fields()
+    period = data.get('period')
+    subject = data.get('subject')
+    images_bytes = read_images_bytes()
+    
+    if not all([images_bytes, period, subject]):
+        return jsonify({"error": "Missing required fields"}), 400
+    
+    # Group photos are decoded at full resolution; detection only shrinks them to the group preset's
+    # limit (GROUP_DETECTION_PRESET), so small faces at the back stay detectable
+    images = [decode_image(image_bytes, max_side=None) for image_bytes in images_bytes]
+    
+    # Recognize all faces, matched against the gallery (or the scope's shard) in one pass
+    scope, fallback = scope_args(data)
+    results = face_module.recognize_faces(images, scope=scope, fallback=fallback)
+    
+    # Mark attendance for every recognized student with one bulk write
+    user_ids = {face['user_id'] for faces in results for face in faces if face['user_id']}
+    users = db.get_users(user_ids)
+    attendance_ids = db.mark_attendance_many([user_id for user_id in user_ids if user_id in users], period, subject)
+    
+    response = []
+    for image_index, faces in enumerate(results):
+        for face in faces:
+            top, right, bottom, left = face['location']
+            user_id = face['user_id']
+            result = {
+                "image": image_index,
+                "box": {"top": top, "right": right, "bottom": bottom, "left": left},
+                "recognized": user_id in attendance_ids,
+                "user": users.get(user_id),
+                "distance": face['distance'],
+                "attendance_id": attendance_ids.get(user_id)
+            }
+            if scope:
+                result["in_scope"] = face_module.in_scope(scope, user_id)
+            response.append(result)
+    
+    return jsonify({
+        "faces": response,
+        "recognized_count": len(attendance_ids),
+        "timestamp": datetime.now().isoformat()
+    }), 200
+
+@app.route('/api/stream/sessions', methods=['POST'])
+@cross_origin()
+def start_stream():
+    """Open a recognition session for a camera; its frames go to /api/stream/sessions/<id>/frames"""
+    data = request_fields()
+    period = data.get('period')
+    subject = data.get('subject')
+    
+    if not all([period, subject]):
+        return jsonify({"error": "Missing required fields"}), 400
+    
+    detect_every = data.get('detect_every')
+    try:
+        detect_every = settings.STREAM_DETECT_EVERY if detect_every in (None, '') else int(detect_every)
+    except (TypeError, ValueError):
+        detect_every = 0
+    if detect_every < 1:
+        return jsonify({"error": "detect_every must be a positive integer"}), 400
+    
+    scope, fallback = scope_args(data)
+    session = StreamSession(face_module, period, subject, detect_every, scope=scope, fallback=fallback)
+    stream_sessions.set(session.session_id, session)
+    return jsonify(session.snapshot()), 201
+
+def get_stream(session_id):
+    session = stream_sessions.get(session_id)
+    if session is not None:
+        # Every frame keeps the session alive
+        stream_sessions.set(session_id, session)
+    return session
+
+def process_stream_frame(session, image_bytes):
+    """Track one frame of a stream and mark attendance for newly confirmed faces"""
+    with session.lock:
+        detected = session.needs_detection()
+        if detected and session.scope:
+            load_scope(session.scope)
+        confirmed = session.detect(decode_image(image_bytes)) if detected else []
+        
+        # Attendance is marked once per person per session, not once per frame
+        new = {track.user_id for track in confirmed if track.user_id not in session.marked}
+        users = db.get_users(new) if new else {}
+        for track in confirmed:
+            if track.user_id in users and track.user_id not in session.marked:
+                session.marked[track.user_id] = db.mark_attendance(track.user_id, session.period, session.subject)
+            track.attendance_id = session.marked.get(track.user_id)
+        
+        return {
+            "frame": session.frames,
+            "detected": detected,
+            "tracks": [track.to_dict() for track in session.tracker.tracks],
+            "confirmed": [dict(track.to_dict(), user=users.get(track.user_id)) for track in confirmed]
+        }
+
+@app.route('/api/stream/sessions/<session_id>/frames', methods=['POST'])
+@cross_origin()
+def stream_frame(session_id):
+    """One frame of a stream, sent as a raw image body, multipart file or base64 JSON"""
+    session = get_stream(session_id)
+    if session is None:
+        return jsonify({"error": "Unknown or expired stream session"}), 404
+    
+    image_bytes = read_image_bytes()
+    if not image_bytes:
+        return jsonify({"error": "No image provided"}), 400
+    
+    return jsonify(process_stream_frame(session, image_bytes)), 200
+
+@app.route('/api/stream/sessions/<session_id>/mjpeg', methods=['POST'])
+@cross_origin()
+def stream_mjpeg(session_id):
+    """A chunked MJPEG upload; answers with one NDJSON line per frame as the frames arrive"""
+    session = get_stream(session_id)
+    if session is None:
+        return jsonify({"error": "Unknown or expired stream session"}), 404
+    
+    def generate():
+        for image_bytes in iter_jpeg_frames(request.stream):
+            try:
+                result = process_stream_frame(session, image_bytes)
+            except ImageRejected as error:
+                result = {"frame": session.frames, "error": str(error)}
+            stream_sessions.set(session_id, session)
+            yield app.json.dumps(result) + '\n'
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/api/stream/sessions/<session_id>', methods=['GET', 'DELETE'])
+@cross_origin()
+def stream_session(session_id):
+    """Frame, detection and encoding counts of a stream; DELETE also closes it"""
+    session = get_stream(session_id)
+    if session is None:
+        return jsonify({"error": "Unknown or expired stream session"}), 404
+    if request.method == 'DELETE':
+        stream_sessions.pop(session_id)
+    return jsonify(session.snapshot()), 200
+
+@app.route('/api/stats', methods=['GET'])
+@cross_origin()
+def get_stats():
+    """Recognition latency per stage and micro-batching statistics, for tuning the batch window"""
+    return jsonify(dict(face_module.snapshot_stats(), user_cache=db.user_cache.snapshot())), 200
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Stage latency histograms, gallery size, cache and queue gauges for Prometheus"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 @app.route('/api/users', methods=['GET'])
 @cross_origin()
 def get_users():
-    users = db.get_all_users()
-    return jsonify({"users": users}), 200
+    after, limit = page_args()
+    users = db.iter_users(after, limit)
+    return list_response("users", users, 'user_id', limit)
+
+@app.route('/api/users/<user_id>', methods=['DELETE'])
+@cross_origin()
+def delete_user(user_id):
+    """Remove a student and their face encodings; attendance history is kept"""
+    # Encodings first, so a half-finished delete can never mark attendance for a removed student
+    removed = face_module.remove_user(user_id)
+    deleted = db.delete_user(user_id)
+    
+    if not (removed or deleted):
+        return jsonify({"error": "User not found"}), 404
+    return jsonify({"message": "Student deleted", "user_id": user_id, "encodings_removed": removed}), 200
 
 @app.route('/api/departments', methods=['GET'])
 @cross_origin()
@@ -283,13 +544,31 @@ def get_departments():
     departments = db.get_departments()
     return jsonify({"departments": departments}), 200
 
+@app.route('/api/rosters/<roster_id>', methods=['GET', 'PUT'])
+@cross_origin()
+def roster(roster_id):
+    """A named group of students (a class or section); recognition can be scoped to it as roster:<roster_id>"""
+    if request.method == 'PUT':
+        data = request.get_json(silent=True) or {}
+        user_ids = data.get('user_ids')
+        if not isinstance(user_ids, list):
+            return jsonify({"error": "user_ids must be a list"}), 400
+        db.set_roster(roster_id, user_ids, data.get('name'))
+        face_module.drop_scope(f"roster:{roster_id}")
+    
+    roster = db.get_roster(roster_id)
+    if roster is None:
+        return jsonify({"error": "Roster not found"}), 404
+    return jsonify(roster), 200
+
 @app.route('/api/attendance', methods=['GET'])
 @cross_origin()
 def get_attendance():
     date = request.args.get('date', datetime.now().strftime('%Y-%m-%d'))
     period = request.args.get('period')
-    attendance = db.get_attendance_by_date(date, period)
-    return jsonify({"attendance": attendance}), 200
+    after, limit = page_args()
+    attendance = db.iter_attendance_by_date(date, period, after, limit)
+    return list_response("attendance", attendance, 'attendance_id', limit)
 
 @app.route('/api/attendance/monthly', methods=['GET'])
 @cross_origin()
@@ -0,0 +1,604 @@
+"""ASGI variant of app.py: the same API on Starlette, with Motor for MongoDB.
+
+Request handling never blocks the event loop: database calls are awaited
+through Motor, and image decoding plus everything FaceRecognitionModule does
+(which itself waits on the inference process pool) runs in a thread executor.
+
+Run with:
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:app
+or, for development:
+    uvicorn asgi:app --port 8000
+"""
+import asyncio
+import contextlib
+import contextvars
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route, WebSocketRoute
+from starlette.websockets import WebSocketDisconnect
+from werkzeug.http import http_date
+
+import metrics
+import settings
+from async_database import AsyncDatabase
+from caching import TTLCache
+from image_ingest import (
+    INT_FIELDS, MAX_IMAGE_BYTES, ImageRejected, JpegFrameSplitter, check_size, decode_data_url, decode_image,
+    image_fields
+)
+from inference_pool import InferencePoolBusy
+from shards import ScopeError, parse_scope
+from streaming import StreamSession
+
+db = AsyncDatabase(**settings.DATABASE_OPTIONS)
+inference_pool = settings.create_inference_pool()
+face_module = settings.create_face_module(db, inference_pool)
+stream_sessions = TTLCache(settings.STREAM_MAX_SESSIONS, settings.STREAM_SESSION_TTL)
+metrics.register_server(face_module, db, inference_pool, stream_sessions)
+
+# Threads that decode images and wait on detection/matching; ASGI_EXECUTOR_THREADS bounds how many
+# requests can be in the CPU-bound part at once (the rest wait on the event loop, not in a thread)
+executor = ThreadPoolExecutor(int(os.getenv('ASGI_EXECUTOR_THREADS', '32')))
+
+# Same limit as app.py's MAX_CONTENT_LENGTH
+MAX_BODY_BYTES = 8 * MAX_IMAGE_BYTES
+
+# Largest page a client can ask for with ?limit=
+MAX_PAGE_SIZE = 1000
+
+
+def run(fn, *args):
+    """Run blocking work in the executor, keeping the request's stage timings"""
+    context = contextvars.copy_context()
+    return asyncio.get_running_loop().run_in_executor(executor, context.run, fn, *args)
+
+
+def _json_default(value):
+    # Matches Flask's JSON provider, so both servers return identical documents
+    if isinstance(value, datetime):
+        return http_date(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content):
+    return json.dumps(content, default=_json_default, sort_keys=True)
+
+
+class APIResponse(JSONResponse):
+    def render(self, content):
+        return dumps(content).encode('utf-8')
+
+
+def respond(content, status_code=200, headers=None):
+    return APIResponse(content, status_code, headers)
+
+
+# --- Request parsing (the async counterparts of image_ingest's Flask helpers) ---
+
+def _is_raw_image(request):
+    content_type = request.headers.get('content-type', '').split(';')[0].strip()
+    return content_type.startswith('image/') or content_type == 'application/octet-stream'
+
+
+async def request_fields(request):
+    """Request parameters from a JSON body, a multipart form or the query string (raw image bodies)"""
+    content_length = int(request.headers.get('content-length') or 0)
+    if content_length > MAX_BODY_BYTES:
+        raise ImageRejected(f"Request body is larger than {MAX_BODY_BYTES} bytes", 413)
+
+    content_type = request.headers.get('content-type', '')
+    if content_type.startswith('application/json'):
+        try:
+            data = await request.json()
+        except ValueError:
+            data = None
+        if isinstance(data, dict):
+            return data
+
+    fields = dict(request.query_params)
+    if content_type.startswith(('multipart/form-data', 'application/x-www-form-urlencoded')):
+        form = await request.form()
+        fields.update({name: value for name, value in form.items() if isinstance(value, str)})
+    for name in INT_FIELDS:
+        if isinstance(fields.get(name), str) and fields[name].isdigit():
+            fields[name] = int(fields[name])
+    return fields
+
+
+async def _read_raw_body(request):
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        check_size(len(body))
+    return bytes(body)
+
+
+async def read_payloads(request, field='images', single='image'):
+    """Every uploaded image, as raw bytes or as a base64 data URL still to be decoded"""
+    if _is_raw_image(request):
+        body = await _read_raw_body(request)
+        return [body] if body else []
+
+    content_type = request.headers.get('content-type', '')
+    if content_type.startswith('multipart/form-data'):
+        form = await request.form()
+        files = form.getlist(field) or form.getlist(single)
+        payloads = []
+        for upload in files:
+            if isinstance(upload, str):
+                continue
+            data = await upload.read(MAX_IMAGE_BYTES + 1)
+            check_size(len(data))
+            payloads.append(data)
+        return payloads
+
+    return image_fields(await request_fields(request), field, single)
+
+
+def load_image(payload, max_side=None, reduced=True):
+    """Decode one payload to an RGB image; runs in the executor"""
+    image_bytes = decode_data_url(payload) if isinstance(payload, str) else payload
+    if reduced:
+        return decode_image(image_bytes)
+    return decode_image(image_bytes, max_side=None)
+
+
+class UploadStreamingResponse(StreamingResponse):
+    """Streams the response while the request body is still arriving.
+
+    StreamingResponse also listens for the client disconnecting, and that
+    listener would swallow the body chunks the generator is reading.
+    """
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+
+
+async def load_scope(scope):
+    """Load a scope's members into the face module unless they are still cached and current"""
+    # Other workers and the importer edit rosters and enrol students behind this worker's back:
+    # a roster is reloaded once its updated_at moves on, and students enrolled since are looked up
+    shard = face_module.get_scope(scope)
+    version = await db.get_scope_version(scope)
+    if shard is None or shard.expired or shard.version != version:
+        mark = await run(face_module.scope_mark)
+        face_module.set_scope(scope, await db.get_scope_members(scope), mark, version)
+        return
+    newcomers = await run(face_module.scope_newcomers, scope)
+    if newcomers:
+        for user_id in await db.get_scope_members(scope, among=newcomers):
+            face_module.add_to_scopes(user_id, [scope])
+
+
+async def scope_args(data):
+    """Optional recognition scope (department:<name> or roster:<id>) and whether to fall back to everyone"""
+    scope = data.get('scope') or None
+    if scope is not None:
+        parse_scope(scope)
+        await load_scope(scope)
+    fallback = str(data.get('fallback', True)).lower() not in ('0', 'false', 'no')
+    return scope, fallback
+
+
+def page_args(request):
+    """Keyset pagination parameters: ?after=<last key seen>&limit=<page size>"""
+    limit = request.query_params.get('limit')
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE)) if limit and limit.lstrip('-').isdigit() else None
+    return request.query_params.get('after'), limit
+
+
+async def list_response(request, key, cursor, cursor_field, limit):
+    """JSON page with a next cursor, or a streamed NDJSON body with ?format=ndjson"""
+    if request.query_params.get('format') == 'ndjson':
+        async def generate():
+            async for document in cursor:
+                yield dumps(document) + '\n'
+        return StreamingResponse(generate(), media_type='application/x-ndjson')
+
+    documents = [document async for document in cursor]
+    body = {key: documents}
+    if limit and len(documents) == limit:
+        body['next_after'] = documents[-1][cursor_field]
+    return respond(body)
+
+
+# --- Routes ---
+
+async def verify_face(request):
+    """Check if a face already exists in the database"""
+    payloads = await read_payloads(request, field='image')
+    if not payloads:
+        return respond({"error": "No image provided"}, 400)
+
+    img = await run(load_image, payloads[0])
+    if await run(face_module.recognize_face, img):
+        return respond({"faceExists": True, "message": "Face already registered"})
+    return respond({"faceExists": False, "message": "Face is unique"})
+
+
+async def register_user(request):
+    data = await request_fields(request)
+    name = data.get('name')
+    email = data.get('email')
+    department = data.get('department')
+    payloads = await read_payloads(request)
+
+    if not all([name, email, department, payloads]):
+        return respond({"error": "Missing required fields"}, 400)
+
+    if len(payloads) > settings.MAX_ENROL_IMAGES:
+        return respond({"error": f"Provide at most {settings.MAX_ENROL_IMAGES} images"}, 400)
+
+    if await db.get_user_by_email(email):
+        return respond({"error": "Email already registered"}, 409)
+
+    images = [await run(load_image, payload) for payload in payloads]
+
+    for img in images:
+        if await run(face_module.recognize_face, img):
+            return respond({"error": "This face is already registered with another account"}, 409)
+
+    user_id = await db.add_user(name, email, department)
+    samples = await run(face_module.add_faces, user_id, images)
+    face_module.add_to_scopes(user_id, [f"department:{department}"])
+
+    return respond({"message": "Student registered successfully", "user_id": user_id, "samples": samples}, 201)
+
+
+async def recognize_face(request):
+    data = await request_fields(request)
+    period = data.get('period')
+    subject = data.get('subject')
+    payloads = await read_payloads(request, field='image')
+
+    if not all([payloads, period, subject]):
+        return respond({"error": "Missing required fields"}, 400)
+
+    img = await run(load_image, payloads[0])
+    scope, fallback = await scope_args(data)
+    user_id = await run(face_module.recognize_face, img, 0.4, scope, fallback)
+
+    # A match whose student was deleted from the database counts as unrecognized
+    user = await db.get_user(user_id) if user_id else None
+
+    if user:
+        attendance_id = await db.mark_attendance(user_id, period, subject)
+        response = {
+            "recognized": True,
+            "user": user,
+            "attendance_id": attendance_id,
+            "timestamp": datetime.now().isoformat()
+        }
+        if scope:
+            response["in_scope"] = face_module.in_scope(scope, user_id)
+        return respond(response)
+    return respond({"recognized": False}, 404)
+
+
+async def recognize_faces_batch(request):
+    """Recognize every face in a group photo or a burst of frames and mark attendance for all of them"""
+    data = await request_fields(request)
+    period = data.get('period')
+    subject = data.get('subject')
+    payloads = await read_payloads(request)
+
+    if not all([payloads, period, subject]):
+        return respond({"error": "Missing required fields"}, 400)
+
+    # Group photos are decoded at full resolution; detection only shrinks them to the group preset's
+    # limit (GROUP_DETECTION_PRESET), so small faces at the back stay detectable
+    images = [await run(load_image, payload, None, False) for payload in payloads]
+    scope, fallback = await scope_args(data)
+    results = await run(face_module.recognize_faces, images, 0.4, scope, fallback)
+
+    user_ids = {face['user_id'] for faces in results for face in faces if face['user_id']}
+    users = await db.get_users(user_ids)
+    attendance_ids = await db.mark_attendance_many([user_id for user_id in user_ids if user_id in users], period, subject)
+
+    response = []
+    for image_index, faces in enumerate(results):
+        for face in faces:
+            top, right, bottom, left = face['location']
+            user_id = face['user_id']
+            result = {
+                "image": image_index,
+                "box": {"top": top, "right": right, "bottom": bottom, "left": left},
+                "recognized": user_id in attendance_ids,
+                "user": users.get(user_id),
+                "distance": face['distance'],
+                "attendance_id": attendance_ids.get(user_id)
+            }
+            if scope:
+                result["in_scope"] = face_module.in_scope(scope, user_id)
+            response.append(result)
+
+    return respond({
+        "faces": response,
+        "recognized_count": len(attendance_ids),
+        "timestamp": datetime.now().isoformat()
+    })
+
+
+async def start_stream(request):
+    """Open a recognition session for a camera"""
+    data = await request_fields(request)
+    period = data.get('period')
+    subject = data.get('subject')
+
+    if not all([period, subject]):
+        return respond({"error": "Missing required fields"}, 400)
+
+    detect_every = data.get('detect_every')
+    try:
+        detect_every = settings.STREAM_DETECT_EVERY if detect_every in (None, '') else int(detect_every)
+    except (TypeError, ValueError):
+        detect_every = 0
+    if detect_every < 1:
+        return respond({"error": "detect_every must be a positive integer"}, 400)
+
+    scope, fallback = await scope_args(data)
+    session = StreamSession(face_module, period, subject, detect_every, scope=scope, fallback=fallback)
+    stream_sessions.set(session.session_id, session)
+    return respond(session.snapshot(), 201)
+
+
+def get_stream(session_id):
+    session = stream_sessions.get(session_id)
+    if session is not None:
+        stream_sessions.set(session_id, session)
+    return session
+
+
+def _track_frame(session, payload):
+    with session.lock:
+        detected = session.needs_detection()
+        confirmed = session.detect(load_image(payload)) if detected else []
+        return detected, confirmed
+
+
+async def process_stream_frame(session, payload):
+    """Track one frame of a stream and mark attendance for newly confirmed faces"""
+    if session.scope:
+        await load_scope(session.scope)
+    detected, confirmed = await run(_track_frame, session, payload)
+
+    new = {track.user_id for track in confirmed if track.user_id not in session.marked}
+    users = await db.get_users(new) if new else {}
+    for track in confirmed:
+        if track.user_id in users and track.user_id not in session.marked:
+            session.marked[track.user_id] = await db.mark_attendance(track.user_id, session.period, session.subject)
+        track.attendance_id = session.marked.get(track.user_id)
+
+    return {
+        "frame": session.frames,
+        "detected": detected,
+        "tracks": [track.to_dict() for track in session.tracker.tracks],
+        "confirmed": [dict(track.to_dict(), user=users.get(track.user_id)) for track in confirmed]
+    }
+
+
+async def stream_frame(request):
+    """One frame of a stream, sent as a raw image body, multipart file or base64 JSON"""
+    session = get_stream(request.path_params['session_id'])
+    if session is None:
+        return respond({"error": "Unknown or expired stream session"}, 404)
+
+    payloads = await read_payloads(request, field='image')
+    if not payloads:
+        return respond({"error": "No image provided"}, 400)
+
+    return respond(await process_stream_frame(session, payloads[0]))
+
+
+async def stream_mjpeg(request):
+    """A chunked MJPEG upload; answers with one NDJSON line per frame as the frames arrive"""
+    session_id = request.path_params['session_id']
+    session = get_stream(session_id)
+    if session is None:
+        return respond({"error": "Unknown or expired stream session"}, 404)
+
+    async def generate():
+        splitter = JpegFrameSplitter()
+        async for chunk in request.stream():
+            for frame in splitter.feed(chunk):
+                try:
+                    result = await process_stream_frame(session, frame)
+                except ImageRejected as error:
+                    result = {"frame": session.frames, "error": str(error)}
+                stream_sessions.set(session_id, session)
+                yield dumps(result) + '\n'
+    return UploadStreamingResponse(generate(), media_type='application/x-ndjson')
+
+
+async def stream_websocket(websocket):
+    """A stream over a WebSocket: binary JPEG/PNG frames (or data URLs) in, one JSON message per frame out"""
+    session_id = websocket.path_params['session_id']
+    session = get_stream(session_id)
+    if session is None:
+        await websocket.close(code=4404)
+        return
+
+    await websocket.accept()
+    try:
+        while True:
+            message = await websocket.receive()
+            if message['type'] == 'websocket.disconnect':
+                break
+            payload = message.get('bytes') or message.get('text')
+            if not payload:
+                continue
+            try:
+                if isinstance(payload, bytes):
+                    check_size(len(payload))
+                result = await process_stream_frame(session, payload)
+            except (ImageRejected, InferencePoolBusy) as error:
+                result = {"frame": session.frames, "error": str(error)}
+            stream_sessions.set(session_id, session)
+            await websocket.send_text(dumps(result))
+    except WebSocketDisconnect:
+        pass
+
+
+async def stream_session(request):
+    """Frame, detection and encoding counts of a stream; DELETE also closes it"""
+    session_id = request.path_params['session_id']
+    session = get_stream(session_id)
+    if session is None:
+        return respond({"error": "Unknown or expired stream session"}, 404)
+    if request.method == 'DELETE':
+        stream_sessions.pop(session_id)
+    return respond(session.snapshot())
+
+
+async def get_stats(request):
+    """Recognition latency per stage and micro-batching statistics"""
+    return respond(dict(face_module.snapshot_stats(), user_cache=db.user_cache.snapshot()))
+
+
+async def get_metrics(request):
+    """Stage latency histograms, gallery size, cache and queue gauges for Prometheus"""
+    return Response(metrics.render(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+async def get_users(request):
+    after, limit = page_args(request)
+    return await list_response(request, "users", db.iter_users(after, limit), 'user_id', limit)
+
+
+async def delete_user(request):
+    """Remove a student and their face encodings; attendance history is kept"""
+    user_id = request.path_params['user_id']
+    removed = await run(face_module.remove_user, user_id)
+    deleted = await db.delete_user(user_id)
+
+    if not (removed or deleted):
+        return respond({"error": "User not found"}, 404)
+    return respond({"message": "Student deleted", "user_id": user_id, "encodings_removed": removed})
+
+
+async def get_departments(request):
+    return respond({"departments": await db.get_departments()})
+
+
+async def get_attendance(request):
+    date = request.query_params.get('date', datetime.now().strftime('%Y-%m-%d'))
+    period = request.query_params.get('period')
+    after, limit = page_args(request)
+    cursor = db.iter_attendance_by_date(date, period, after, limit)
+    return await list_response(request, "attendance", cursor, 'attendance_id', limit)
+
+
+async def get_monthly_attendance(request):
+    month = request.query_params.get('month', datetime.now().strftime('%Y-%m'))
+    department = request.query_params.get('department', 'all')
+    return respond({"attendance": await db.get_monthly_attendance(month, department)})
+
+
+async def roster(request):
+    """A named group of students (a class or section); recognition can be scoped to it as roster:<roster_id>"""
+    roster_id = request.path_params['roster_id']
+    if request.method == 'PUT':
+        try:
+            data = await request.json()
+        except ValueError:
+            data = {}
+        user_ids = data.get('user_ids') if isinstance(data, dict) else None
+        if not isinstance(user_ids, list):
+            return respond({"error": "user_ids must be a list"}, 400)
+        await db.set_roster(roster_id, user_ids, data.get('name'))
+        face_module.drop_scope(f"roster:{roster_id}")
+
+    document = await db.get_roster(roster_id)
+    if document is None:
+        return respond({"error": "Roster not found"}, 404)
+    return respond(document)
+
+
+async def image_rejected(request, error):
+    """Oversized, empty or undecodable images never reach face detection"""
+    return respond({"error": str(error)}, error.status)
+
+
+async def invalid_scope(request, error):
+    return respond({"error": str(error)}, 400)
+
+
+async def inference_busy(request, error):
+    """Shed load instead of queueing requests behind a saturated inference pool"""
+    return respond({"error": str(error)}, 503, {'Retry-After': '1'})
+
+
+class TimingMiddleware:
+    """Per-endpoint request histograms and the Server-Timing header"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        started = metrics.begin_request()
+
+        async def send_with_timing(message):
+            if message['type'] == 'http.response.start':
+                timing = metrics.server_timing_header()
+                if timing:
+                    message['headers'] = list(message.get('headers', [])) + [(b'server-timing', timing.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            endpoint = scope.get('endpoint')
+            metrics.end_request(getattr(endpoint, '__name__', None), started)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    await db.ensure_indexes()
+    watcher = asyncio.create_task(db.watch_changes())
+    yield
+    watcher.cancel()
+    executor.shutdown(wait=False, cancel_futures=True)
+    if inference_pool is not None:
+        inference_pool.shutdown()
+
+
+routes = [
+    Route('/api/verify-face', verify_face, methods=['POST']),
+    Route('/api/register', register_user, methods=['POST']),
+    Route('/api/recognize', recognize_face, methods=['POST']),
+    Route('/api/recognize/batch', recognize_faces_batch, methods=['POST']),
+    Route('/api/stream/sessions', start_stream, methods=['POST']),
+    Route('/api/stream/sessions/{session_id}/frames', stream_frame, methods=['POST']),
+    Route('/api/stream/sessions/{session_id}/mjpeg', stream_mjpeg, methods=['POST']),
+    WebSocketRoute('/api/stream/sessions/{session_id}/ws', stream_websocket),
+    Route('/api/stream/sessions/{session_id}', stream_session, methods=['GET', 'DELETE']),
+    Route('/api/stats', get_stats, methods=['GET']),
+    Route('/metrics', get_metrics, methods=['GET']),
+    Route('/api/users', get_users, methods=['GET']),
+    Route('/api/users/{user_id}', delete_user, methods=['DELETE']),
+    Route('/api/departments', get_departments, methods=['GET']),
+    Route('/api/rosters/{roster_id}', roster, methods=['GET', 'PUT']),
+    Route('/api/attendance', get_attendance, methods=['GET']),
+    Route('/api/attendance/monthly', get_monthly_attendance, methods=['GET']),
+]
+
+app = Starlette(
+    routes=routes,
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*']),
+        Middleware(TimingMiddleware),
+    ],
+    exception_handlers={ImageRejected: image_rejected, InferencePoolBusy: inference_busy, ScopeError: invalid_scope},
+    lifespan=lifespan,
+)
@@ -0,0 +1,236 @@
+import os
+import uuid
+from datetime import datetime
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError, OperationFailure
+
+import metrics
+from caching import TTLCache
+from shards import parse_scope
+from database import (
+    INDEXES, attendance_upsert, bulk_upsert_outcome, monthly_increments, attendance_pipeline, monthly_queries, monthly_report
+)
+
+
+class AsyncDatabase:
+    """Motor (asyncio) counterpart of Database for the ASGI server.
+
+    Queries are built by the same helpers as Database, so both servers read
+    and write identical documents; only the I/O is non-blocking.
+    """
+
+    def __init__(self, mongo_uri=None, db_name='student_attendance_system', client=None,
+                 cache_size=10000, cache_ttl=60.0):
+        mongo_uri = mongo_uri or os.getenv('MONGO_URI')
+        self.client = client or AsyncIOMotorClient(mongo_uri)
+        self.db = self.client[db_name]
+        self.users_collection = self.db['users']
+        self.attendance_collection = self.db['attendance']
+        self.departments_collection = self.db['departments']
+        self.monthly_collection = self.db['attendance_monthly']
+        self.rosters_collection = self.db['rosters']
+
+        # Same read-through caches as Database
+        self.user_cache = TTLCache(cache_size, cache_ttl)
+        self.departments_cache = TTLCache(1, cache_ttl)
+
+    async def ensure_indexes(self):
+        """Create the declared indexes; existing ones are left untouched"""
+        for collection, indexes in INDEXES.items():
+            for keys, options in indexes:
+                try:
+                    await self.db[collection].create_index(keys, **options)
+                except OperationFailure as e:
+                    print(f"Could not create index {collection}.{options['name']}: {e}")
+
+    async def watch_changes(self):
+        """Invalidate the caches on changes made by other processes; runs until cancelled"""
+        pipeline = [{'$match': {'ns.coll': {'$in': ['users', 'departments']}}}]
+        try:
+            async with self.db.watch(pipeline) as stream:
+                async for change in stream:
+                    if change['ns']['coll'] == 'departments':
+                        self.departments_cache.clear()
+                    elif change['operationType'] != 'insert':
+                        self.user_cache.clear()
+        except OperationFailure as e:
+            print(f"No change stream ({e}); cached users and departments expire after {self.user_cache.ttl}s")
+
+    async def add_user(self, name, email, department):
+        """Add a new student to the database"""
+        user_id = str(uuid.uuid4())
+        await self.users_collection.insert_one({
+            'user_id': user_id,
+            'name': name,
+            'email': email,
+            'department': department,
+            'created_at': datetime.now()
+        })
+        await self.departments_collection.update_one(
+            {'name': department},
+            {'$set': {'name': department}},
+            upsert=True
+        )
+        self.departments_cache.clear()
+        return user_id
+
+    @metrics.timed('get_user')
+    async def get_user(self, user_id):
+        user = self.user_cache.get(user_id)
+        if user is None:
+            user = await self.users_collection.find_one({'user_id': user_id}, {'_id': 0})
+            if user is not None:
+                self.user_cache.set(user_id, user)
+        return user
+
+    @metrics.timed('get_users')
+    async def get_users(self, user_ids):
+        """Get several users by ID in one query, keyed by user_id"""
+        found = {}
+        missing = []
+        for user_id in user_ids:
+            user = self.user_cache.get(user_id)
+            if user is None:
+                missing.append(user_id)
+            else:
+                found[user_id] = user
+        if missing:
+            async for user in self.users_collection.find({'user_id': {'$in': missing}}, {'_id': 0}):
+                self.user_cache.set(user['user_id'], user)
+                found[user['user_id']] = user
+        return found
+
+    async def get_user_by_email(self, email):
+        return await self.users_collection.find_one({'email': email})
+
+    async def delete_user(self, user_id):
+        """Remove a student; their attendance history is kept"""
+        result = await self.users_collection.delete_one({'user_id': user_id})
+        await self.rosters_collection.update_many({'user_ids': user_id}, {'$pull': {'user_ids': user_id}})
+        self.user_cache.pop(user_id)
+        return result.deleted_count > 0
+
+    async def set_roster(self, roster_id, user_ids, name=None):
+        """Create or replace a roster of students"""
+        await self.rosters_collection.update_one(
+            {'roster_id': roster_id},
+            {'$set': {'user_ids': list(dict.fromkeys(user_ids)), 'name': name or roster_id, 'updated_at': datetime.now()}},
+            upsert=True
+        )
+
+    async def get_roster(self, roster_id):
+        return await self.rosters_collection.find_one({'roster_id': roster_id}, {'_id': 0})
+
+    async def get_scope_members(self, scope, among=None):
+        """user_ids in a recognition scope: every student of a department, or the members of a roster
+        (only those of `among`, when given)"""
+        kind, name = parse_scope(scope)
+        if kind == 'department':
+            query = {'department': name}
+            if among is not None:
+                query['user_id'] = {'$in': list(among)}
+            return {user['user_id'] async for user in self.users_collection.find(query, {'_id': 0, 'user_id': 1})}
+        roster = await self.rosters_collection.find_one({'roster_id': name}, {'_id': 0, 'user_ids': 1})
+        members = set(roster['user_ids']) if roster else set()
+        return members if among is None else members & set(among)
+
+    async def get_scope_version(self, scope):
+        """When a roster was last changed (None for a department or a missing roster)"""
+        kind, name = parse_scope(scope)
+        if kind == 'department':
+            return None
+        roster = await self.rosters_collection.find_one({'roster_id': name}, {'_id': 0, 'updated_at': 1})
+        return roster['updated_at'] if roster else None
+
+    def iter_users(self, after=None, limit=None, batch_size=500):
+        """Async cursor over users ordered by user_id, starting after the given user_id"""
+        query = {'user_id': {'$gt': after}} if after else {}
+        cursor = self.users_collection.find(query, {'_id': 0}).sort('user_id', 1).batch_size(batch_size)
+        if limit:
+            cursor = cursor.limit(limit)
+        return cursor
+
+    async def get_departments(self):
+        names = self.departments_cache.get('all')
+        if names is None:
+            names = [dept['name'] async for dept in self.departments_collection.find({}, {'_id': 0})]
+            self.departments_cache.set('all', names)
+        return names
+
+    @metrics.timed('mark_attendance')
+    async def mark_attendance(self, user_id, period, subject):
+        """Mark attendance for a student for a specific period and subject"""
+        attendance_id = str(uuid.uuid4())
+        query, update = attendance_upsert(user_id, period, subject, datetime.now(), attendance_id)
+        record = await self.attendance_collection.find_one_and_update(
+            query, update,
+            projection={'attendance_id': 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        if record.get('attendance_id') == attendance_id:
+            await self._increment_monthly([user_id], query['date'])
+        return record.get('attendance_id', str(record['_id']))
+
+    @metrics.timed('mark_attendance_many')
+    async def mark_attendance_many(self, user_ids, period, subject):
+        """Mark attendance for several students at once; returns {user_id: attendance_id}"""
+        now = datetime.now()
+        date = now.strftime('%Y-%m-%d')
+        user_ids = list(dict.fromkeys(user_ids))
+        if not user_ids:
+            return {}
+
+        new_ids = {user_id: str(uuid.uuid4()) for user_id in user_ids}
+        operations = [
+            UpdateOne(*attendance_upsert(user_id, period, subject, now, new_ids[user_id]), upsert=True)
+            for user_id in user_ids
+        ]
+        try:
+            upserted = list((await self.attendance_collection.bulk_write(operations, ordered=False)).upserted_ids)
+            failure = None
+        except BulkWriteError as e:
+            upserted, errors = bulk_upsert_outcome(e)
+            failure = e if errors else None
+
+        attendance_ids = {user_ids[index]: new_ids[user_ids[index]] for index in upserted}
+        await self._increment_monthly(list(attendance_ids), date)
+        if failure is not None:
+            raise failure
+
+        existing = [user_id for user_id in user_ids if user_id not in attendance_ids]
+        if existing:
+            async for record in self.attendance_collection.find(
+                {'user_id': {'$in': existing}, 'date': date, 'period': period},
+                {'user_id': 1, 'attendance_id': 1}
+            ):
+                attendance_ids[record['user_id']] = record.get('attendance_id', str(record['_id']))
+        return attendance_ids
+
+    async def _increment_monthly(self, user_ids, date):
+        operations = monthly_increments(user_ids, date)
+        if operations:
+            await self.monthly_collection.bulk_write(operations, ordered=False)
+
+    def iter_attendance_by_date(self, date, period=None, after=None, limit=None, batch_size=500):
+        """Async cursor over a date's attendance ordered by attendance_id"""
+        pipeline = attendance_pipeline(date, period, after, limit)
+        return self.attendance_collection.aggregate(pipeline, batchSize=batch_size)
+
+    async def get_monthly_attendance(self, month, department=None):
+        """Get monthly attendance report with percentage calculation"""
+        user_match, rollup_query = monthly_queries(month, department)
+        users = await self.users_collection.find(
+            user_match, {'_id': 0, 'user_id': 1, 'name': 1, 'department': 1}
+        ).to_list(None)
+        if user_match:
+            rollup_query['user_id'] = {'$in': [user['user_id'] for user in users]}
+        attendance_counts = {
+            record['user_id']: record['classes_attended']
+            async for record in self.monthly_collection.find(
+                rollup_query, {'_id': 0, 'user_id': 1, 'classes_attended': 1}
+            )
+        }
+        return monthly_report(month, users, attendance_counts)
@@ -0,0 +1,119 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class StageStats:
+    """Rolling latency samples per named stage"""
+
+    def __init__(self, window=2048):
+        self.window = window
+        self._samples = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, value):
+        with self._lock:
+            if stage not in self._samples:
+                self._samples[stage] = deque(maxlen=self.window)
+                self._counts[stage] = 0
+            self._samples[stage].append(value)
+            self._counts[stage] += 1
+
+    def snapshot(self, scale=1000.0):
+        """count, mean, p50, p99 and max per stage (seconds scaled to ms by default)"""
+        with self._lock:
+            samples = {stage: np.asarray(values) for stage, values in self._samples.items()}
+            counts = dict(self._counts)
+        return {
+            stage: {
+                'count': counts[stage],
+                'mean': round(float(values.mean()) * scale, 3),
+                'p50': round(float(np.percentile(values, 50)) * scale, 3),
+                'p99': round(float(np.percentile(values, 99)) * scale, 3),
+                'max': round(float(values.max()) * scale, 3),
+            }
+            for stage, values in samples.items() if len(values)
+        }
+
+
+class _Request:
+    __slots__ = ('encoding', 'k', 'enqueued', 'future')
+
+    def __init__(self, encoding, k):
+        self.encoding = encoding
+        self.k = k
+        self.enqueued = time.perf_counter()
+        self.future = Future()
+
+
+class RecognitionBatcher:
+    """Coalesces concurrent gallery searches into one matrix-matrix product.
+
+    The first waiting request opens a window of `max_wait_ms`; everything that
+    arrives before it closes (up to `max_batch_size`) is searched together
+    and the results are handed back to each waiting caller.
+    """
+
+    def __init__(self, search_batch, max_batch_size=32, max_wait_ms=2.0):
+        self.search_batch = search_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.stats = StageStats()
+        self.batch_sizes = StageStats()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='recognition-batcher', daemon=True)
+        self._thread.start()
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def search(self, encoding, k=1, timeout=None):
+        """Queue one search and wait for its (rows, distances)"""
+        request = _Request(np.asarray(encoding, dtype=np.float32).reshape(-1), k)
+        self._queue.put(request)
+        return request.future.result(timeout)
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = batch[0].enqueued + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started = time.perf_counter()
+            for request in batch:
+                self.stats.record('queue_wait', started - request.enqueued)
+            self.batch_sizes.record('batch_size', len(batch))
+
+            try:
+                k = max(request.k for request in batch)
+                rows, distances = self.search_batch(np.stack([request.encoding for request in batch]), k)
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            self.stats.record('batch_search', time.perf_counter() - started)
+
+            for i, request in enumerate(batch):
+                found = rows[i, :request.k] >= 0
+                request.future.set_result((rows[i, :request.k][found], distances[i, :request.k][found]))
+
+    def snapshot(self):
+        """Queue wait and batch search latency (ms), batch sizes and current queue depth"""
+        stats = self.stats.snapshot()
+        stats.update(self.batch_sizes.snapshot(scale=1.0))
+        stats['queue_depth'] = self.queue_depth
+        return stats
@@ -0,0 +1,105 @@
+"""Latency/recall tradeoff of each detection preset on the enrolled face images and on group photos.
+
+Usage: python benchmarks/bench_detection.py [--images 'known_faces/*.jpg'] [--presets fast balanced]
+                                            [--group-width 4000] [--group-rows 5]
+
+For every preset it reports how many images yield a face (recall), the
+detection + encoding latency and how far the encodings drift from the
+full-resolution 'default' preset (a drift well under the 0.4 match
+tolerance means the preset does not change who gets recognized).
+
+The group table does the same for a class photo laid out from the same
+images: rows of faces that shrink towards the back, as in /api/recognize/batch
+uploads, where recall is the share of the faces placed that were found.
+"""
+import argparse
+import glob
+import os
+import time
+
+import cv2
+import numpy as np
+
+from synthetic import BACKEND_DIR, percentile_ms
+from detection import PRESETS
+from face_recognition_module import detect_and_encode
+
+
+def load_images(pattern):
+    images = []
+    for path in sorted(glob.glob(pattern)):
+        image = cv2.imread(path, cv2.IMREAD_COLOR)
+        if image is not None:
+            images.append((os.path.basename(path), cv2.cvtColor(image, cv2.COLOR_BGR2RGB)))
+    return images
+
+
+def run_preset(images, preset):
+    timings = []
+    encodings = {}
+    for name, image in images:
+        start = time.perf_counter()
+        _, found = detect_and_encode(image, first_only=True, config=preset)
+        timings.append(time.perf_counter() - start)
+        if found:
+            encodings[name] = found[0]
+    return timings, encodings
+
+
+def make_group_photo(images, width, rows):
+    """A class photo: rows of faces, the back row a third the size of the front; returns (photo, faces placed)"""
+    height = width * 3 // 4
+    photo = np.full((height, width, 3), 90, dtype=np.uint8)
+    faces = [image for _, image in images]
+    placed = 0
+    y = 0
+    for row in range(rows):
+        # Back rows first, at the top of the frame
+        side = int(height / rows * (1 + 2 * row / max(rows - 1, 1)) / 3)
+        for x in range(0, width - side + 1, side):
+            photo[y:y + side, x:x + side] = cv2.resize(faces[placed % len(faces)], (side, side), interpolation=cv2.INTER_AREA)
+            placed += 1
+        y += side
+    return photo, placed
+
+
+def run_group(photo, preset):
+    start = time.perf_counter()
+    locations, _ = detect_and_encode(photo, config=preset)
+    return time.perf_counter() - start, len(locations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', default=os.path.join(BACKEND_DIR, 'known_faces', '*.jpg'))
+    parser.add_argument('--presets', nargs='+', default=list(PRESETS))
+    parser.add_argument('--group-width', type=int, default=4000, help="width of the group photo in pixels")
+    parser.add_argument('--group-rows', type=int, default=5, help="rows of faces in the group photo")
+    args = parser.parse_args()
+
+    images = load_images(args.images)
+    if not images:
+        parser.error(f"No images match {args.images}")
+
+    _, reference = run_preset(images, 'default')
+
+    print(f"{len(images)} images\n")
+    print(f"{'preset':<10} {'recall':>7} {'mean ms':>8} {'p95 ms':>8} {'drift mean':>11} {'drift max':>10}  settings")
+    for preset in args.presets:
+        timings, encodings = run_preset(images, preset)
+        drift = [np.linalg.norm(encodings[name] - reference[name]) for name in encodings if name in reference]
+        drift_mean = f"{np.mean(drift):.3f}" if drift else 'n/a'
+        drift_max = f"{np.max(drift):.3f}" if drift else 'n/a'
+        print(f"{preset:<10} {len(encodings) / len(images):>7.2f} {np.mean(timings) * 1000:>8.1f} "
+              f"{percentile_ms(timings, 95):>8.1f} {drift_mean:>11} {drift_max:>10}  {PRESETS[preset]}")
+
+    photo, placed = make_group_photo(images, args.group_width, args.group_rows)
+    print(f"\nGroup photo {photo.shape[1]}x{photo.shape[0]}, {placed} faces\n")
+    print(f"{'preset':<10} {'recall':>7} {'ms':>8}  settings")
+    for preset in args.presets:
+        seconds, found = run_group(photo, preset)
+        print(f"{preset:<10} {min(found, placed) / placed:>7.2f} {seconds * 1000:>8.1f}  {PRESETS[preset]}")
+
+
+if __name__ == '__main__':
+    main()
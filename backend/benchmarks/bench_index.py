@@ -0,0 +1,80 @@
+"""Recall and latency of the IVF face index against brute-force search.
+
+Usage: python benchmarks/bench_index.py [--sizes 10000 100000 1000000] [--nprobe N]
+
+Exits non-zero if recall@1 against brute force drops below --min-recall at
+any size, so it doubles as the recall check for the approximate index.
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from synthetic import make_identities, make_samples, percentile_ms
+from face_gallery import FaceGallery
+from face_index import create_index
+
+
+def time_queries(index, queries):
+    timings = []
+    rows = []
+    for query in queries:
+        start = time.perf_counter()
+        found, _ = index.search(query, 1)
+        timings.append(time.perf_counter() - start)
+        rows.append(found[0] if len(found) else -1)
+    return np.asarray(rows), timings
+
+
+def run(size, nprobe, queries):
+    identities = make_identities(size)
+    gallery = FaceGallery()
+    gallery.extend(list(range(size)), identities)
+    samples, _ = make_samples(identities, queries)
+
+    start = time.perf_counter()
+    ivf = create_index('ivf', gallery, nprobe=nprobe)
+    build_s = time.perf_counter() - start
+
+    brute = create_index('brute', gallery)
+    exact, brute_times = time_queries(brute, samples)
+    approx, ivf_times = time_queries(ivf, samples)
+
+    return {
+        'size': size,
+        'nlist': len(ivf.lists),
+        'nprobe': ivf.probes(len(ivf.lists)),
+        'build_s': round(build_s, 2),
+        'recall_at_1': float(np.mean(exact == approx)),
+        'brute_p50_ms': percentile_ms(brute_times, 50),
+        'brute_p99_ms': percentile_ms(brute_times, 99),
+        'ivf_p50_ms': percentile_ms(ivf_times, 50),
+        'ivf_p99_ms': percentile_ms(ivf_times, 99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--nprobe', type=int, help="cells probed per query (default: sized from nlist)")
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--min-recall', type=float, default=0.99)
+    args = parser.parse_args()
+
+    ok = True
+    print(f"{'size':>9} {'nlist':>6} {'nprobe':>6} {'recall@1':>9} {'brute p50/p99 ms':>18} {'ivf p50/p99 ms':>16} {'build s':>8}")
+    for size in args.sizes:
+        r = run(size, args.nprobe, args.queries)
+        print(f"{r['size']:>9} {r['nlist']:>6} {r['nprobe']:>6} {r['recall_at_1']:>9.3f} "
+              f"{r['brute_p50_ms']:>8.3f} /{r['brute_p99_ms']:>8.3f} "
+              f"{r['ivf_p50_ms']:>7.3f} /{r['ivf_p99_ms']:>7.3f} {r['build_s']:>8}")
+        ok = ok and r['recall_at_1'] >= args.min_recall
+
+    if not ok:
+        print(f"Recall fell below {args.min_recall}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
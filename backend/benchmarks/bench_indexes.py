@@ -0,0 +1,131 @@
+"""Query plans and latency of the hot Database queries before and after index provisioning.
+
+Usage:
+    python benchmarks/bench_indexes.py [--uri mongodb://localhost:27017] [--rows 1000000]
+    python benchmarks/bench_indexes.py --mongomock --rows 20000
+
+Works on its own `attendance_index_benchmark` database, which is dropped
+and regenerated on every run. mongomock has no query planner, so only
+timings are reported there.
+"""
+import argparse
+import time
+import uuid
+from datetime import date, timedelta
+
+import synthetic  # noqa: F401  (puts the backend on sys.path)
+from database import Database
+
+DB_NAME = 'attendance_index_benchmark'
+PERIODS = 5
+
+
+def populate(db, rows, users_count):
+    users = [
+        {
+            'user_id': str(uuid.uuid4()),
+            'name': f"Student {i}",
+            'email': f"student{i}@example.edu",
+            'department': f"Dept {i % 20}",
+        }
+        for i in range(users_count)
+    ]
+    db.users_collection.insert_many(users)
+
+    days = -(-rows // (users_count * PERIODS))
+    start = date(2025, 1, 1)
+    batch = []
+    written = 0
+    for day in range(days):
+        day_str = (start + timedelta(days=day)).strftime('%Y-%m-%d')
+        for period in range(1, PERIODS + 1):
+            for user in users:
+                batch.append({
+                    'attendance_id': str(uuid.uuid4()),
+                    'user_id': user['user_id'],
+                    'date': day_str,
+                    'period': period,
+                    'subject': 'Maths',
+                    'time': '09:00:00',
+                })
+                written += 1
+                if len(batch) == 10000 or written == rows:
+                    db.attendance_collection.insert_many(batch, ordered=False)
+                    batch = []
+                if written == rows:
+                    return users
+
+
+def plan_of(collection, query):
+    try:
+        plan = collection.find(query).explain()['queryPlanner']['winningPlan']
+    except Exception:
+        return 'n/a'
+    stages = []
+    while plan:
+        stages.append(plan.get('stage', '?'))
+        plan = plan.get('inputStage')
+    return ' <- '.join(stages)
+
+
+def measure(db, users, repeat):
+    user = users[len(users) // 2]
+    queries = [
+        ('get_user', db.users_collection, {'user_id': user['user_id']}),
+        ('get_user_by_email', db.users_collection, {'email': user['email']}),
+        ('users by department', db.users_collection, {'department': user['department']}),
+        ('attendance by date+period', db.attendance_collection, {'date': '2025-01-02', 'period': 3}),
+        ('attendance month range', db.attendance_collection, {'date': {'$gte': '2025-01-01', '$lte': '2025-01-31'}}),
+        ('attendance by user+date', db.attendance_collection, {'user_id': user['user_id'], 'date': '2025-01-02'}),
+    ]
+    results = []
+    for name, collection, query in queries:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            list(collection.find(query, {'_id': 0}))
+        elapsed_ms = (time.perf_counter() - start) * 1000.0 / repeat
+        results.append((name, elapsed_ms, plan_of(collection, query)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--uri', default='mongodb://localhost:27017')
+    parser.add_argument('--mongomock', action='store_true')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.mongomock:
+        import mongomock
+        client = mongomock.MongoClient()
+    else:
+        from pymongo import MongoClient
+        client = MongoClient(args.uri)
+    client.drop_database(DB_NAME)
+
+    db = Database(db_name=DB_NAME, client=client)
+    for collection in (db.users_collection, db.attendance_collection, db.departments_collection):
+        collection.drop_indexes()
+
+    print(f"Populating {args.rows} attendance rows for {args.users} students...")
+    users = populate(db, args.rows, min(args.users, args.rows))
+
+    before = measure(db, users, args.repeat)
+    start = time.perf_counter()
+    db.ensure_indexes()
+    build_s = time.perf_counter() - start
+    missing = db.verify_indexes()
+    after = measure(db, users, args.repeat)
+
+    print(f"Index build: {build_s:.1f}s, missing after build: {missing or 'none'}\n")
+    print(f"{'query':<28} {'before ms':>10} {'after ms':>10}  plan before -> after")
+    for (name, before_ms, before_plan), (_, after_ms, after_plan) in zip(before, after):
+        print(f"{name:<28} {before_ms:>10.2f} {after_ms:>10.2f}  {before_plan} -> {after_plan}")
+
+    client.drop_database(DB_NAME)
+
+
+if __name__ == '__main__':
+    main()
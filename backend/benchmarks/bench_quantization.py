@@ -0,0 +1,135 @@
+"""Accuracy loss, memory and latency of the compressed (fp16 / int8 / pq) indexes against exact search.
+
+Usage: python benchmarks/bench_quantization.py [--size 100000] [--codecs fp16 int8 pq] [--refine 32]
+       [--min-recall 0.99] [--max-distance-error 1e-4] [--min-agreement 0.999]
+
+Queries are new photos of enrolled people (which should match) and people
+who were never enrolled (which should not). For every codec it reports:
+  - bytes per row held by the index, against 512 for float32 rows
+  - error of the raw code distance (before re-ranking) to the exact distance
+  - recall@1 against brute force, with and without the full-precision re-rank
+  - recall@1 and the error of the returned distance over the queries whose
+    true nearest row is within --tolerance (the ones that decide a match)
+  - agreement with brute force on the match decision at --tolerance
+    (same person, or both under no match)
+
+Overall recall counts strangers too, whose nearest rows are all about as far
+and out of tolerance, so product quantization ranks them loosely without
+changing any decision; the within-tolerance recall is the one that matters.
+
+Exits non-zero if, with the re-rank, the within-tolerance recall falls below
+--min-recall, its distance error exceeds --max-distance-error or the decision
+agreement falls below --min-agreement, so it doubles as the accuracy check
+for the codecs.
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from synthetic import make_identities, make_samples, percentile_ms
+from face_gallery import FaceGallery
+from face_index import create_index
+
+
+def top1(index, queries):
+    rows = np.full(len(queries), -1)
+    distances = np.full(len(queries), np.inf)
+    timings = []
+    for i, query in enumerate(queries):
+        start = time.perf_counter()
+        found, dist = index.search(query, 1)
+        timings.append(time.perf_counter() - start)
+        if len(found):
+            rows[i], distances[i] = found[0], dist[0]
+    return rows, distances, timings
+
+
+def decisions(rows, distances, tolerance):
+    return np.where(distances <= tolerance, rows, -1)
+
+
+def run(codec, gallery, queries, exact, tolerance, refine):
+    start = time.perf_counter()
+    index = create_index(codec, gallery, refine=refine)
+    build_s = time.perf_counter() - start
+    exact_rows, exact_distances = exact
+
+    rows, distances, timings = top1(index, queries)
+    index.refine = 1
+    raw_rows, raw_distances, _ = top1(index, queries)
+
+    # Distance the codes alone give to each query's true nearest row
+    code_distances = np.array([
+        np.sqrt(max(index._approximate(query)[row], 0.0)) for query, row in zip(queries, exact_rows)
+    ])
+    code_error = np.abs(code_distances - exact_distances)
+
+    expected = decisions(exact_rows, exact_distances, tolerance)
+    matchable = exact_distances <= tolerance
+    return {
+        'codec': codec,
+        'bytes_per_row': index.nbytes / len(gallery),
+        'build_s': round(build_s, 2),
+        'code_error_mean': float(code_error.mean()),
+        'code_error_max': float(code_error.max()),
+        'raw_recall_at_1': float(np.mean(raw_rows == exact_rows)),
+        'raw_agreement': float(np.mean(decisions(raw_rows, raw_distances, tolerance) == expected)),
+        'recall_at_1': float(np.mean(rows == exact_rows)),
+        'agreement': float(np.mean(decisions(rows, distances, tolerance) == expected)),
+        'match_recall': float(np.mean(rows[matchable] == exact_rows[matchable])) if matchable.any() else 1.0,
+        'match_distance_error': float(np.abs(distances[matchable] - exact_distances[matchable]).max())
+        if matchable.any() else 0.0,
+        'p50_ms': percentile_ms(timings, 50),
+        'p99_ms': percentile_ms(timings, 99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=100000)
+    parser.add_argument('--codecs', nargs='+', default=['fp16', 'int8', 'pq'])
+    parser.add_argument('--refine', type=int, default=32)
+    parser.add_argument('--queries', type=int, default=1000, help="half enrolled, half strangers")
+    parser.add_argument('--tolerance', type=float, default=0.4)
+    parser.add_argument('--min-agreement', type=float, default=0.999)
+    parser.add_argument('--min-recall', type=float, default=0.99, help="recall@1 within --tolerance")
+    parser.add_argument('--max-distance-error', type=float, default=1e-4, help="within --tolerance")
+    args = parser.parse_args()
+
+    identities = make_identities(args.size)
+    gallery = FaceGallery()
+    gallery.extend(list(range(args.size)), identities)
+    enrolled, _ = make_samples(identities, args.queries // 2)
+    strangers = make_identities(args.queries - len(enrolled), seed=3)
+    queries = np.concatenate([enrolled, strangers])
+
+    brute = create_index('brute', gallery)
+    exact_rows, exact_distances, brute_times = top1(brute, queries)
+    print(f"{args.size} rows, {len(queries)} queries, tolerance {args.tolerance}; "
+          f"float32 brute force: 512 B/row, p50 {percentile_ms(brute_times, 50):.2f} ms\n")
+
+    print(f"{'codec':<6} {'B/row':>6} {'code err mean/max':>18} {'raw recall/agree':>17} "
+          f"{'recall/agree':>13} {'in-tol recall/err':>18} {'p50/p99 ms':>14} {'build s':>8}")
+    failures = []
+    for codec in args.codecs:
+        r = run(codec, gallery, queries, (exact_rows, exact_distances), args.tolerance, args.refine)
+        print(f"{r['codec']:<6} {r['bytes_per_row']:>6.0f} {r['code_error_mean']:>9.4f}/{r['code_error_max']:<8.4f} "
+              f"{r['raw_recall_at_1']:>8.3f}/{r['raw_agreement']:<8.3f} {r['recall_at_1']:>6.3f}/{r['agreement']:<6.3f} "
+              f"{r['match_recall']:>8.3f}/{r['match_distance_error']:<9.2e} "
+              f"{r['p50_ms']:>6.2f}/{r['p99_ms']:<7.2f} {r['build_s']:>8}")
+        if r['agreement'] < args.min_agreement:
+            failures.append(f"{codec}: match decisions agreed with brute force {r['agreement']:.3f} of the time")
+        if r['match_recall'] < args.min_recall:
+            failures.append(f"{codec}: recall@1 within tolerance {r['match_recall']:.3f}")
+        if r['match_distance_error'] > args.max_distance_error:
+            failures.append(f"{codec}: distance error within tolerance {r['match_distance_error']:.2e}")
+
+    if failures:
+        print('\n'.join(failures))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""Requests/sec and latency of running servers under concurrent load.
+
+Usage:
+    gunicorn -c gunicorn.conf.py -b :5000 app:app
+    gunicorn -c gunicorn.conf.py -b :8000 -k uvicorn.workers.UvicornWorker asgi:app
+    python benchmarks/bench_server.py --url http://localhost:5000 --url http://localhost:8000 \
+        [--concurrency 32] [--duration 20] [--image face.jpg]
+
+Each client thread keeps one connection open and sends requests back to back.
+/api/recognize gets a raw JPEG body (a real photo with --image, otherwise a
+synthetic frame, which exercises decoding and detection but matches nobody);
+/api/departments measures the metadata path alone.
+"""
+import argparse
+import http.client
+import threading
+import time
+from urllib.parse import urlsplit
+
+import synthetic
+from bench_upload import make_frame
+
+
+def load(url, method, path, body, headers, concurrency, duration):
+    """Hammer one endpoint; returns (latencies of successful requests, status code counts)"""
+    target = urlsplit(url)
+    deadline = time.perf_counter() + duration
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def client():
+        connection = http.client.HTTPConnection(target.hostname, target.port, timeout=30)
+        mine = []
+        seen = {}
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection(target.hostname, target.port, timeout=30)
+                status = 'error'
+            seen[status] = seen.get(status, 0) + 1
+            # 404 is the expected answer for a face nobody enrolled
+            if status in (200, 404):
+                mine.append(time.perf_counter() - start)
+        connection.close()
+        with lock:
+            latencies.extend(mine)
+            for status, count in seen.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', action='append', required=True, help="server to test; repeat to compare several")
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=20.0, help="seconds per endpoint and server")
+    parser.add_argument('--image', help="JPEG to recognize (default: a synthetic 640x480 frame)")
+    args = parser.parse_args()
+
+    if args.image:
+        with open(args.image, 'rb') as f:
+            jpeg = f.read()
+    else:
+        jpeg = make_frame(640, 480)
+
+    endpoints = {
+        'recognize': ('POST', '/api/recognize?period=1&subject=Maths', jpeg, {'Content-Type': 'image/jpeg'}),
+        'departments': ('GET', '/api/departments', None, {}),
+    }
+
+    print(f"{args.concurrency} concurrent clients, {args.duration:.0f}s per run\n")
+    print(f"{'server':<28} {'endpoint':<12} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for url in args.url:
+        for name, (method, path, body, headers) in endpoints.items():
+            latencies, statuses = load(url, method, path, body, headers, args.concurrency, args.duration)
+            errors = sum(count for status, count in statuses.items() if status not in (200, 404))
+            if latencies:
+                p50 = f"{synthetic.percentile_ms(latencies, 50):>8.1f}"
+                p99 = f"{synthetic.percentile_ms(latencies, 99):>8.1f}"
+            else:
+                p50 = p99 = f"{'-':>8}"
+            print(f"{url:<28} {name:<12} {len(latencies) / args.duration:>8.1f} {p50} {p99} {errors:>7}")
+
+
+if __name__ == '__main__':
+    main()
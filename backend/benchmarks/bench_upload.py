@@ -0,0 +1,81 @@
+"""Request size and ingest time of base64 JSON vs multipart vs raw image uploads.
+
+Usage: python benchmarks/bench_upload.py [--width 1280 --height 720] [--repeat 200]
+
+Posts the same JPEG frame through a minimal Flask app that uses the
+backend's ingest helpers, so the numbers include Flask's body parsing but
+no face detection.
+"""
+import argparse
+import base64
+import io
+import time
+
+import cv2
+import numpy as np
+from flask import Flask, jsonify
+from werkzeug.test import EnvironBuilder
+
+import synthetic  # noqa: F401  (puts the backend on sys.path)
+from image_ingest import read_image_bytes, decode_image, request_fields
+
+
+def make_frame(width, height):
+    # Smooth gradients plus noise compress roughly like a webcam frame
+    y, x = np.mgrid[0:height, 0:width]
+    frame = np.dstack([(x * 255 // width), (y * 255 // height), ((x + y) * 127 // (width + height))])
+    frame = frame + np.random.default_rng(0).integers(0, 24, frame.shape)
+    return cv2.imencode('.jpg', frame.astype(np.uint8), [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+
+
+def make_app():
+    app = Flask(__name__)
+
+    @app.route('/ingest', methods=['POST'])
+    def ingest():
+        request_fields()
+        img = decode_image(read_image_bytes())
+        return jsonify({"shape": img.shape})
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    jpeg = make_frame(args.width, args.height)
+    data_url = 'data:image/jpeg;base64,' + base64.b64encode(jpeg).decode()
+    client = make_app().test_client()
+
+    requests = {
+        'json+base64': dict(path='/ingest', json={'image': data_url, 'period': 1, 'subject': 'Maths'}),
+        'multipart': dict(path='/ingest', content_type='multipart/form-data',
+                          data=lambda: {'period': '1', 'subject': 'Maths', 'image': (io.BytesIO(jpeg), 'frame.jpg')}),
+        'raw image/jpeg': dict(path='/ingest?period=1&subject=Maths', data=jpeg, content_type='image/jpeg'),
+    }
+
+    def build(options):
+        options = dict(options)
+        if callable(options.get('data')):
+            options['data'] = options['data']()
+        return options
+
+    print(f"{args.width}x{args.height} JPEG, {len(jpeg) / 1024:.0f} KiB\n")
+    print(f"{'upload':<16} {'body KiB':>9} {'mean ms':>8} {'p95 ms':>8}")
+    for name, options in requests.items():
+        size = int(EnvironBuilder(method='POST', **build(options)).get_environ()['CONTENT_LENGTH'])
+        assert client.post(**build(options)).status_code == 200
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            client.post(**build(options))
+            timings.append(time.perf_counter() - start)
+        print(f"{name:<16} {size / 1024:>9.0f} {np.mean(timings) * 1000:>8.2f} {synthetic.percentile_ms(timings, 95):>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
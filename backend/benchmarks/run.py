@@ -0,0 +1,372 @@
+"""Benchmark suite for the recognition, enrolment, HTTP and reporting paths, as JSON.
+
+Usage:
+    python benchmarks/run.py [--suites recognize enrol http monthly] [--output results.json]
+    python benchmarks/run.py --uri mongodb://localhost:27017 --output results.json
+    python benchmarks/run.py --quick --output smoke.json
+    python benchmarks/run.py --compare before.json after.json
+
+Needs no network: galleries are filled with synthetic encodings, the face
+images are the bundled known_faces/*.jpg, and MongoDB is mongomock unless
+--uri points at a local mongod (the suite then works on its own
+`attendance_benchmark` database, dropped at the end of the run). Every run
+happens in a scratch directory, so the server's own gallery is never touched.
+
+The JSON carries the commit, environment and parameters next to the numbers;
+--compare prints every metric of two runs side by side.
+"""
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+import numpy as np
+
+from synthetic import BACKEND_DIR, make_identities, make_samples, percentile_ms
+
+DB_NAME = 'attendance_benchmark'
+SUITES = ('recognize', 'enrol', 'http', 'monthly')
+
+
+def summarize(timings):
+    """count, mean, p50 and p99 in milliseconds"""
+    return {
+        'count': len(timings),
+        'mean_ms': round(float(np.mean(timings)) * 1000.0, 3),
+        'p50_ms': round(percentile_ms(timings, 50), 3),
+        'p99_ms': round(percentile_ms(timings, 99), 3),
+    }
+
+
+def load_images(pattern):
+    """(name, JPEG bytes, RGB image) of every readable image"""
+    import cv2
+    images = []
+    for path in sorted(glob.glob(pattern)):
+        with open(path, 'rb') as f:
+            data = f.read()
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if image is not None:
+            images.append((os.path.basename(path), data, cv2.cvtColor(image, cv2.COLOR_BGR2RGB)))
+    return images
+
+
+def create_module(path, index):
+    """A FaceRecognitionModule on its own gallery, without caches, batching or reloads skewing the timings"""
+    from face_recognition_module import FaceRecognitionModule
+    return FaceRecognitionModule(None, index, gallery_path=path, batch_window_ms=None,
+                                 cache_size=0, reload_interval=0)
+
+
+def bench_recognize(args, images, workdir):
+    """recognize_face on the bundled images, and search alone on synthetic queries, per gallery size"""
+    results = []
+    for size in args.sizes:
+        module = create_module(os.path.join(workdir, f'recognize_{size}'), args.index)
+        identities = make_identities(size)
+        module.gallery.extend([f'synthetic-{i}' for i in range(size)], identities)
+        enrolled = {}
+        for name, _, image in images:
+            with contextlib.suppress(ValueError):
+                module.add_faces(name, [image])
+                enrolled[name] = image
+        module.sync()
+        # Without a watcher thread the index is trained here, as it would be in the background
+        module.rebuild_index()
+
+        queries, who = make_samples(identities, args.queries)
+        search_timings = []
+        found = 0
+        for query, identity in zip(queries, who):
+            started = time.perf_counter()
+            matches = module.search(query, k=1)
+            search_timings.append(time.perf_counter() - started)
+            found += bool(matches) and matches[0][0] == f'synthetic-{identity}'
+
+        recognize_timings = []
+        recognized = 0
+        for _ in range(args.repeat):
+            for name, image in enrolled.items():
+                started = time.perf_counter()
+                user_id = module.recognize_face(image)
+                recognize_timings.append(time.perf_counter() - started)
+                recognized += user_id == name
+
+        result = {
+            'gallery_size': len(module.gallery),
+            'index': args.index,
+            'search': dict(summarize(search_timings), recall_at_1=round(found / len(queries), 4)),
+        }
+        if recognize_timings:
+            result['recognize_face'] = dict(summarize(recognize_timings),
+                                            accuracy=round(recognized / len(recognize_timings), 4))
+        results.append(result)
+        print(f"recognize: gallery {size}: search p50 {result['search']['p50_ms']} ms", file=sys.stderr)
+    return results
+
+
+def bench_enrol(args, images, workdir):
+    """add_faces throughput from the bundled images, and the bare store append + index sync"""
+    results = {}
+    if images:
+        module = create_module(os.path.join(workdir, 'enrol_images'), args.index)
+        timings = []
+        started = time.perf_counter()
+        for i in range(args.enrolments):
+            image = images[i % len(images)][2]
+            add_started = time.perf_counter()
+            with contextlib.suppress(ValueError):
+                module.add_faces(f'user-{i}', [image])
+            timings.append(time.perf_counter() - add_started)
+        save_started = time.perf_counter()
+        module.save_encodings()
+        save_s = time.perf_counter() - save_started
+        elapsed = time.perf_counter() - started
+        results['add_faces'] = dict(
+            summarize(timings),
+            per_second=round(args.enrolments / elapsed, 2),
+            save_encodings_ms=round(save_s * 1000.0, 3),
+        )
+
+    module = create_module(os.path.join(workdir, 'enrol_synthetic'), args.index)
+    encodings = make_identities(args.enrolments, seed=2)
+    timings = []
+    started = time.perf_counter()
+    for i, encoding in enumerate(encodings):
+        add_started = time.perf_counter()
+        module.gallery.add(f'user-{i}', encoding)
+        module.sync()
+        timings.append(time.perf_counter() - add_started)
+    module.save_encodings()
+    elapsed = time.perf_counter() - started
+    results['store_append'] = dict(summarize(timings), per_second=round(len(encodings) / elapsed, 2))
+    print(f"enrol: {results['store_append']['per_second']} appends/s", file=sys.stderr)
+    return results
+
+
+def bench_http(args, images, workdir, client):
+    """Request throughput of the Flask app through its test client"""
+    # app.py configures itself from the environment at import time
+    os.environ.setdefault('INFERENCE_WORKERS', '0')
+    os.environ.setdefault('GALLERY_RELOAD_INTERVAL', '0')
+    os.environ.setdefault('ENCODING_CACHE_SIZE', '0')
+    import settings
+    settings.DATABASE_OPTIONS = dict(settings.DATABASE_OPTIONS, client=client, db_name=DB_NAME, watch_changes=False)
+
+    cwd = os.getcwd()
+    os.chdir(os.path.join(workdir, 'http'))
+    try:
+        import app as server
+        test_client = server.app.test_client()
+
+        results = {}
+        timings = []
+        for i, (_, data, _) in enumerate(images):
+            started = time.perf_counter()
+            response = test_client.post('/api/register', data={
+                'name': f'Student {i}', 'email': f'student{i}@example.edu', 'department': f'Dept {i % 3}',
+                'image': (io.BytesIO(data), 'face.jpg')
+            }, content_type='multipart/form-data')
+            timings.append(time.perf_counter() - started)
+            if response.status_code != 201:
+                print(f"http: register returned {response.status_code}: {response.get_json()}", file=sys.stderr)
+        if timings:
+            results['POST /api/register'] = summarize(timings)
+
+        month = datetime.now().strftime('%Y-%m')
+        requests = {
+            'GET /api/departments': lambda: test_client.get('/api/departments'),
+            'GET /api/users?limit=100': lambda: test_client.get('/api/users?limit=100'),
+            'GET /api/attendance/monthly': lambda: test_client.get(f'/api/attendance/monthly?month={month}'),
+        }
+        if images:
+            body = images[0][1]
+            requests['POST /api/recognize'] = lambda: test_client.post(
+                '/api/recognize?period=1&subject=Maths', data=body, content_type='image/jpeg')
+
+        for name, send in requests.items():
+            timings = []
+            statuses = {}
+            started = time.perf_counter()
+            for _ in range(args.requests):
+                request_started = time.perf_counter()
+                status = send().status_code
+                timings.append(time.perf_counter() - request_started)
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+            elapsed = time.perf_counter() - started
+            results[name] = dict(summarize(timings), per_second=round(args.requests / elapsed, 2), statuses=statuses)
+            print(f"http: {name}: {results[name]['per_second']} req/s", file=sys.stderr)
+        return results
+    finally:
+        os.chdir(cwd)
+
+
+def bench_monthly(args, client):
+    """get_monthly_attendance over users with a month of attendance rollups"""
+    from database import Database
+    results = []
+    month = '2025-03'
+    for users_count in args.users:
+        client.drop_database(DB_NAME)
+        db = Database(db_name=DB_NAME, client=client, watch_changes=False)
+        users = [
+            {'user_id': str(uuid.uuid4()), 'name': f"Student {i}", 'email': f"student{i}@example.edu",
+             'department': f"Dept {i % 20}"}
+            for i in range(users_count)
+        ]
+        db.users_collection.insert_many(users)
+        rng = np.random.default_rng(users_count)
+        db.monthly_collection.insert_many([
+            {'month': month, 'user_id': user['user_id'], 'classes_attended': int(attended)}
+            for user, attended in zip(users, rng.integers(0, 105, users_count))
+        ])
+
+        result = {'users': users_count}
+        for name, department in (('all', 'all'), ('one_department', 'Dept 0')):
+            timings = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                report = db.get_monthly_attendance(month, department)
+                timings.append(time.perf_counter() - started)
+            result[name] = dict(summarize(timings), rows=len(report))
+        results.append(result)
+        print(f"monthly: {users_count} users: p50 {result['all']['p50_ms']} ms", file=sys.stderr)
+    client.drop_database(DB_NAME)
+    return results
+
+
+def environment(args):
+    def git(*command):
+        try:
+            return subprocess.run(['git', *command], cwd=BACKEND_DIR, capture_output=True,
+                                  text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    status = git('status', '--porcelain')
+    return {
+        'commit': git('rev-parse', 'HEAD'),
+        'dirty': bool(status) if status is not None else None,
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'mongo': 'mongomock' if args.uri is None else 'mongod',
+        'parameters': {name: value for name, value in vars(args).items() if name not in ('output', 'compare', 'uri')},
+    }
+
+
+def flatten(results, prefix=''):
+    """Numeric leaves of a results document as {'suite.path.metric': value}"""
+    flat = {}
+    if isinstance(results, dict):
+        for key, value in results.items():
+            flat.update(flatten(value, f"{prefix}{key}."))
+    elif isinstance(results, list):
+        for i, value in enumerate(results):
+            # Lists are runs over a size parameter; label them by it
+            label = next((str(value[key]) for key in ('gallery_size', 'users') if isinstance(value, dict) and key in value), str(i))
+            flat.update(flatten(value, f"{prefix}{label}."))
+    elif isinstance(results, (int, float)) and not isinstance(results, bool):
+        flat[prefix.rstrip('.')] = results
+    return flat
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print(f"before: {before['environment']['commit']}  after: {after['environment']['commit']}\n")
+    old = flatten(before['results'])
+    new = flatten(after['results'])
+    width = max((len(key) for key in old.keys() | new.keys()), default=10)
+    print(f"{'metric':<{width}} {'before':>12} {'after':>12} {'change':>8}")
+    for key in sorted(old.keys() | new.keys()):
+        a, b = old.get(key), new.get(key)
+        change = f"{(b - a) / a * 100:+.1f}%" if a and b is not None else ''
+        print(f"{key:<{width}} {'' if a is None else a:>12} {'' if b is None else b:>12} {change:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--suites', nargs='+', choices=SUITES, default=list(SUITES))
+    parser.add_argument('--output', help="write the JSON here instead of stdout")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help="compare two result files and exit")
+    parser.add_argument('--uri', help="local mongod to use instead of mongomock")
+    parser.add_argument('--images', default=os.path.join(BACKEND_DIR, 'known_faces', '*.jpg'))
+    parser.add_argument('--index', choices=('brute', 'ivf', 'fp16', 'int8', 'pq'), default='brute')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help="gallery sizes")
+    parser.add_argument('--queries', type=int, default=1000, help="synthetic searches per gallery size")
+    parser.add_argument('--repeat', type=int, default=5, help="passes over the images / monthly reports")
+    parser.add_argument('--enrolments', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=200, help="requests per HTTP endpoint")
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000], help="users in the monthly report")
+    parser.add_argument('--quick', action='store_true', help="small sizes, for a smoke run")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    if args.quick:
+        args.sizes, args.queries, args.repeat = [1000], 100, 1
+        args.enrolments, args.requests, args.users = 20, 20, [1000]
+
+    if args.uri:
+        from pymongo import MongoClient
+        client = MongoClient(args.uri)
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("mongomock is not installed: pip install mongomock, or pass --uri for a local mongod")
+        client = mongomock.MongoClient()
+
+    document = {'environment': environment(args), 'results': {}}
+    images = load_images(args.images) if {'recognize', 'enrol', 'http'} & set(args.suites) else []
+    workdir = tempfile.mkdtemp(prefix='face-benchmark-')
+    os.makedirs(os.path.join(workdir, 'http'))
+    cwd = os.getcwd()
+    try:
+        # The modules print while loading galleries; keep stdout for the JSON
+        with contextlib.redirect_stdout(sys.stderr):
+            os.chdir(workdir)
+            for suite in args.suites:
+                started = time.perf_counter()
+                if suite == 'recognize':
+                    document['results'][suite] = bench_recognize(args, images, workdir)
+                elif suite == 'enrol':
+                    document['results'][suite] = bench_enrol(args, images, workdir)
+                elif suite == 'http':
+                    document['results'][suite] = bench_http(args, images, workdir, client)
+                elif suite == 'monthly':
+                    document['results'][suite] = bench_monthly(args, client)
+                print(f"{suite}: done in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+        if args.uri:
+            client.drop_database(DB_NAME)
+
+    output = json.dumps(document, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
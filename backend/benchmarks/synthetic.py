@@ -0,0 +1,36 @@
+"""Synthetic face-encoding generator shared by the benchmarks.
+
+Encodings mimic dlib's 128-d face descriptors: different people sit roughly
+0.9-1.0 apart and two photos of the same person roughly 0.3-0.4 apart.
+"""
+import os
+import sys
+
+import numpy as np
+
+# Benchmarks import the backend modules directly
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+DIM = 128
+IDENTITY_SCALE = 0.06
+SAMPLE_NOISE = 0.022
+
+
+def make_identities(n, seed=0):
+    """One reference encoding per synthetic person"""
+    rng = np.random.default_rng(seed)
+    return rng.normal(0.0, IDENTITY_SCALE, (n, DIM)).astype(np.float32)
+
+
+def make_samples(identities, n, seed=1):
+    """New photos of randomly chosen enrolled people; returns (encodings, identity index)"""
+    rng = np.random.default_rng(seed)
+    who = rng.integers(0, len(identities), n)
+    noise = rng.normal(0.0, SAMPLE_NOISE, (n, DIM)).astype(np.float32)
+    return identities[who] + noise, who
+
+
+def percentile_ms(samples, q):
+    return float(np.percentile(np.asarray(samples) * 1000.0, q))
@@ -0,0 +1,307 @@
+"""Offline bulk enrolment of a new intake.
+
+Students come from a CSV with name, email, department and image columns
+(one row per image; rows sharing an email are one student, image paths are
+relative to the CSV), or from a directory laid out as
+
+    <root>/<department>/<name> <email>.jpg        one image
+    <root>/<department>/<name> <email>/*.jpg      several images
+
+Instead of one /api/register call per student (duplicate check, detection
+and a store append each), the importer
+  1. encodes every image in a pool of worker processes, appending each
+     result to a progress file, so an interrupted run picks up where it left off
+  2. drops emails already registered or repeated in the batch, then checks
+     the new faces against the gallery and against each other in one
+     chunked distance pass
+  3. inserts the users with a single insert_many and appends all their
+     encodings to the gallery in one commit, which running servers pick up
+     on their next reload
+"""
+import csv
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+
+from embedding_store import MappedFaceGallery, exemplars_path
+from face_gallery import FaceGallery
+from face_recognition_module import detect_and_encode
+from image_ingest import decode_image
+from templates import compact_templates
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+CSV_FIELDS = ('name', 'email', 'department', 'image')
+
+
+class ManifestError(ValueError):
+    """The CSV or directory does not describe the students to import"""
+
+
+def _split_name_email(stem):
+    name, _, email = stem.strip().rpartition(' ')
+    if '@' not in email or not name.strip():
+        raise ManifestError(f"Expected '<name> <email>', got {stem!r}")
+    return name.replace('_', ' ').strip(), email
+
+
+def _is_image(path):
+    return os.path.isfile(path) and path.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def read_csv(path):
+    students = {}
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, newline='') as f:
+        reader = csv.DictReader(f)
+        missing = set(CSV_FIELDS) - set(reader.fieldnames or [])
+        if missing:
+            raise ManifestError(f"{path} is missing the columns: {', '.join(sorted(missing))}")
+        for row in reader:
+            email = row['email'].strip()
+            student = students.setdefault(email, {
+                'name': row['name'].strip(), 'email': email, 'department': row['department'].strip(), 'images': []
+            })
+            student['images'].append(os.path.join(base, row['image'].strip()))
+    return list(students.values())
+
+
+def read_directory(root):
+    students = []
+    for department in sorted(os.listdir(root)):
+        department_dir = os.path.join(root, department)
+        if not os.path.isdir(department_dir):
+            continue
+        for entry in sorted(os.listdir(department_dir)):
+            path = os.path.join(department_dir, entry)
+            if os.path.isdir(path):
+                images = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+                images = [image for image in images if _is_image(image)]
+                stem = entry
+            elif _is_image(path):
+                images = [path]
+                stem = os.path.splitext(entry)[0]
+            else:
+                continue
+            name, email = _split_name_email(stem)
+            students.append({'name': name, 'email': email, 'department': department,
+                             'images': [os.path.abspath(image) for image in images]})
+    return students
+
+
+def read_students(source):
+    """Students to import as dicts of name, email, department and image paths"""
+    students = read_directory(source) if os.path.isdir(source) else read_csv(source)
+    for student in students:
+        if not all([student['name'], student['email'], student['department'], student['images']]):
+            raise ManifestError(f"Incomplete entry for {student['email'] or student['name']!r}")
+    return students
+
+
+def encode_file(path, detection):
+    """(path, first face encoding or None, error or None) of an image file; runs in a worker process"""
+    try:
+        with open(path, 'rb') as f:
+            image = decode_image(f.read())
+        _, encodings = detect_and_encode(image, first_only=True, config=detection)
+    except Exception as e:
+        # dlib and OpenCV raise their own errors on some files; one bad image must not abort the import
+        return path, None, str(e) or type(e).__name__
+    if not encodings:
+        return path, None, "No face detected"
+    return path, [float(x) for x in encodings[0]], None
+
+
+class Progress:
+    """Append-only JSON lines log of encoded images and committed users, replayed on restart"""
+
+    def __init__(self, path, detection):
+        self.path = path
+        self.detection = detection
+        self.encoded = {}
+        self.committed = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line of an interrupted run may be cut short
+                        continue
+                    if 'image' in entry and entry.get('detection') == detection:
+                        self.encoded[entry['image']] = (entry['encoding'], entry['error'])
+                    elif 'user_id' in entry:
+                        self.committed[entry['email']] = entry['user_id']
+        self._file = open(path, 'a')
+
+    def _write(self, entries):
+        for entry in entries:
+            self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def record_encoding(self, path, encoding, error):
+        self.encoded[path] = (encoding, error)
+        self._write([{'image': path, 'detection': self.detection, 'encoding': encoding, 'error': error}])
+
+    def record_users(self, users):
+        """Remember the user_ids given out before they are inserted, so a rerun can finish the commit"""
+        for user in users:
+            self.committed[user['email']] = user['user_id']
+        self._write([{'email': user['email'], 'user_id': user['user_id']} for user in users])
+
+    def close(self):
+        self._file.close()
+
+
+def encode_images(paths, progress, workers, detection, report_every=100):
+    """Encode the images not in the progress log yet, in parallel"""
+    pending = [path for path in dict.fromkeys(paths) if path not in progress.encoded]
+    if not pending:
+        return
+    print(f"Encoding {len(pending)} images with {workers} workers "
+          f"({len(progress.encoded)} already encoded)")
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Workers read the files themselves, so only paths and encodings cross the process boundary
+        results = executor.map(encode_file, pending, repeat(detection), chunksize=max(1, min(16, len(pending) // (workers * 4))))
+        for done, (path, encoding, error) in enumerate(results, 1):
+            progress.record_encoding(path, encoding, error)
+            if done % report_every == 0 or done == len(pending):
+                rate = done / (time.perf_counter() - started)
+                print(f"  {done}/{len(pending)} images, {rate:.1f}/s")
+
+
+def nearest_distances(store, queries, chunk=256, block=16384):
+    """Distance from every query to its nearest live row of a store (inf when it is empty)"""
+    nearest = np.full(len(queries), np.inf, dtype=np.float32)
+    size = len(store)
+    for start in range(0, len(queries), chunk):
+        # A running minimum over blocks of the store, so no more than chunk x block distances
+        # are held at once however large the gallery grows
+        for row in range(0, size, block):
+            # Tombstoned rows have an infinite norm, so they never come out nearest
+            distances = store.distances(queries[start:start + chunk], slice(row, min(row + block, size)))
+            np.minimum(nearest[start:start + chunk], distances.min(axis=1), out=nearest[start:start + chunk])
+    return nearest
+
+
+def earlier_duplicates(centroids, tolerance, chunk=256):
+    """Index of the first earlier centroid within tolerance of each one, or -1"""
+    batch = FaceGallery(capacity=max(1, len(centroids)))
+    batch.extend(list(range(len(centroids))), centroids)
+    duplicates = np.full(len(centroids), -1, dtype=np.int64)
+    for start in range(0, len(centroids), chunk):
+        distances = batch.distances(centroids[start:start + chunk])
+        # Only compare with the centroids before each one, so the first of a pair is kept
+        close = distances <= tolerance
+        close &= np.arange(len(centroids))[None, :] < np.arange(start, start + len(distances))[:, None]
+        found = close.any(axis=1)
+        duplicates[start:start + len(distances)][found] = close.argmax(axis=1)[found]
+    return duplicates
+
+
+def run_import(db, source, gallery_path='face_gallery', progress_path=None, workers=None,
+               detection='balanced', tolerance=0.4, max_exemplars=4, dry_run=False):
+    """Import the students of a CSV or directory; returns a summary of what was imported and skipped"""
+    students = read_students(source)
+    progress = Progress(progress_path or source.rstrip(os.sep) + '.progress.jsonl', detection)
+    skipped = []
+    try:
+        encode_images([image for student in students for image in student['images']], progress,
+                      workers or os.cpu_count() or 1, detection)
+
+        # Emails: repeated within the batch, or already registered (unless this import registered them)
+        registered = db.get_user_ids_by_email(student['email'] for student in students)
+        gallery = MappedFaceGallery(gallery_path, readonly=dry_run)
+        exemplars = MappedFaceGallery(exemplars_path(gallery_path), readonly=dry_run)
+        enrolled = gallery.live_ids()
+
+        candidates, resumed = [], []
+        already = 0
+        seen = set()
+        for student in students:
+            email = student['email']
+            if email in seen:
+                skipped.append((student, "email repeated in the import"))
+                continue
+            seen.add(email)
+            if email in registered:
+                user_id = registered[email]
+                if progress.committed.get(email) == user_id and user_id not in enrolled:
+                    # Inserted by an interrupted run that never reached the gallery commit
+                    student['user_id'] = user_id
+                    resumed.append(student)
+                elif progress.committed.get(email) == user_id:
+                    already += 1
+                else:
+                    skipped.append((student, "email already registered"))
+                continue
+            candidates.append(student)
+
+        # One centroid (plus exemplars) per student from the faces found in their images
+        for student in candidates + resumed:
+            samples = [progress.encoded[image][0] for image in student['images'] if progress.encoded[image][0]]
+            errors = {progress.encoded[image][1] for image in student['images'] if progress.encoded[image][1]}
+            student['templates'] = compact_templates(samples, max_exemplars) if samples else None
+            if not samples:
+                skipped.append((student, '; '.join(sorted(errors))))
+        candidates = [student for student in candidates if student['templates'] is not None]
+        resumed = [student for student in resumed if student['templates'] is not None]
+
+        # Faces already enrolled, or enrolled twice in this batch under different emails
+        new = []
+        if candidates:
+            centroids = np.stack([student['templates'][0] for student in candidates]).astype(np.float32)
+            known = np.minimum(nearest_distances(gallery, centroids), nearest_distances(exemplars, centroids))
+            duplicates = earlier_duplicates(centroids, tolerance)
+            for i, student in enumerate(candidates):
+                if known[i] <= tolerance:
+                    skipped.append((student, f"face already registered (distance {known[i]:.3f})"))
+                elif duplicates[i] >= 0:
+                    skipped.append((student, f"same face as {candidates[duplicates[i]]['email']}"))
+                else:
+                    new.append(student)
+
+        summary = {'students': len(students), 'imported': 0, 'resumed': len(resumed), 'already_imported': already,
+                   'skipped': skipped}
+        if dry_run:
+            summary['imported'] = len(new)
+            return summary
+
+        for student in new:
+            student['user_id'] = str(uuid.uuid4())
+        users = [{key: student[key] for key in ('user_id', 'name', 'email', 'department')} for student in new]
+        progress.record_users(users)
+        inserted = set(db.add_users(users))
+        for student in new:
+            if student['user_id'] not in inserted:
+                skipped.append((student, "email registered during the import"))
+        enrol = [student for student in new if student['user_id'] in inserted] + resumed
+
+        # A single append to each store, exemplars first so no centroid is searchable without them.
+        # An interrupted run may have appended the exemplars of the resumed students already
+        has_exemplars = exemplars.live_ids() if resumed else set()
+        exemplar_ids, exemplar_rows = [], []
+        for student in enrol:
+            if student['user_id'] in has_exemplars:
+                continue
+            _, student_exemplars = student['templates']
+            exemplar_ids.extend([student['user_id']] * len(student_exemplars))
+            exemplar_rows.extend(student_exemplars)
+        if exemplar_rows:
+            exemplars.extend(exemplar_ids, exemplar_rows)
+        if enrol:
+            gallery.extend([student['user_id'] for student in enrol],
+                           [student['templates'][0] for student in enrol])
+        gallery.checkpoint()
+        exemplars.checkpoint()
+
+        summary['imported'] = len(enrol) - len(resumed)
+        return summary
+    finally:
+        progress.close()
@@ -112,24 +112,211 @@
 
 
 
-from pymongo import MongoClient
+from pymongo import DeleteOne, MongoClient, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
 from datetime import datetime
 import os
+import threading
 from dotenv import load_dotenv
 import uuid
 import calendar
+from caching import TTLCache
+from shards import parse_scope
+import metrics
 
 load_dotenv()
 
+DUPLICATE_KEY = 11000
+
+# Indexes every collection needs, as (keys, options) pairs.
+# attendance (user_id, date, period) is unique and also serves (user_id, date) lookups by prefix.
+INDEXES = {
+    'users': [
+        ([('user_id', 1)], {'name': 'user_id_unique', 'unique': True}),
+        ([('email', 1)], {'name': 'email_unique', 'unique': True}),
+        ([('department', 1)], {'name': 'department'}),
+    ],
+    'attendance': [
+        ([('user_id', 1), ('date', 1), ('period', 1)], {'name': 'user_date_period_unique', 'unique': True}),
+        ([('date', 1), ('period', 1)], {'name': 'date_period'}),
+    ],
+    'departments': [
+        ([('name', 1)], {'name': 'name_unique', 'unique': True}),
+    ],
+    'attendance_monthly': [
+        ([('month', 1), ('user_id', 1)], {'name': 'month_user_unique', 'unique': True}),
+    ],
+    'rosters': [
+        ([('roster_id', 1)], {'name': 'roster_id_unique', 'unique': True}),
+    ],
+}
+
+def attendance_upsert(user_id, period, subject, now, attendance_id):
+    """Filter and update that mark one period's attendance, creating the record on first marking"""
+    return (
+        {'user_id': user_id, 'date': now.strftime('%Y-%m-%d'), 'period': period},
+        {
+            '$set': {'time': now.strftime('%H:%M:%S'), 'subject': subject},
+            '$setOnInsert': {'attendance_id': attendance_id, 'created_at': now}
+        }
+    )
+
+def bulk_upsert_outcome(error):
+    """Indexes that were still upserted by a failed unordered bulk write, and its errors other than duplicate keys.
+    
+    Two requests upserting the same (user_id, date, period) race on the unique
+    index and the loser gets E11000, but the record exists all the same.
+    """
+    upserted = [operation['index'] for operation in error.details.get('upserted', [])]
+    errors = [e for e in error.details.get('writeErrors', []) if e.get('code') != DUPLICATE_KEY]
+    return upserted, errors
+
+def monthly_increments(user_ids, date):
+    """Rollup updates counting newly marked periods"""
+    month = date[:7]
+    return [
+        UpdateOne({'month': month, 'user_id': user_id}, {'$inc': {'classes_attended': 1}}, upsert=True)
+        for user_id in user_ids
+    ]
+
+def attendance_pipeline(date, period=None, after=None, limit=None):
+    """Aggregation over a date's attendance ordered by attendance_id, starting after the given attendance_id"""
+    match_query = {'date': date}
+    if period:
+        match_query['period'] = int(period)
+    if after:
+        match_query['attendance_id'] = {'$gt': after}
+    
+    # Page before the $lookup so only the returned records are joined
+    pipeline = [{'$match': match_query}, {'$sort': {'attendance_id': 1}}]
+    if limit:
+        pipeline.append({'$limit': limit})
+    pipeline += [
+        {'$lookup': {
+            'from': 'users',
+            'localField': 'user_id',
+            'foreignField': 'user_id',
+            'as': 'user'
+        }},
+        # Records of deleted students are kept with null user fields, so every page stays full
+        {'$unwind': {'path': '$user', 'preserveNullAndEmptyArrays': True}},
+        {'$project': {
+            '_id': 0,
+            'attendance_id': 1,
+            'date': 1,
+            'period': 1,
+            'subject': 1,
+            'time': 1,
+            'user_id': 1,
+            'user_name': {'$ifNull': ['$user.name', None]},
+            'user_email': {'$ifNull': ['$user.email', None]},
+            'department': {'$ifNull': ['$user.department', None]}
+        }}
+    ]
+    return pipeline
+
+def monthly_queries(month, department=None):
+    """Users query and rollup query of a monthly report"""
+    year, month = map(int, month.split('-'))
+    user_match = {}
+    if department and department != "all":
+        user_match = {'department': department}
+    return user_match, {'month': f"{year}-{month:02d}"}
+
+def monthly_report(month, users, attendance_counts):
+    """Attendance percentage of each user, from the attended-class counters of the month"""
+    year, month = map(int, month.split('-'))
+    
+    # Get the number of days in the month
+    _, last_day = calendar.monthrange(year, month)
+    
+    # Total number of school days in the month (excluding weekends)
+    total_school_days = sum(1 for day in range(1, last_day + 1) 
+                           if calendar.weekday(year, month, day) < 5)  # 0-4 are weekdays
+    
+    # Total possible classes per student (5 periods per day)
+    total_possible_classes = total_school_days * 5
+    
+    # Prepare the report
+    report = []
+    for user in users:
+        user_id = user['user_id']
+        classes_attended = attendance_counts.get(user_id, 0)
+        attendance_percentage = round((classes_attended / total_possible_classes) * 100, 2) if total_possible_classes > 0 else 0
+        
+        report.append({
+            'user_id': user_id,
+            'user_name': user['name'],
+            'department': user['department'],
+            'total_classes': total_possible_classes,
+            'classes_attended': classes_attended,
+            'attendance_percentage': attendance_percentage
+        })
+    
+    return report
+
 class Database:
-    def __init__(self):
+    def __init__(self, mongo_uri=None, db_name='student_attendance_system', client=None,
+                 cache_size=10000, cache_ttl=60.0, watch_changes=True):
         # Get MongoDB connection string from environment variable or use default
-        mongo_uri = os.getenv('MONGO_URI')
-        self.client = MongoClient(mongo_uri)
-        self.db = self.client['student_attendance_system']
+        mongo_uri = mongo_uri or os.getenv('MONGO_URI')
+        self.client = client or MongoClient(mongo_uri)
+        self.db = self.client[db_name]
         self.users_collection = self.db['users']
         self.attendance_collection = self.db['attendance']
         self.departments_collection = self.db['departments']
+        # Per-(user, month) attended-class counters kept in step with attendance
+        self.monthly_collection = self.db['attendance_monthly']
+        # Named groups of students (a class or section) that recognition can be scoped to
+        self.rosters_collection = self.db['rosters']
+        
+        # Create any missing indexes and report the ones that could not be built
+        self.ensure_indexes()
+        missing = self.verify_indexes()
+        if missing:
+            print(f"Missing database indexes: {', '.join(missing)}")
+        
+        # Read-through caches of user documents by user_id and of the department list.
+        # Writes through this object invalidate them; changes made elsewhere arrive through
+        # a change stream, or after cache_ttl seconds when the server has none (standalone mongod)
+        self.user_cache = TTLCache(cache_size, cache_ttl)
+        self.departments_cache = TTLCache(1, cache_ttl)
+        if watch_changes and cache_size > 0:
+            threading.Thread(target=self._watch_changes, daemon=True).start()
+    
+    def _watch_changes(self):
+        pipeline = [{'$match': {'ns.coll': {'$in': ['users', 'departments']}}}]
+        try:
+            with self.db.watch(pipeline) as stream:
+                for change in stream:
+                    if change['ns']['coll'] == 'departments':
+                        self.departments_cache.clear()
+                    elif change['operationType'] != 'insert':
+                        # Deletes only carry the _id, so drop every cached user
+                        self.user_cache.clear()
+        except Exception as e:
+            print(f"No change stream ({e}); cached users and departments expire after {self.user_cache.ttl}s")
+    
+    def ensure_indexes(self):
+        """Create the declared indexes; existing ones are left untouched"""
+        for collection, indexes in INDEXES.items():
+            for keys, options in indexes:
+                try:
+                    self.db[collection].create_index(keys, **options)
+                except OperationFailure as e:
+                    # e.g. duplicate emails in existing data block a unique index
+                    print(f"Could not create index {collection}.{options['name']}: {e}")
+    
+    def verify_indexes(self):
+        """Return the declared indexes that do not exist, as collection.name"""
+        missing = []
+        for collection, indexes in INDEXES.items():
+            existing = self.db[collection].index_information()
+            for keys, options in indexes:
+                key = [(field, int(direction)) for field, direction in existing.get(options['name'], {}).get('key', [])]
+                if key != keys:
+                    missing.append(f"{collection}.{options['name']}")
+        return missing
     
     def add_user(self, name, email, department):
         """Add a new student to the database"""
@@ -149,151 +336,287 @@ class Database:
             {'$set': {'name': department}},
             upsert=True
         )
+        self.departments_cache.clear()
         
         return user_id
     
+    def add_users(self, users):
+        """Insert many students in one round trip (bulk enrolment); each dict has user_id, name, email and department.
+        
+        Returns the user_ids inserted: a student whose email was registered in
+        the meantime is rejected by the unique index without stopping the rest.
+        """
+        now = datetime.now()
+        documents = [dict(user, created_at=now) for user in users]
+        if not documents:
+            return []
+        try:
+            self.users_collection.insert_many(documents, ordered=False)
+            failed = set()
+        except BulkWriteError as e:
+            failed = {error['index'] for error in e.details.get('writeErrors', [])}
+        inserted = [user for i, user in enumerate(documents) if i not in failed]
+        
+        departments = sorted({user['department'] for user in inserted})
+        if departments:
+            self.departments_collection.bulk_write(
+                [UpdateOne({'name': department}, {'$set': {'name': department}}, upsert=True) for department in departments],
+                ordered=False
+            )
+        self.departments_cache.clear()
+        return [user['user_id'] for user in inserted]
+    
+    @metrics.timed('get_user')
     def get_user(self, user_id):
         """Get user by ID"""
-        user = self.users_collection.find_one({'user_id': user_id}, {'_id': 0})
+        user = self.user_cache.get(user_id)
+        if user is None:
+            user = self.users_collection.find_one({'user_id': user_id}, {'_id': 0})
+            # Unknown ids are not cached, so a user added by another process shows up at once
+            if user is not None:
+                self.user_cache.set(user_id, user)
         return user
     
+    @metrics.timed('get_users')
+    def get_users(self, user_ids):
+        """Get several users by ID in one query, keyed by user_id"""
+        found = {}
+        missing = []
+        for user_id in user_ids:
+            user = self.user_cache.get(user_id)
+            if user is None:
+                missing.append(user_id)
+            else:
+                found[user_id] = user
+        if missing:
+            for user in self.users_collection.find({'user_id': {'$in': missing}}, {'_id': 0}):
+                self.user_cache.set(user['user_id'], user)
+                found[user['user_id']] = user
+        return found
+    
     def get_user_by_email(self, email):
         user = self.users_collection.find_one({"email": email})
         return user
     
-    def get_all_users(self):
-        """Get all users"""
-        users = list(self.users_collection.find({}, {'_id': 0}))
+    def get_user_ids_by_email(self, emails):
+        """Map of email -> user_id for the given emails that are already registered"""
+        cursor = self.users_collection.find({'email': {'$in': list(emails)}}, {'_id': 0, 'email': 1, 'user_id': 1})
+        return {user['email']: user['user_id'] for user in cursor}
+    
+    def get_user_ids(self, batch_size=10000):
+        """Every user_id, in one query"""
+        cursor = self.users_collection.find({}, {'_id': 0, 'user_id': 1}).batch_size(batch_size)
+        return {user['user_id'] for user in cursor}
+    
+    def delete_user(self, user_id):
+        """Remove a student; their attendance history is kept"""
+        result = self.users_collection.delete_one({'user_id': user_id})
+        self.rosters_collection.update_many({'user_ids': user_id}, {'$pull': {'user_ids': user_id}})
+        self.user_cache.pop(user_id)
+        return result.deleted_count > 0
+    
+    def set_roster(self, roster_id, user_ids, name=None):
+        """Create or replace a roster of students"""
+        self.rosters_collection.update_one(
+            {'roster_id': roster_id},
+            {'$set': {'user_ids': list(dict.fromkeys(user_ids)), 'name': name or roster_id, 'updated_at': datetime.now()}},
+            upsert=True
+        )
+    
+    def get_roster(self, roster_id):
+        return self.rosters_collection.find_one({'roster_id': roster_id}, {'_id': 0})
+    
+    def get_scope_members(self, scope, among=None):
+        """user_ids in a recognition scope: every student of a department, or the members of a roster
+        (only those of `among`, when given)"""
+        kind, name = parse_scope(scope)
+        if kind == 'department':
+            query = {'department': name}
+            if among is not None:
+                query['user_id'] = {'$in': list(among)}
+            return {user['user_id'] for user in self.users_collection.find(query, {'_id': 0, 'user_id': 1})}
+        roster = self.rosters_collection.find_one({'roster_id': name}, {'_id': 0, 'user_ids': 1})
+        members = set(roster['user_ids']) if roster else set()
+        return members if among is None else members & set(among)
+    
+    def get_scope_version(self, scope):
+        """When a roster was last changed (None for a department or a missing roster)"""
+        kind, name = parse_scope(scope)
+        if kind == 'department':
+            return None
+        roster = self.rosters_collection.find_one({'roster_id': name}, {'_id': 0, 'updated_at': 1})
+        return roster['updated_at'] if roster else None
+    
+    def iter_users(self, after=None, limit=None, batch_size=500):
+        """Cursor over users ordered by user_id, starting after the given user_id (keyset pagination)"""
+        query = {'user_id': {'$gt': after}} if after else {}
+        cursor = self.users_collection.find(query, {'_id': 0}).sort('user_id', 1).batch_size(batch_size)
+        if limit:
+            cursor = cursor.limit(limit)
+        return cursor
+    
+    def get_all_users(self, after=None, limit=None):
+        """Get all users, or one page of them"""
+        users = list(self.iter_users(after, limit))
         return users
     
     def get_departments(self):
         """Get all departments"""
-        departments = list(self.departments_collection.find({}, {'_id': 0}))
-        return [dept['name'] for dept in departments]
+        names = self.departments_cache.get('all')
+        if names is None:
+            departments = list(self.departments_collection.find({}, {'_id': 0}))
+            names = [dept['name'] for dept in departments]
+            self.departments_cache.set('all', names)
+        return names
     
+    @metrics.timed('mark_attendance')
     def mark_attendance(self, user_id, period, subject):
         """Mark attendance for a student for a specific period and subject"""
         now = datetime.now()
-        date = now.strftime('%Y-%m-%d')
-        time = now.strftime('%H:%M:%S')
         
-        # Check if attendance already marked for this period today
-        existing = self.attendance_collection.find_one({
-            'user_id': user_id,
-            'date': date,
-            'period': period
-        })
+        # Single idempotent round-trip: update the period's record or create it
+        attendance_id = str(uuid.uuid4())
+        query, update = attendance_upsert(user_id, period, subject, now, attendance_id)
+        record = self.attendance_collection.find_one_and_update(
+            query, update,
+            projection={'attendance_id': 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
         
-        if existing:
-            # Update existing record
-            self.attendance_collection.update_one(
-                {'_id': existing['_id']},
-                {'$set': {'time': time, 'subject': subject}}
-            )
-            return str(existing['_id'])
-        else:
-            # Create new attendance record
-            attendance_id = str(uuid.uuid4())
-            attendance = {
-                'attendance_id': attendance_id,
-                'user_id': user_id,
-                'date': date,
-                'period': period,
-                'subject': subject,
-                'time': time,
-                'created_at': now
-            }
-            self.attendance_collection.insert_one(attendance)
-            return attendance_id
-    
-    def get_attendance_by_date(self, date, period=None):
-        """Get attendance records for a specific date and optional period"""
-        match_query = {'date': date}
-        if period:
-            match_query['period'] = int(period)
-            
-        pipeline = [
-            {'$match': match_query},
-            {'$lookup': {
-                'from': 'users',
-                'localField': 'user_id',
-                'foreignField': 'user_id',
-                'as': 'user'
-            }},
-            {'$unwind': '$user'},
-            {'$project': {
-                '_id': 0,
-                'attendance_id': 1,
-                'date': 1,
-                'period': 1,
-                'subject': 1,
-                'time': 1,
-                'user_id': 1,
-                'user_name': '$user.name',
-                'user_email': '$user.email',
-                'department': '$user.department'
-            }}
-        ]
+        # Our id only survives if this call created the record: first marking for the period
+        if record.get('attendance_id') == attendance_id:
+            self._increment_monthly([user_id], query['date'])
         
-        attendance = list(self.attendance_collection.aggregate(pipeline))
-        return attendance
+        return record.get('attendance_id', str(record['_id']))
     
-    def get_monthly_attendance(self, month, department=None):
-        """Get monthly attendance report with percentage calculation"""
-        year, month = map(int, month.split('-'))
-        
-        # Get the number of days in the month
-        _, last_day = calendar.monthrange(year, month)
-        
-        # Format date strings for the month
-        start_date = f"{year}-{month:02d}-01"
-        end_date = f"{year}-{month:02d}-{last_day}"
-        
-        # Total number of school days in the month (excluding weekends)
-        total_school_days = sum(1 for day in range(1, last_day + 1) 
-                               if calendar.weekday(year, month, day) < 5)  # 0-4 are weekdays
+    @metrics.timed('mark_attendance_many')
+    def mark_attendance_many(self, user_ids, period, subject):
+        """Mark attendance for several students at once; returns {user_id: attendance_id}"""
+        now = datetime.now()
+        date = now.strftime('%Y-%m-%d')
+        user_ids = list(dict.fromkeys(user_ids))
+        if not user_ids:
+            return {}
         
-        # Total possible classes per student (5 periods per day)
-        total_possible_classes = total_school_days * 5
+        new_ids = {user_id: str(uuid.uuid4()) for user_id in user_ids}
+        operations = [
+            UpdateOne(*attendance_upsert(user_id, period, subject, now, new_ids[user_id]), upsert=True)
+            for user_id in user_ids
+        ]
+        # Unordered so one failing upsert does not hold back the rest of the batch
+        try:
+            upserted = list(self.attendance_collection.bulk_write(operations, ordered=False).upserted_ids)
+            failure = None
+        except BulkWriteError as e:
+            upserted, errors = bulk_upsert_outcome(e)
+            failure = e if errors else None
         
-        # Query to match users from specific department if provided
-        user_match = {}
-        if department and department != "all":
-            user_match = {'department': department}
+        attendance_ids = {user_ids[index]: new_ids[user_ids[index]] for index in upserted}
+        self._increment_monthly(list(attendance_ids), date)
+        if failure is not None:
+            raise failure
         
-        # Get all users
-        users = list(self.users_collection.find(user_match, {'_id': 0}))
+        # Students already marked for this period keep their original attendance_id
+        existing = [user_id for user_id in user_ids if user_id not in attendance_ids]
+        if existing:
+            for record in self.attendance_collection.find(
+                {'user_id': {'$in': existing}, 'date': date, 'period': period},
+                {'user_id': 1, 'attendance_id': 1}
+            ):
+                attendance_ids[record['user_id']] = record.get('attendance_id', str(record['_id']))
         
-        # Get attendance for the month
+        return attendance_ids
+    
+    def _increment_monthly(self, user_ids, date):
+        """Count newly marked periods in the monthly rollup"""
+        operations = monthly_increments(user_ids, date)
+        if operations:
+            self.monthly_collection.bulk_write(operations, ordered=False)
+    
+    def _count_monthly(self, month=None):
+        """Recount attended classes per (month, user_id) from the raw attendance records"""
+        match = {'date': {'$gte': f"{month}-01", '$lte': f"{month}-31"}} if month else {}
         pipeline = [
-            {'$match': {
-                'date': {'$gte': start_date, '$lte': end_date}
-            }},
+            {'$match': match},
             {'$group': {
-                '_id': '$user_id',
+                '_id': {'month': {'$substr': ['$date', 0, 7]}, 'user_id': '$user_id'},
                 'classes_attended': {'$sum': 1}
             }}
         ]
+        return {
+            (record['_id']['month'], record['_id']['user_id']): record['classes_attended']
+            for record in self.attendance_collection.aggregate(pipeline, allowDiskUse=True)
+        }
+    
+    def _write_monthly(self, counts, keys):
+        """Set the rollups of the given (month, user_id) keys to their counts, deleting those counted zero"""
+        operations = [
+            ReplaceOne({'month': month, 'user_id': user_id},
+                       {'month': month, 'user_id': user_id, 'classes_attended': counts[(month, user_id)]}, upsert=True)
+            if counts.get((month, user_id)) else DeleteOne({'month': month, 'user_id': user_id})
+            for month, user_id in keys
+        ]
+        for start in range(0, len(operations), 10000):
+            self.monthly_collection.bulk_write(operations[start:start + 10000], ordered=False)
+    
+    def rebuild_monthly_rollups(self, month=None, passes=3):
+        """Backfill or rebuild the monthly rollups from the attendance collection.
         
-        attendance_counts = {
-            record['_id']: record['classes_attended'] 
-            for record in self.attendance_collection.aggregate(pipeline)
+        Runs against a live deployment: each rollup is replaced in place, so reports never see it
+        missing. A class marked between the recount and the write can be overwritten, so the rollups
+        are checked again and the ones that moved are rewritten, up to `passes` times; with
+        attendance still being marked, check-rollups afterwards confirms the result.
+        """
+        counts = self._count_monthly(month)
+        existing = self.monthly_collection.find({'month': month} if month else {}, {'_id': 0, 'month': 1, 'user_id': 1})
+        keys = set(counts) | {(record['month'], record['user_id']) for record in existing}
+        rebuilt = len(counts)
+        for _ in range(passes):
+            self._write_monthly(counts, keys)
+            mismatches = self.check_monthly_rollups(month)
+            if not mismatches:
+                break
+            counts = {(mismatch['month'], mismatch['user_id']): mismatch['attendance'] for mismatch in mismatches}
+            keys = set(counts)
+        return rebuilt
+    
+    def check_monthly_rollups(self, month=None):
+        """Compare the rollups with the raw attendance; returns the mismatching counters"""
+        expected = self._count_monthly(month)
+        actual = {
+            (record['month'], record['user_id']): record['classes_attended']
+            for record in self.monthly_collection.find({'month': month} if month else {}, {'_id': 0})
         }
+        return [
+            {'month': key[0], 'user_id': key[1], 'rollup': actual.get(key, 0), 'attendance': expected.get(key, 0)}
+            for key in sorted(set(expected) | set(actual))
+            if actual.get(key, 0) != expected.get(key, 0)
+        ]
+    
+    def iter_attendance_by_date(self, date, period=None, after=None, limit=None, batch_size=500):
+        """Cursor over a date's attendance ordered by attendance_id, starting after the given attendance_id"""
+        pipeline = attendance_pipeline(date, period, after, limit)
+        return self.attendance_collection.aggregate(pipeline, batchSize=batch_size)
+    
+    def get_attendance_by_date(self, date, period=None, after=None, limit=None):
+        """Get attendance records for a specific date and optional period"""
+        attendance = list(self.iter_attendance_by_date(date, period, after, limit))
+        return attendance
+    
+    def get_monthly_attendance(self, month, department=None):
+        """Get monthly attendance report with percentage calculation"""
+        user_match, rollup_query = monthly_queries(month, department)
+        
+        # Students of the department (indexed on department)
+        users = list(self.users_collection.find(user_match, {'_id': 0, 'user_id': 1, 'name': 1, 'department': 1}))
         
-        # Prepare the report
-        report = []
-        for user in users:
-            user_id = user['user_id']
-            classes_attended = attendance_counts.get(user_id, 0)
-            attendance_percentage = round((classes_attended / total_possible_classes) * 100, 2) if total_possible_classes > 0 else 0
-            
-            report.append({
-                'user_id': user_id,
-                'user_name': user['name'],
-                'department': user['department'],
-                'total_classes': total_possible_classes,
-                'classes_attended': classes_attended,
-                'attendance_percentage': attendance_percentage
-            })
+        # Attended-class counters for the month, read from the rollups (indexed on month, user_id)
+        if user_match:
+            rollup_query['user_id'] = {'$in': [user['user_id'] for user in users]}
+        attendance_counts = {
+            record['user_id']: record['classes_attended']
+            for record in self.monthly_collection.find(rollup_query, {'_id': 0, 'user_id': 1, 'classes_attended': 1})
+        }
         
-        return report
\ No newline at end of file
+        return monthly_report(month, users, attendance_counts)
@@ -0,0 +1,91 @@
+import cv2
+import face_recognition
+
+
+class DetectionConfig:
+    """How faces are located and encoded.
+
+    max_side     downscale the frame so its longest side is at most this many
+                 pixels before detection (None keeps full resolution); boxes are
+                 scaled back so encodings still use the full-resolution pixels
+    model        'hog' (CPU, fast) or 'cnn' (more accurate, needs a GPU to be quick)
+    upsample     number_of_times_to_upsample for detection; finds smaller faces, costs ~4x per step
+    num_jitters  re-samples per encoding; higher is slightly more accurate and linearly slower
+    roi          optional (top, right, bottom, left) crop as fractions of the frame,
+                 e.g. (0.1, 0.8, 0.9, 0.2) for a kiosk where faces are always central
+    """
+
+    def __init__(self, max_side=None, model='hog', upsample=1, num_jitters=1, roi=None):
+        if model not in ('hog', 'cnn'):
+            raise ValueError(f"Unknown detection model: {model}")
+        self.max_side = max_side
+        self.model = model
+        self.upsample = upsample
+        self.num_jitters = num_jitters
+        self.roi = tuple(roi) if roi else None
+
+    def key(self):
+        """Hashable identity of the settings"""
+        return (self.max_side, self.model, self.upsample, self.num_jitters, self.roi)
+
+    def __repr__(self):
+        return (f"DetectionConfig(max_side={self.max_side}, model={self.model!r}, "
+                f"upsample={self.upsample}, num_jitters={self.num_jitters}, roi={self.roi})")
+
+
+PRESETS = {
+    # Full-resolution HOG, the original behaviour
+    'default': DetectionConfig(),
+    'fast': DetectionConfig(max_side=480, upsample=0),
+    'balanced': DetectionConfig(max_side=640, upsample=1),
+    'accurate': DetectionConfig(max_side=1280, upsample=1, num_jitters=3),
+    'cnn': DetectionConfig(max_side=800, model='cnn', upsample=1),
+    # Group photos: faces at the back of a class photo are a few dozen pixels wide, so only
+    # very large photos are shrunk
+    'group': DetectionConfig(max_side=2560, upsample=1),
+}
+
+
+def get_config(config):
+    """Accept a DetectionConfig, a preset name or None (the default preset)"""
+    if config is None:
+        return PRESETS['default']
+    if isinstance(config, DetectionConfig):
+        return config
+    if config not in PRESETS:
+        raise ValueError(f"Unknown detection preset: {config}")
+    return PRESETS[config]
+
+
+def detect_faces(image, config=None):
+    """Face locations as (top, right, bottom, left) in full-image coordinates"""
+    config = get_config(config)
+    height, width = image.shape[:2]
+
+    # Optional region of interest
+    offset_y, offset_x = 0, 0
+    region = image
+    if config.roi:
+        top, right, bottom, left = config.roi
+        offset_y, offset_x = int(top * height), int(left * width)
+        region = image[offset_y:int(bottom * height), offset_x:int(right * width)]
+
+    # Downscale before detection, which is where the time goes
+    scale = 1.0
+    longest = max(region.shape[:2])
+    if config.max_side and longest > config.max_side:
+        scale = config.max_side / longest
+        region = cv2.resize(region, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    locations = face_recognition.face_locations(region, config.upsample, config.model)
+
+    # Map boxes back onto the full-resolution frame
+    return [
+        (
+            max(int(round(top / scale)) + offset_y, 0),
+            min(int(round(right / scale)) + offset_x, width),
+            min(int(round(bottom / scale)) + offset_y, height),
+            max(int(round(left / scale)) + offset_x, 0),
+        )
+        for top, right, bottom, left in locations
+    ]
@@ -0,0 +1,431 @@
+import fcntl
+import os
+import struct
+import threading
+import zlib
+from contextlib import contextmanager
+
+import numpy as np
+
+from face_gallery import FaceGallery
+
+# WAL record header: crc32 of the rest of the record, row index, id length
+WAL_HEADER = struct.Struct('<IQH')
+WAL_CHECKPOINT_BYTES = 1 << 20
+
+# Rows are copied to the compacted file in chunks of this many
+COMPACT_CHUNK_ROWS = 65536
+
+
+def exemplars_path(path):
+    """Where the enrolment exemplars of the gallery at `path` are stored"""
+    return f"{path}_exemplars"
+
+
+def _fsync_dir(path):
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class MappedFaceGallery(FaceGallery):
+    """FaceGallery persisted as an append-only, memory-mapped float32 file.
+
+    `<path>.f32` holds the encodings as raw fixed-width rows, `<path>.ids` one
+    user id per line (row i is line i) and `<path>.wal` a write-ahead log of
+    appends that have not been checkpointed yet. The matrix is mapped
+    read-only, so several processes opening the same files share one copy
+    through the page cache; writes go through the file handles and are
+    fsync'd before `add` returns.
+
+    The id file doubles as the change log: its length in bytes is the
+    gallery version. Writers append under an exclusive flock on
+    `<path>.lock`, and every process picks up rows appended by the others
+    with `refresh()`, which reads only the id lines past its last offset.
+
+    Removed users are appended to `<path>.del`; their rows stay in place but
+    get an infinite norm, so every distance to them is infinite. `compact()`
+    rewrites the files without them and bumps `generation`, which tells the
+    other processes to reload rather than apply the log incrementally.
+    """
+
+    def __init__(self, path, dim=128, capacity=1024, readonly=False):
+        self.path = path
+        self.dim = dim
+        self.readonly = readonly
+        self.initial_capacity = capacity
+        self.row_bytes = dim * np.dtype(np.float32).itemsize
+        self.data_file = f"{path}.f32"
+        self.ids_file = f"{path}.ids"
+        self.wal_file = f"{path}.wal"
+        self.lock_file = f"{path}.lock"
+        self.tombstone_file = f"{path}.del"
+        self.compact_marker = f"{path}.compacting"
+        self.generation = 0
+        self._files = []
+        self._thread_lock = threading.RLock()
+        self._lock_depth = 0
+        if not readonly:
+            self._lock = open(self.lock_file, 'a+b')
+
+        with self.locked():
+            if not readonly:
+                self._finish_compaction()
+            self._load()
+
+    def _load(self):
+        """Open the files and map the rows they hold"""
+        if not self.readonly:
+            for name in (self.data_file, self.ids_file, self.wal_file):
+                if not os.path.exists(name):
+                    open(name, 'wb').close()
+            self._data = open(self.data_file, 'r+b')
+            self._ids = open(self.ids_file, 'r+b')
+            self._wal = open(self.wal_file, 'r+b')
+            self._files = [self._data, self._ids, self._wal]
+
+        self._ids_inode = self._inode(self.ids_file)
+        self.ids = self._read_ids()
+        self.size = len(self.ids)
+        if not self.readonly:
+            self._recover()
+
+        file_rows = os.path.getsize(self.data_file) // self.row_bytes if os.path.exists(self.data_file) else 0
+        rows = max(file_rows, self.size, 1)
+        if not self.readonly and file_rows < max(self.initial_capacity, self.size):
+            rows = max(self.initial_capacity, self.size)
+            self._resize_file(rows)
+        self._mapped = bool(file_rows or not self.readonly)
+        if self._mapped:
+            self.matrix = self._map(rows)
+        else:
+            # Nothing written yet; a writer process will create the file
+            self.matrix = np.zeros((rows, self.dim), dtype=np.float32)
+
+        self.sq_norms = np.zeros(rows, dtype=np.float32)
+        encodings = self.matrix[:self.size]
+        self.sq_norms[:self.size] = np.einsum('ij,ij->i', encodings, encodings)
+
+        # Tombstoned users, and the rows masked for them in the order they were removed
+        self.deleted = set()
+        self.deleted_rows = []
+        self._del_offset = 0
+        self._read_tombstones()
+
+    @staticmethod
+    def _inode(name):
+        try:
+            return os.stat(name).st_ino
+        except FileNotFoundError:
+            return None
+
+    def _read_ids(self):
+        if not os.path.exists(self.ids_file):
+            self._ids_offset = 0
+            return []
+        with open(self.ids_file, 'rb') as f:
+            content = f.read()
+        # A line without its newline is an append that never completed; the WAL replays it
+        complete = content[:content.rfind(b'\n') + 1]
+        if not self.readonly and len(complete) != len(content):
+            self._ids.truncate(len(complete))
+        self._ids_offset = len(complete)
+        return complete.decode('utf-8').splitlines()
+
+    @contextmanager
+    def locked(self):
+        """Hold the writer lock, across threads and across processes sharing the files"""
+        with self._thread_lock:
+            if self._lock_depth == 0 and not self.readonly:
+                fcntl.flock(self._lock.fileno(), fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0 and not self.readonly:
+                    fcntl.flock(self._lock.fileno(), fcntl.LOCK_UN)
+
+    @property
+    def version(self):
+        """Bytes of the id log applied to this process's view of the gallery"""
+        return self._ids_offset
+
+    def live_ids(self):
+        """Ids of the users with rows that are not tombstoned"""
+        return set(self.ids) - self.deleted
+
+    @property
+    def stale(self):
+        """Whether another process compacted (or created) the files since they were loaded"""
+        return self._inode(self.ids_file) != self._ids_inode
+
+    @property
+    def changed(self):
+        """Whether other processes appended, removed or compacted rows since the last refresh (a few stat() calls)"""
+        return (self.stale or self._grown(self.ids_file, self._ids_offset)
+                or self._grown(self.tombstone_file, self._del_offset))
+
+    @staticmethod
+    def _grown(path, offset):
+        return os.path.exists(path) and os.path.getsize(path) > offset
+
+    def refresh(self, reload=True):
+        """Apply rows other processes appended since the last refresh; returns their row indices.
+
+        After a compaction by another process the gallery is reloaded in place,
+        or with reload=False left untouched (see `stale`) until the caller can
+        reload it without searches in flight.
+        """
+        if self.stale:
+            if not reload:
+                return np.arange(0)
+            # Row numbers changed, start over
+            with self.locked():
+                self._close_files()
+                self._load()
+                self.generation += 1
+            return np.arange(0)
+
+        added = self._read_appends()
+        self._read_tombstones()
+        return added
+
+    def _read_appends(self):
+        # A stat() is all it costs when nothing changed
+        if not os.path.exists(self.ids_file) or os.path.getsize(self.ids_file) <= self._ids_offset:
+            return np.arange(0)
+
+        with self._thread_lock:
+            with open(self.ids_file, 'rb') as f:
+                f.seek(self._ids_offset)
+                content = f.read()
+            # Rows are written before their id line, so every complete line has its encoding on disk
+            complete = content[:content.rfind(b'\n') + 1]
+            if not complete:
+                return np.arange(0)
+            user_ids = complete.decode('utf-8').splitlines()
+
+            start = self.size
+            needed = start + len(user_ids)
+            if needed > self.capacity or not self._mapped:
+                # Another process grew the file; map it at its new length
+                rows = max(os.path.getsize(self.data_file) // self.row_bytes, needed)
+                self.matrix = self._map(rows)
+                self._mapped = True
+                sq_norms = np.zeros(rows, dtype=np.float32)
+                sq_norms[:start] = self.sq_norms[:start]
+                self.sq_norms = sq_norms
+
+            encodings = self.matrix[start:needed]
+            self.sq_norms[start:needed] = np.einsum('ij,ij->i', encodings, encodings)
+            self.ids.extend(user_ids)
+            self.size = needed
+            self._ids_offset += len(complete)
+            return np.arange(start, needed)
+
+    def _read_tombstones(self):
+        if not os.path.exists(self.tombstone_file) or os.path.getsize(self.tombstone_file) <= self._del_offset:
+            return
+        with self._thread_lock:
+            with open(self.tombstone_file, 'rb') as f:
+                f.seek(self._del_offset)
+                content = f.read()
+            complete = content[:content.rfind(b'\n') + 1]
+            self._del_offset += len(complete)
+            self._mask(complete.decode('utf-8').splitlines())
+
+    def _mask(self, user_ids):
+        removed = set(user_ids) - self.deleted
+        if not removed:
+            return
+        self.deleted |= removed
+        rows = [row for row, user_id in enumerate(self.ids) if user_id in removed]
+        self.sq_norms[rows] = np.inf
+        self.deleted_rows.extend(rows)
+
+    def extend(self, user_ids, encodings):
+        """Append after any rows other processes added, holding the writer lock throughout"""
+        with self.locked():
+            self.refresh()
+            return super().extend(user_ids, encodings)
+
+    def remove(self, user_ids):
+        """Tombstone every row of these users; returns the rows masked"""
+        if self.readonly:
+            raise RuntimeError("Face gallery is opened read-only")
+        with self.locked():
+            self.refresh()
+            user_ids = [user_id for user_id in dict.fromkeys(user_ids) if user_id not in self.deleted]
+            if not user_ids:
+                return []
+            with open(self.tombstone_file, 'ab') as f:
+                f.write(''.join(f"{user_id}\n" for user_id in user_ids).encode('utf-8'))
+                f.flush()
+                os.fsync(f.fileno())
+                self._del_offset = f.tell()
+            start = len(self.deleted_rows)
+            self._mask(user_ids)
+            return self.deleted_rows[start:]
+
+    def compact(self):
+        """Rewrite the files without tombstoned rows; returns how many rows were dropped"""
+        if self.readonly:
+            raise RuntimeError("Face gallery is opened read-only")
+        with self.locked():
+            self.refresh()
+            keep = np.array([row for row, user_id in enumerate(self.ids) if user_id not in self.deleted], dtype=np.int64)
+            dropped = self.size - len(keep)
+            if not dropped:
+                return 0
+
+            # Row numbers are about to change; everything in the WAL is already applied
+            self.checkpoint()
+            with open(f"{self.data_file}.tmp", 'wb') as f:
+                for start in range(0, len(keep), COMPACT_CHUNK_ROWS):
+                    f.write(np.ascontiguousarray(self.matrix[keep[start:start + COMPACT_CHUNK_ROWS]]).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(f"{self.ids_file}.tmp", 'wb') as f:
+                f.write(''.join(f"{self.ids[row]}\n" for row in keep).encode('utf-8'))
+                f.flush()
+                os.fsync(f.fileno())
+            with open(f"{self.tombstone_file}.tmp", 'wb') as f:
+                os.fsync(f.fileno())
+
+            # Commit point: from here on, an interrupted compaction is finished on the next open
+            with open(self.compact_marker, 'wb') as f:
+                os.fsync(f.fileno())
+            _fsync_dir(self.compact_marker)
+            self._finish_compaction()
+
+            self._close_files()
+            self._load()
+            self.generation += 1
+            return dropped
+
+    def _finish_compaction(self):
+        temporary = [f"{name}.tmp" for name in (self.data_file, self.tombstone_file, self.ids_file)]
+        if not os.path.exists(self.compact_marker):
+            # A compaction that never reached its commit point
+            for name in temporary:
+                if os.path.exists(name):
+                    os.remove(name)
+            return
+        # Data before ids: a process that sees the new id file must find the new rows behind it
+        for name in temporary:
+            if os.path.exists(name):
+                os.replace(name, name[:-len('.tmp')])
+        _fsync_dir(self.compact_marker)
+        os.remove(self.compact_marker)
+
+    def _close_files(self):
+        for f in self._files:
+            f.close()
+        self._files = []
+
+    def _read_wal(self):
+        """Yield (row, user_id, encoding) for every intact WAL record"""
+        self._wal.seek(0)
+        content = self._wal.read()
+        offset = 0
+        while offset + WAL_HEADER.size <= len(content):
+            crc, row, id_len = WAL_HEADER.unpack_from(content, offset)
+            body_start = offset + 4
+            end = offset + WAL_HEADER.size + id_len + self.row_bytes
+            if end > len(content) or zlib.crc32(content[body_start:end]) != crc:
+                # Torn tail from a crash mid-write: nothing after it was acknowledged
+                break
+            id_start = offset + WAL_HEADER.size
+            user_id = content[id_start:id_start + id_len].decode('utf-8')
+            encoding = np.frombuffer(content, dtype=np.float32, count=self.dim,
+                                     offset=id_start + id_len)
+            yield row, user_id, encoding
+            offset = end
+
+    def _recover(self):
+        """Re-apply logged appends that did not reach the data and id files"""
+        replayed = 0
+        for row, user_id, encoding in self._read_wal():
+            if row < self.size:
+                continue
+            if row > self.size:
+                break
+            self._write_data(row, encoding[None, :])
+            self._write_ids([user_id])
+            self.ids.append(user_id)
+            self.size += 1
+            replayed += 1
+        if replayed:
+            print(f"Recovered {replayed} face encodings from {self.wal_file}")
+        self.checkpoint()
+
+    def _map(self, rows):
+        return np.memmap(self.data_file, dtype=np.float32, mode='r', shape=(rows, self.dim))
+
+    def _resize_file(self, rows):
+        # Never shrink: another process may already have grown the file further
+        self._data.truncate(max(rows * self.row_bytes, os.path.getsize(self.data_file)))
+        self._data.flush()
+        os.fsync(self._data.fileno())
+
+    def _allocate(self, capacity):
+        if self.readonly:
+            raise RuntimeError("Face gallery is opened read-only")
+        # Growing the file keeps existing rows in place, so only a remap is needed
+        self._resize_file(capacity)
+        return self._map(capacity)
+
+    def _write_data(self, start, encodings):
+        self._data.seek(start * self.row_bytes)
+        self._data.write(np.ascontiguousarray(encodings, dtype=np.float32).tobytes())
+        self._data.flush()
+        os.fsync(self._data.fileno())
+
+    def _write_ids(self, user_ids):
+        self._ids.seek(0, os.SEEK_END)
+        self._ids.write(''.join(f"{user_id}\n" for user_id in user_ids).encode('utf-8'))
+        self._ids.flush()
+        os.fsync(self._ids.fileno())
+        self._ids_offset = self._ids.tell()
+
+    def _store(self, start, user_ids, encodings):
+        if self.readonly:
+            raise RuntimeError("Face gallery is opened read-only")
+        for user_id in user_ids:
+            if '\n' in user_id:
+                raise ValueError("User id must not contain a newline")
+
+        # 1. Log the append so a crash at any later point can be replayed
+        records = []
+        for offset, (user_id, encoding) in enumerate(zip(user_ids, encodings)):
+            id_bytes = user_id.encode('utf-8')
+            body = struct.pack('<QH', start + offset, len(id_bytes)) + id_bytes + encoding.tobytes()
+            records.append(struct.pack('<I', zlib.crc32(body)) + body)
+        self._wal.seek(0, os.SEEK_END)
+        self._wal.write(b''.join(records))
+        self._wal.flush()
+        os.fsync(self._wal.fileno())
+
+        # 2. Apply it: rows first, then the id lines that make them visible
+        self._write_data(start, encodings)
+        self._write_ids(user_ids)
+
+        if self._wal.tell() > WAL_CHECKPOINT_BYTES:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """Drop WAL records whose appends are already durable"""
+        if self.readonly:
+            return
+        with self.locked():
+            self._wal.truncate(0)
+            self._wal.flush()
+            os.fsync(self._wal.fileno())
+
+    def close(self):
+        self._close_files()
+        if not self.readonly:
+            self._lock.close()
@@ -0,0 +1,107 @@
+import numpy as np
+
+
+class FaceGallery:
+    """Contiguous float32 matrix of known face encodings with precomputed norms"""
+
+    def __init__(self, dim=128, capacity=1024):
+        self.dim = dim
+        self.size = 0
+        self.ids = []
+        self.matrix = np.zeros((capacity, dim), dtype=np.float32)
+        self.sq_norms = np.zeros(capacity, dtype=np.float32)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def capacity(self):
+        return self.matrix.shape[0]
+
+    @property
+    def encodings(self):
+        """View of the stored encodings (size x dim)"""
+        return self.matrix[:self.size]
+
+    def _reserve(self, capacity):
+        """Grow the preallocated storage to hold at least `capacity` rows"""
+        if capacity <= self.capacity:
+            return
+        self.matrix = self._allocate(capacity)
+        sq_norms = np.zeros(capacity, dtype=np.float32)
+        sq_norms[:self.size] = self.sq_norms[:self.size]
+        self.sq_norms = sq_norms
+
+    def _allocate(self, capacity):
+        """Return a (capacity x dim) matrix holding the current rows"""
+        matrix = np.zeros((capacity, self.dim), dtype=np.float32)
+        matrix[:self.size] = self.matrix[:self.size]
+        return matrix
+
+    def add(self, user_id, encoding):
+        """Append one encoding and return its row index"""
+        return int(self.extend([user_id], [encoding])[0])
+
+    def extend(self, user_ids, encodings):
+        """Append many encodings at once and return their row indices"""
+        encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, self.dim)
+        if len(user_ids) != len(encodings):
+            raise ValueError("Number of ids and encodings must match")
+
+        needed = self.size + len(encodings)
+        if needed > self.capacity:
+            # Amortized doubling keeps add_face O(1) on average
+            capacity = max(1, self.capacity)
+            while capacity < needed:
+                capacity *= 2
+            self._reserve(capacity)
+
+        start = self.size
+        self._store(start, user_ids, encodings)
+        self.sq_norms[start:needed] = np.einsum('ij,ij->i', encodings, encodings)
+        self.ids.extend(user_ids)
+        self.size = needed
+        return np.arange(start, needed)
+
+    def _store(self, start, user_ids, encodings):
+        """Write rows into the matrix; subclasses persist them as well"""
+        self.matrix[start:start + len(encodings)] = encodings
+
+    def distances(self, queries, rows=None):
+        """Euclidean distances from each query to every stored encoding (or to `rows`)"""
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        if rows is None:
+            matrix = self.matrix[:self.size]
+            sq_norms = self.sq_norms[:self.size]
+        else:
+            matrix = self.matrix[rows]
+            sq_norms = self.sq_norms[rows]
+
+        # ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b, with a single BLAS product for the cross term
+        q_norms = np.einsum('ij,ij->i', queries, queries)
+        sq_dist = q_norms[:, None] + sq_norms[None, :] - 2.0 * (queries @ matrix.T)
+        np.maximum(sq_dist, 0.0, out=sq_dist)
+        return np.sqrt(sq_dist)
+
+    def search(self, encoding, k=1):
+        """Return the k nearest rows as (rows, distances), closest first"""
+        rows, distances = self.search_batch(encoding, k)
+        return rows[0], distances[0]
+
+    def search_batch(self, queries, k=1):
+        """Top-k rows and distances for every query, closest first"""
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        k = min(k, self.size)
+        if k <= 0:
+            empty = np.empty((len(queries), 0))
+            return empty.astype(np.int64), empty.astype(np.float32)
+
+        distances = self.distances(queries)
+        if k < self.size:
+            # Partial sort: only the k best candidates get fully ordered
+            rows = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        else:
+            rows = np.broadcast_to(np.arange(self.size), distances.shape)
+        top = np.take_along_axis(distances, rows, axis=1)
+        order = np.argsort(top, axis=1)
+        return np.take_along_axis(rows, order, axis=1), np.take_along_axis(top, order, axis=1)
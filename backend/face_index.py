@@ -0,0 +1,412 @@
+import functools
+
+import numpy as np
+
+from quantization import assign_labels, create_codec, kmeans
+
+
+class BruteForceIndex:
+    """Exact search over every row of the gallery"""
+
+    def __init__(self, gallery):
+        self.gallery = gallery
+
+    def add(self, rows):
+        """Nothing to maintain: the gallery matrix is the index"""
+        pass
+
+    def remove(self, rows):
+        """Nothing to do: tombstoned rows already have an infinite norm in the gallery"""
+        pass
+
+    def rebuild(self):
+        pass
+
+    @property
+    def needs_rebuild(self):
+        return False
+
+    def search(self, query, k=1):
+        return self.gallery.search(query, k)
+
+    def search_batch(self, queries, k=1):
+        return self.gallery.search_batch(queries, k)
+
+
+class _InvertedList:
+    """Growable block of vectors belonging to one coarse cell"""
+
+    def __init__(self, dim, capacity=16):
+        self.size = 0
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.sq_norms = np.zeros(capacity, dtype=np.float32)
+        self.rows = np.zeros(capacity, dtype=np.int64)
+
+    def extend(self, rows, vectors, sq_norms):
+        needed = self.size + len(rows)
+        if needed > len(self.rows):
+            capacity = len(self.rows)
+            while capacity < needed:
+                capacity *= 2
+            for name in ('vectors', 'sq_norms', 'rows'):
+                old = getattr(self, name)
+                new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+                new[:self.size] = old[:self.size]
+                setattr(self, name, new)
+
+        self.vectors[self.size:needed] = vectors
+        self.sq_norms[self.size:needed] = sq_norms
+        self.rows[self.size:needed] = rows
+        self.size = needed
+
+    def mask(self, rows):
+        hit = np.isin(self.rows[:self.size], rows)
+        self.sq_norms[:self.size][hit] = np.inf
+
+
+class IVFIndex:
+    """Inverted-file index: a k-means coarse quantizer over the gallery.
+
+    Each query only scans the `nprobe` cells whose centroids are closest, so
+    `nprobe` is the recall/latency knob; by default it grows with the number
+    of cells (1/32 of them, at least 16). Until the gallery holds
+    `min_train_size` encodings searches fall back to brute force.
+
+    A retrain builds the centroids and inverted lists off to the side and
+    publishes them as one snapshot, so concurrent searches keep using the
+    previous one until then. `add` never retrains: the owner calls rebuild
+    off the request path once `needs_rebuild` says so.
+    """
+
+    def __init__(self, gallery, nlist=None, nprobe=None, min_train_size=1000,
+                 kmeans_iterations=10, max_train_size=65536, seed=0):
+        self.gallery = gallery
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.min_train_size = min_train_size
+        self.kmeans_iterations = kmeans_iterations
+        self.max_train_size = max_train_size
+        self.seed = seed
+        # (centroids, centroid squared norms, inverted lists), replaced as a whole
+        self.cells = None
+        self.trained_on = 0
+
+    @property
+    def is_trained(self):
+        return self.cells is not None
+
+    @property
+    def centroids(self):
+        return self.cells[0] if self.cells else None
+
+    @property
+    def lists(self):
+        return self.cells[2] if self.cells else []
+
+    def probes(self, nlist):
+        if self.nprobe:
+            return self.nprobe
+        return max(16, -(-nlist // 32))
+
+    @staticmethod
+    def _nearest_centroids(cells, vectors, n=1):
+        centroids, centroid_sq_norms, _ = cells
+        vectors = np.asarray(vectors, dtype=np.float32)
+        # The query norm is constant per row, so it can be left out of the ranking
+        scores = centroid_sq_norms[None, :] - 2.0 * (vectors @ centroids.T)
+        n = min(n, len(centroids))
+        return np.argpartition(scores, n - 1, axis=1)[:, :n]
+
+    def _kmeans(self, data, nlist):
+        return kmeans(data, nlist, self.kmeans_iterations, self.seed)
+
+    def rebuild(self):
+        """Retrain the coarse quantizer and reassign every live gallery row"""
+        size = len(self.gallery)
+        # Tombstoned rows may be anything and never match, so they are neither trained on nor assigned
+        live = np.flatnonzero(np.isfinite(self.gallery.sq_norms[:size]))
+        if len(live) < self.min_train_size:
+            self.cells = None
+            self.trained_on = 0
+            return
+
+        nlist = self.nlist or int(np.clip(4 * np.sqrt(len(live)), 1, 65536))
+        nlist = min(nlist, len(live))
+        train_size = min(self.max_train_size, 64 * nlist)
+        sample = live
+        if len(live) > train_size:
+            rng = np.random.default_rng(self.seed)
+            sample = np.sort(rng.choice(live, train_size, replace=False))
+        train = np.ascontiguousarray(self.gallery.matrix[sample])
+
+        centroids = self._kmeans(train, nlist)
+        cells = (centroids, np.einsum('ij,ij->i', centroids, centroids),
+                 [_InvertedList(self.gallery.dim) for _ in range(nlist)])
+        self._assign(cells, live)
+        self.cells = cells
+        self.trained_on = size
+
+    @property
+    def needs_rebuild(self):
+        """Whether the gallery outgrew the quantizer (or grew enough to train one); the caller retrains
+        off the request path, and until then rows go into the current cells"""
+        if not self.is_trained:
+            return len(self.gallery) >= self.min_train_size
+        return len(self.gallery) >= 4 * self.trained_on
+
+    def _assign(self, cells, rows, chunk=65536):
+        centroids, centroid_sq_norms, lists = cells
+        for start in range(0, len(rows), chunk):
+            part = rows[start:start + chunk]
+            vectors = self.gallery.matrix[part]
+            labels = assign_labels(vectors, centroids, centroid_sq_norms)
+            order = np.argsort(labels, kind='stable')
+            labels, part, vectors = labels[order], part[order], vectors[order]
+            bounds = np.flatnonzero(np.diff(labels)) + 1
+            for lo, hi in zip(np.r_[0, bounds], np.r_[bounds, len(labels)]):
+                lists[labels[lo]].extend(part[lo:hi], vectors[lo:hi],
+                                         self.gallery.sq_norms[part[lo:hi]])
+
+    def add(self, rows):
+        """Index rows newly appended to the gallery (searched by brute force until the first training)"""
+        if not self.is_trained:
+            return
+        self._assign(self.cells, np.asarray(rows, dtype=np.int64))
+
+    def remove(self, rows):
+        """Mask tombstoned rows in the inverted lists, which hold their own copy of the norms"""
+        if not self.is_trained:
+            return
+        rows = np.asarray(rows, dtype=np.int64)
+        for lst in self.lists:
+            lst.mask(rows)
+
+    def search(self, query, k=1):
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        cells = self.cells
+        if cells is None:
+            return self.gallery.search(query, k)
+
+        lists = cells[2]
+        probed = self._nearest_centroids(cells, query[None, :], self.probes(len(lists)))[0]
+        lists = [lists[c] for c in probed if lists[c].size]
+        if not lists:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        q_sq = np.dot(query, query)
+        # Each list's size is read once, so rows appended meanwhile are left for the next search
+        sizes = [lst.size for lst in lists]
+        rows = np.concatenate([lst.rows[:n] for lst, n in zip(lists, sizes)])
+        sq_dist = np.concatenate([
+            lst.sq_norms[:n] - 2.0 * (lst.vectors[:n] @ query)
+            for lst, n in zip(lists, sizes)
+        ]) + q_sq
+        k = min(k, len(rows))
+        if k < len(rows):
+            top = np.argpartition(sq_dist, k - 1)[:k]
+        else:
+            top = np.arange(len(rows))
+        top = top[np.argsort(sq_dist[top])]
+        return rows[top], np.sqrt(np.maximum(sq_dist[top], 0.0))
+
+    def search_batch(self, queries, k=1):
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.gallery.dim)
+        if not self.is_trained:
+            return self.gallery.search_batch(queries, k)
+
+        k = min(k, len(self.gallery))
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        for i, query in enumerate(queries):
+            r, d = self.search(query, k)
+            rows[i, :len(r)] = r
+            distances[i, :len(d)] = d
+        return rows, distances
+
+
+class QuantizedIndex:
+    """Scan over compressed codes, with the best `refine` candidates re-scored in full precision.
+
+    The scan only reads the codes (`codec` 'fp16': 2 bytes per dimension,
+    'int8': 1 byte, 'pq': 1 byte per subspace), so the working set of a large
+    gallery is 2-32x smaller than the float32 rows, which are read back only
+    for the candidates being refined. `refine` is the accuracy/latency knob.
+    Until the gallery holds `min_train_size` encodings searches are exact.
+
+    This trades latency for memory: with numpy the fp16 and int8 scans are
+    slower than a float32 BLAS scan that fits in memory (converting the codes
+    costs more than the bytes saved), so use them when it does not.
+
+    The codec, codes, norms and size are published as one tuple, and a
+    retrain builds its tuple off to the side, so concurrent searches keep
+    using the previous codes until it is done.
+    """
+
+    def __init__(self, gallery, codec='int8', refine=32, min_train_size=1000, max_train_size=65536,
+                 chunk_rows=4096, seed=0, **codec_options):
+        self.gallery = gallery
+        self.codec_kind = codec
+        self.codec_options = codec_options
+        self.refine = refine
+        self.min_train_size = min_train_size
+        self.max_train_size = max_train_size
+        self.chunk_rows = chunk_rows
+        self.seed = seed
+        # (codec, codes, norms, rows encoded), replaced as a whole
+        self.encoded = None
+        self.trained_on = 0
+
+    @property
+    def is_trained(self):
+        return self.encoded is not None
+
+    @property
+    def codec(self):
+        return self.encoded[0] if self.encoded else None
+
+    @property
+    def size(self):
+        return self.encoded[3] if self.encoded else 0
+
+    @property
+    def nbytes(self):
+        """Memory held by the codes and their norms"""
+        if not self.is_trained:
+            return 0
+        _, codes, norms, size = self.encoded
+        return codes[:size].nbytes + norms[:size].nbytes
+
+    def rebuild(self):
+        """Retrain the codec and re-encode every gallery row"""
+        size = len(self.gallery)
+        if size < self.min_train_size:
+            self.encoded = None
+            self.trained_on = 0
+            return
+
+        # Train on live rows only; tombstoned ones may be anything
+        live = np.flatnonzero(np.isfinite(self.gallery.sq_norms[:size]))
+        if len(live) > self.max_train_size:
+            rng = np.random.default_rng(self.seed)
+            live = np.sort(rng.choice(live, self.max_train_size, replace=False))
+        codec = create_codec(self.codec_kind, self.gallery.dim, **self.codec_options)
+        codec.train(np.ascontiguousarray(self.gallery.matrix[live]))
+
+        codes = np.zeros((max(size, 1), codec.code_size), dtype=codec.code_dtype)
+        norms = np.zeros(max(size, 1), dtype=np.float32)
+        self._encode(codec, codes, norms, 0, size)
+        self.encoded = (codec, codes, norms, size)
+        self.trained_on = size
+
+    @property
+    def needs_rebuild(self):
+        """Whether the gallery outgrew the codec (or grew enough to train one); the caller retrains
+        off the request path, and until then rows are encoded with the current codec"""
+        if not self.is_trained:
+            return len(self.gallery) >= self.min_train_size
+        return len(self.gallery) >= 4 * self.trained_on
+
+    def _encode(self, codec, codes, norms, start, end):
+        """Encode gallery rows start..end into `codes` and `norms`"""
+        for chunk_start in range(start, end, self.chunk_rows):
+            stop = min(chunk_start + self.chunk_rows, end)
+            chunk = codec.encode(self.gallery.matrix[chunk_start:stop])
+            chunk_norms = codec.norms(chunk)
+            chunk_norms[~np.isfinite(self.gallery.sq_norms[chunk_start:stop])] = np.inf
+            codes[chunk_start:stop] = chunk
+            norms[chunk_start:stop] = chunk_norms
+
+    def _append(self, end):
+        """Encode the gallery rows from self.size up to `end`"""
+        codec, codes, norms, size = self.encoded
+        if end > len(norms):
+            capacity = len(norms)
+            while capacity < end:
+                capacity *= 2
+            grown = []
+            for old in (codes, norms):
+                new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+                new[:size] = old[:size]
+                grown.append(new)
+            codes, norms = grown
+
+        # Rows past `size` are not visible to searches until the new tuple is published
+        self._encode(codec, codes, norms, size, end)
+        self.encoded = (codec, codes, norms, end)
+
+    def add(self, rows):
+        """Encode rows newly appended to the gallery (searched exactly until the first training)"""
+        if not self.is_trained:
+            return
+        self._append(max(self.size, int(np.max(rows)) + 1) if len(rows) else self.size)
+
+    def remove(self, rows):
+        """Mask tombstoned rows, whose codes are still in place"""
+        if not self.is_trained:
+            return
+        _, _, norms, size = self.encoded
+        rows = np.asarray(rows, dtype=np.int64)
+        norms[rows[rows < size]] = np.inf
+
+    def _approximate(self, query, encoded=None):
+        codec, codes, norms, size = encoded or self.encoded
+        state = codec.prepare(query)
+        sq_dist = np.empty(size, dtype=np.float32)
+        # Chunked so the decoded float32 block stays cache-sized
+        for start in range(0, size, self.chunk_rows):
+            stop = min(start + self.chunk_rows, size)
+            sq_dist[start:stop] = codec.sq_distances(state, codes[start:stop], norms[start:stop])
+        return sq_dist
+
+    def search(self, query, k=1):
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        encoded = self.encoded
+        if encoded is None:
+            return self.gallery.search(query, k)
+
+        size = encoded[3]
+        candidates = min(max(k, self.refine), size)
+        if candidates <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        sq_dist = self._approximate(query, encoded)
+        if candidates < size:
+            rows = np.argpartition(sq_dist, candidates - 1)[:candidates]
+        else:
+            rows = np.arange(size)
+
+        # Exact distances from the float32 rows put the candidates in their true order
+        distances = self.gallery.distances(query, rows)[0]
+        top = np.argsort(distances)[:k]
+        return rows[top], distances[top]
+
+    def search_batch(self, queries, k=1):
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.gallery.dim)
+        if not self.is_trained:
+            return self.gallery.search_batch(queries, k)
+
+        k = min(k, len(self.gallery))
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        for i, query in enumerate(queries):
+            r, d = self.search(query, k)
+            rows[i, :len(r)] = r
+            distances[i, :len(d)] = d
+        return rows, distances
+
+
+INDEX_TYPES = {
+    'brute': BruteForceIndex,
+    'ivf': IVFIndex,
+    'fp16': functools.partial(QuantizedIndex, codec='fp16'),
+    'int8': functools.partial(QuantizedIndex, codec='int8'),
+    'pq': functools.partial(QuantizedIndex, codec='pq'),
+}
+
+
+def create_index(kind, gallery, **options):
+    """Build the named index over a gallery"""
+    if kind not in INDEX_TYPES:
+        raise ValueError(f"Unknown face index type: {kind}")
+    index = INDEX_TYPES[kind](gallery, **options)
+    index.rebuild()
+    return index
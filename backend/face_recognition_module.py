@@ -106,86 +106,510 @@ import face_recognition
 import cv2
 import numpy as np
 import os
+import hashlib
 import pickle
+import threading
+import time
 import uuid
+from collections import defaultdict
+from batching import RecognitionBatcher, StageStats
+from caching import TTLCache
+from detection import detect_faces, get_config
+import metrics
+from embedding_store import MappedFaceGallery, exemplars_path
+from face_index import create_index
+from rwlock import ReadWriteLock
+from shards import GalleryShard
+from templates import compact_templates
+
+def detect_and_encode_timed(image, first_only=False, config=None):
+    """detect_and_encode plus the seconds spent locating and encoding, for the metrics of the calling process"""
+    config = get_config(config)
+    started = time.perf_counter()
+    face_locations = detect_faces(image, config)
+    located = time.perf_counter()
+    if first_only:
+        face_locations = face_locations[:1]
+    face_encodings = face_recognition.face_encodings(image, face_locations, config.num_jitters) if face_locations else []
+    timings = {'face_locations': located - started, 'face_encodings': time.perf_counter() - located}
+    return (face_locations, face_encodings), timings
+
+def detect_and_encode(image, first_only=False, config=None):
+    """Detect faces and compute their encodings; returns (locations, encodings).
+    
+    This is the CPU-heavy dlib work, so it is what runs in the inference pool workers.
+    """
+    return detect_and_encode_timed(image, first_only, config)[0]
+
+def encode_faces(image, face_locations, config=None):
+    """Encodings of already located faces (stream tracks that still need a match)"""
+    config = get_config(config)
+    return face_recognition.face_encodings(image, face_locations, config.num_jitters)
 
 class FaceRecognitionModule:
-    def __init__(self, db):
+    def __init__(self, db, index_type='brute', gallery_path="face_gallery", pool=None,
+                 batch_window_ms=None, max_batch_size=32, detection=None, group_detection='group',
+                 cache_size=256, cache_ttl=300.0, max_exemplars=4, rerank=8, reload_interval=0.5,
+                 compact_ratio=0.2, scope_cache_size=64, scope_ttl=60.0, **index_options):
         self.db = db
-        self.known_face_encodings = []
-        self.known_face_ids = []
+        self.pool = pool
+        # Detection settings: a DetectionConfig or a preset name from detection.PRESETS;
+        # group photos (recognize_faces) have their own, which keep small faces detectable
+        self.detection = get_config(detection)
+        self.group_detection = get_config(group_detection)
+        self.stats = StageStats()
+        
+        # Detections of recently seen frames, keyed by image content (cache_size=0 disables)
+        self.encoding_cache = TTLCache(cache_size, cache_ttl)
+        
+        # Coalesce concurrent searches into one matrix-matrix product when a window is set
+        self.batcher = None
+        if batch_window_ms is not None:
+            self.batcher = RecognitionBatcher(self._search_rows_batch, max_batch_size, batch_window_ms)
+        
+        # One centroid row per user in the gallery, up to max_exemplars extra samples per user
+        # that re-rank the `rerank` closest centroids
+        self.max_exemplars = max_exemplars
+        self.rerank = rerank
+        
+        # Tombstoned rows are compacted away once they are this fraction of the gallery
+        self.compact_ratio = compact_ratio
+        
+        # Shards of the gallery searched for scoped recognition (a department, roster or section).
+        # Their members come from the database and are reloaded after scope_ttl seconds
+        self.shards = TTLCache(scope_cache_size, scope_ttl)
+        self.scope_counts = {'scoped': 0, 'fallback': 0}
+        
+        self.gallery_path = gallery_path
         self.encodings_file = "face_encodings.pkl"
+        self.index_type = index_type
+        self.index_options = index_options
+        
+        # Searches read the stores, index and exemplar rows under the read side; every change to
+        # them (enrolments, removals and compactions, here or in other processes) takes the write side
+        self.view_lock = ReadWriteLock()
         
-        # Load existing face encodings if available
+        # Map the stored face encodings (migrating the old pickle if needed)
+        self._sync_lock = threading.Lock()
         self.load_encodings()
+        
+        # Poll the stores for enrolments made by other workers or scripts (0 disables)
+        self._stop = threading.Event()
+        if reload_interval:
+            threading.Thread(target=self._watch, args=(reload_interval,), daemon=True).start()
     
     def load_encodings(self):
-        """Load face encodings from file if it exists"""
-        if os.path.exists(self.encodings_file):
+        """Map the face encoding store, importing face_encodings.pkl on first start"""
+        self.gallery = MappedFaceGallery(self.gallery_path)
+        
+        # Workers starting together must not all import the pickle
+        with self.gallery.locked():
+            self.gallery.refresh()
+            if not len(self.gallery) and os.path.exists(self.encodings_file):
+                try:
+                    with open(self.encodings_file, 'rb') as f:
+                        data = pickle.load(f)
+                    self.gallery.extend(data.get('ids', []), data.get('encodings', []))
+                    print(f"Migrated {len(self.gallery)} face encodings from {self.encodings_file}")
+                except Exception as e:
+                    print(f"Error loading face encodings: {e}")
+        
+        print(f"Loaded {len(self.gallery)} face encodings")
+        
+        # Enrolment exemplars, looked up by user when re-ranking
+        self.exemplars = MappedFaceGallery(exemplars_path(self.gallery_path))
+        self._load_exemplar_rows()
+        
+        # Build the search index over the loaded gallery
+        self._build_index()
+    
+    def _load_exemplar_rows(self):
+        self.exemplar_rows = defaultdict(list)
+        for row, user_id in enumerate(self.exemplars.ids):
+            if user_id not in self.exemplars.deleted:
+                self.exemplar_rows[user_id].append(row)
+        self.exemplars_seen = len(self.exemplars)
+        self.exemplars_generation = self.exemplars.generation
+    
+    def _build_index(self):
+        self.index = create_index(self.index_type, self.gallery, **self.index_options)
+        self.indexed = len(self.gallery)
+        self.removed = len(self.gallery.deleted_rows)
+        self.generation = self.gallery.generation
+    
+    def sync(self):
+        """Apply rows appended to or removed from the stores since the last sync; returns how many reached the index"""
+        with self._sync_lock:
+            return self._sync()
+    
+    def _stale(self):
+        return (self.gallery.stale or self.exemplars.stale or self.gallery.generation != self.generation
+                or self.exemplars.generation != self.exemplars_generation)
+    
+    def _sync(self):
+        # Searches read the gallery's size, matrix and norms separately, so what other processes
+        # wrote is applied with the searches in flight finished; a few stat() calls tell if there is any,
+        # and rows written straight to the stores (scripts, benchmarks) are caught by their counts
+        pending = (len(self.gallery) != self.indexed or len(self.gallery.deleted_rows) != self.removed
+                   or len(self.exemplars) != self.exemplars_seen)
+        if not (pending or self.gallery.changed or self.exemplars.changed):
+            return 0
+        with self.view_lock.write():
+            return self._apply()
+    
+    def _apply(self):
+        """Apply the stores' new rows and tombstones, or reload them after a compaction; the caller holds the write lock"""
+        self.exemplars.refresh(reload=False)
+        self.gallery.refresh(reload=False)
+        if self._stale():
+            return self._reload()
+        
+        for row in range(self.exemplars_seen, len(self.exemplars)):
+            self.exemplar_rows[self.exemplars.ids[row]].append(row)
+        self.exemplars_seen = len(self.exemplars)
+        for user_id in self.exemplars.deleted.intersection(self.exemplar_rows):
+            del self.exemplar_rows[user_id]
+        
+        added = len(self.gallery) - self.indexed
+        if added:
+            self.index.add(list(range(self.indexed, len(self.gallery))))
+            self.indexed = len(self.gallery)
+        if len(self.gallery.deleted_rows) > self.removed:
+            self.index.remove(self.gallery.deleted_rows[self.removed:])
+            self.removed = len(self.gallery.deleted_rows)
+        return added
+    
+    def _reload(self):
+        """Reload compacted stores and rebuild what refers to their rows; the caller holds the write lock"""
+        self.exemplars.refresh()
+        self.gallery.refresh()
+        self._load_exemplar_rows()
+        self._build_index()
+        return len(self.gallery)
+    
+    def _write_stores(self, write):
+        """Run a store write with searches held back: it reloads the stores if another process compacted them"""
+        with self._sync_lock:
+            with self.view_lock.write():
+                result = write()
+                self._apply()
+        return result
+    
+    def remove_user(self, user_id):
+        """Tombstone a user's centroid and exemplars; returns the number of rows removed"""
+        return self._write_stores(lambda: len(self.gallery.remove([user_id])) + len(self.exemplars.remove([user_id])))
+    
+    def compact(self):
+        """Rewrite the stores without tombstoned rows; returns the number of rows dropped"""
+        return self._write_stores(lambda: self.gallery.compact() + self.exemplars.compact())
+    
+    def rebuild_index(self):
+        """Retrain the index; searches keep using the previous one until the new one is published"""
+        # Writes to the stores wait, so the retrain sees every row up to date
+        with self._sync_lock:
+            self.index.rebuild()
+    
+    def _watch(self, interval):
+        while not self._stop.wait(interval):
             try:
-                with open(self.encodings_file, 'rb') as f:
-                    data = pickle.load(f)
-                    self.known_face_encodings = data.get('encodings', [])
-                    self.known_face_ids = data.get('ids', [])
-                print(f"Loaded {len(self.known_face_encodings)} face encodings")
+                self.sync()
+                # Retraining the index and compaction happen in the background, off the request path
+                if self.index.needs_rebuild:
+                    self.rebuild_index()
+                if len(self.gallery.deleted_rows) > self.compact_ratio * len(self.gallery):
+                    print(f"Compacted {self.compact()} deleted face encodings")
             except Exception as e:
-                print(f"Error loading face encodings: {e}")
-                # Initialize empty if loading fails
-                self.known_face_encodings = []
-                self.known_face_ids = []
+                print(f"Error reloading face encodings: {e}")
     
     def save_encodings(self):
-        """Save face encodings to file"""
-        data = {
-            'encodings': self.known_face_encodings,
-            'ids': self.known_face_ids
-        }
-        with open(self.encodings_file, 'wb') as f:
-            pickle.dump(data, f)
+        """Checkpoint the store; every add is already durable on its own"""
+        self.gallery.checkpoint()
+        self.exemplars.checkpoint()
+    
+    def _cache_key(self, image, first_only, config=None):
+        digest = hashlib.blake2b(np.ascontiguousarray(image).data, digest_size=16).hexdigest()
+        return (digest, image.shape, first_only, (config or self.detection).key())
+    
+    def detect_and_encode(self, image, first_only=False):
+        """Run detection and encoding in the inference pool if there is one, inline otherwise"""
+        # The same frame is often checked by /api/verify-face, then /api/register recognizes and adds it
+        key = self._cache_key(image, first_only)
+        result = self.encoding_cache.get(key)
+        if result is not None:
+            return result
+        
+        with metrics.timer('detect_encode', self.stats) as timer:
+            if self.pool is None:
+                result, timings = detect_and_encode_timed(image, first_only, self.detection)
+            else:
+                result, timings = self.pool.run(detect_and_encode_timed, image, first_only, self.detection)
+        self._observe_detection(timer, [timings])
+        
+        self.encoding_cache.set(key, result)
+        return result
+    
+    def _observe_detection(self, timer, timings):
+        """Split detection time into locating, encoding and waiting for the pool (queueing, transfer)"""
+        if not metrics.ENABLED:
+            return
+        for image_timings in timings:
+            for stage, seconds in image_timings.items():
+                metrics.observe(stage, seconds)
+        if self.pool is not None and timings:
+            # Images of one call run in parallel, so the slowest one bounds the useful work
+            busy = max(sum(image_timings.values()) for image_timings in timings)
+            metrics.observe('inference_wait', max(time.perf_counter() - timer.started - busy, 0.0))
+    
+    def _run(self, stage, fn, *args):
+        with metrics.timer(stage, self.stats):
+            if self.pool is None:
+                return fn(*args)
+            return self.pool.run(fn, *args)
+    
+    def detect_faces(self, image):
+        """Face locations only, without encodings"""
+        return self._run('detect', detect_faces, image, self.detection)
+    
+    def encode_faces(self, image, face_locations):
+        """Encodings of the given face locations"""
+        if not face_locations:
+            return []
+        return self._run('encode', encode_faces, image, face_locations, self.detection)
+    
+    def detect_and_encode_many(self, images, first_only=False, config=None):
+        """detect_and_encode for several images (with `config` instead of the module's detection settings,
+        if given); with a pool, the images not cached run in parallel"""
+        config = config or self.detection
+        keys = [self._cache_key(image, first_only, config) for image in images]
+        detections = [self.encoding_cache.get(key) for key in keys]
+        missing = [i for i, detection in enumerate(detections) if detection is None]
+        if missing:
+            with metrics.timer('detect_encode', self.stats) as timer:
+                if self.pool is None:
+                    computed = [detect_and_encode_timed(images[i], first_only, config) for i in missing]
+                else:
+                    computed = self.pool.run_many(detect_and_encode_timed, [images[i] for i in missing], first_only, config)
+            self._observe_detection(timer, [timings for _, timings in computed])
+            for i, (detection, _) in zip(missing, computed):
+                detections[i] = detection
+                self.encoding_cache.set(keys[i], detection)
+        return detections
     
     def add_face(self, user_id, image):
         """Add a face encoding for a user"""
-        # Detect face locations
-        face_locations = face_recognition.face_locations(image)
+        return self.add_faces(user_id, [image])
+    
+    def add_faces(self, user_id, images):
+        """Enrol a user from one or more images (the first face of each).
         
-        if not face_locations:
+        The samples are compacted to one centroid row in the gallery plus a few
+        diverse exemplars, so the gallery grows with users rather than images.
+        """
+        samples = [encodings[0] for _, encodings in self.detect_and_encode_many(images, first_only=True) if encodings]
+        
+        if not samples:
             raise ValueError("No face detected in the image")
         
-        # Use the first face found (assuming one face per image)
-        face_encoding = face_recognition.face_encodings(image, [face_locations[0]])[0]
+        centroid, exemplars = compact_templates(samples, self.max_exemplars)
         
-        # Add to known faces
-        self.known_face_encodings.append(face_encoding)
-        self.known_face_ids.append(user_id)
+        # Append to the stores (logged and fsync'd), then bring the index up to date
+        def append():
+            if len(exemplars):
+                self.exemplars.extend([user_id] * len(exemplars), exemplars)
+            self.gallery.add(user_id, centroid)
+        self._write_stores(append)
         
-        # Save updated encodings
-        self.save_encodings()
+        return len(samples)
+    
+    def get_scope(self, scope):
+        """The loaded shard of a scope, or None when it was never loaded or has expired"""
+        return self.shards.get(scope)
+    
+    def scope_mark(self):
+        """Where the gallery stands; taken before reading a scope's members, it is passed on to set_scope"""
+        with self.view_lock.read():
+            return self.gallery.generation, len(self.gallery)
+    
+    def set_scope(self, scope, user_ids, mark=None, version=None):
+        """Load (or replace) the members of a scope read from the database after `mark`"""
+        generation, since = mark if mark is not None else self.scope_mark()
+        shard = GalleryShard(user_ids, since, generation, version)
+        self.shards.set(scope, shard)
+        return shard
+    
+    def scope_newcomers(self, scope):
+        """user_ids enrolled anywhere since a loaded scope's members were read, who may belong to it"""
+        shard = self.shards.get(scope)
+        if shard is None:
+            return set()
+        with self.view_lock.read():
+            shard.refresh(self.gallery)
+        return shard.take_newcomers()
+    
+    def drop_scope(self, scope):
+        self.shards.pop(scope)
+    
+    def add_to_scopes(self, user_id, scopes):
+        """Add a newly enrolled user to those of the scopes that are loaded"""
+        for scope in scopes:
+            shard = self.shards.get(scope)
+            if shard is not None:
+                shard.add(user_id)
+    
+    def in_scope(self, scope, user_id):
+        shard = self.shards.get(scope)
+        return shard is not None and user_id in shard.members
+    
+    def _search_scoped(self, encodings, scope, k):
+        """Top-k (rows, distances) among the members of a loaded scope; nothing when it is not loaded"""
+        shard = self.shards.get(scope)
+        if shard is None:
+            return np.full((len(encodings), k), -1), np.full((len(encodings), k), np.inf)
+        return shard.search_batch(self.gallery, encodings, k)
+    
+    def _search_rows_batch(self, encodings, k):
+        return self.index.search_batch(encodings, k)
+    
+    def _rerank(self, queries, rows, distances, k):
+        """Refine centroid distances with each candidate's exemplars and keep the k best"""
+        if not len(self.exemplars):
+            return rows[:, :k], distances[:, :k]
+        
+        distances = distances.copy()
+        for i, query in enumerate(queries):
+            candidates = [(j, self.exemplar_rows.get(self.gallery.ids[row])) for j, row in enumerate(rows[i]) if row >= 0]
+            candidates = [(j, exemplar_rows) for j, exemplar_rows in candidates if exemplar_rows]
+            if not candidates:
+                continue
+            # One distance computation over the exemplars of all candidates of this query
+            exemplar_distances = self.exemplars.distances(query, sum((r for _, r in candidates), []))[0]
+            offset = 0
+            for j, exemplar_rows in candidates:
+                nearest = exemplar_distances[offset:offset + len(exemplar_rows)].min()
+                distances[i, j] = min(distances[i, j], nearest)
+                offset += len(exemplar_rows)
         
-        return True
+        order = np.argsort(distances, axis=1)[:, :k]
+        return np.take_along_axis(rows, order, axis=1), np.take_along_axis(distances, order, axis=1)
     
-    def recognize_face(self, image, tolerance=0.4):
-        """Recognize a face in the image and return user_id if found"""
-        if not self.known_face_encodings:
+    def search(self, encoding, k=1, scope=None):
+        """Return the k closest known faces (among the members of `scope`, if given) as (user_id, distance) pairs"""
+        # Rows are only meaningful until the next compaction, so they are mapped to ids under the same lock
+        with metrics.timer('match', self.stats), self.view_lock.read():
+            candidates = max(k, self.rerank) if len(self.exemplars) else k
+            if scope is not None:
+                rows, distances = self._search_scoped(np.reshape(encoding, (1, -1)).astype(np.float32), scope, candidates)
+            elif self.batcher is not None:
+                rows, distances = self.batcher.search(encoding, candidates)
+            else:
+                rows, distances = self.index.search(encoding, candidates)
+            rows, distances = self._rerank(np.reshape(encoding, (1, -1)), np.reshape(rows, (1, -1)),
+                                           np.reshape(distances, (1, -1)), k)
+            return [(self.gallery.ids[row], float(dist)) for row, dist in zip(rows[0], distances[0]) if row >= 0]
+    
+    def snapshot_stats(self):
+        """Per-stage latency (ms), plus the batcher's queue wait and batch sizes"""
+        stats = {'stages': self.stats.snapshot(), 'encoding_cache': self.encoding_cache.snapshot()}
+        if self.batcher is not None:
+            stats['batcher'] = self.batcher.snapshot()
+        stats['scopes'] = dict(self.scope_counts, loaded=len(self.shards))
+        return stats
+    
+    def recognize_face(self, image, tolerance=0.4, scope=None, fallback=True):
+        """Recognize a face in the image and return user_id if found.
+        
+        With a scope only its members are searched; without a match there,
+        `fallback` searches the whole gallery.
+        """
+        if not len(self.gallery):
             return None
         
-        # Detect face locations
-        face_locations = face_recognition.face_locations(image)
+        # Detect and encode the first face found
+        face_locations, face_encodings = self.detect_and_encode(image, first_only=True)
         
         if not face_locations:
             return None
         
-        # Use the first face found
-        face_encoding = face_recognition.face_encodings(image, [face_locations[0]])[0]
+        face_encoding = face_encodings[0]
         
-        # Compare with known faces
-        matches = face_recognition.compare_faces(self.known_face_encodings, face_encoding, tolerance=tolerance)
+        # Closest known face, rather than the first one under tolerance
+        matches = self.search(face_encoding, k=1, scope=scope)
+        if scope is not None:
+            if matches and matches[0][1] <= tolerance:
+                self.scope_counts['scoped'] += 1
+            elif fallback:
+                self.scope_counts['fallback'] += 1
+                matches = self.search(face_encoding, k=1)
         
-        # If no matches, return None
-        if not any(matches):
+        # If the closest face is still too far away, there is no match
+        if not matches or matches[0][1] > tolerance:
             return None
         
-        # Find the index of the first match
-        match_index = matches.index(True)
-        
         # Return the user_id of the matched face
-        return self.known_face_ids[match_index]
\ No newline at end of file
+        return matches[0][0]
+    
+    def recognize_faces(self, images, tolerance=0.4, scope=None, fallback=True):
+        """Recognize every face in every image.
+        
+        Returns one list per image of dicts with the face location, the matched
+        user_id (or None) and its distance.
+        """
+        # All faces of an image are encoded in a single pass, with the group detection settings
+        # (small faces at the back of a class photo); with a pool, images run in parallel
+        detections = self.detect_and_encode_many(images, config=self.group_detection)
+        
+        locations = []
+        encodings = []
+        for face_locations, face_encodings in detections:
+            locations.append(face_locations)
+            encodings.extend(face_encodings)
+        
+        matches = iter(self.match(encodings, tolerance, scope, fallback))
+        
+        results = []
+        for face_locations in locations:
+            faces = []
+            for location in face_locations:
+                user_id, distance = next(matches)
+                faces.append({'location': location, 'user_id': user_id, 'distance': distance})
+            results.append(faces)
+        
+        return results
+    
+    def match(self, encodings, tolerance=0.4, scope=None, fallback=True):
+        """(user_id, distance) of the closest known face for each encoding, (None, None) when none is close enough.
+        
+        With a scope only its members are searched, and with `fallback` the
+        encodings without a match among them are searched in the whole gallery.
+        """
+        # Match all faces at once with one matrix-matrix distance computation
+        with self.view_lock.read():
+            if len(encodings) and len(self.gallery):
+                with metrics.timer('match', self.stats):
+                    encodings = np.asarray(encodings, dtype=np.float32)
+                    candidates = self.rerank if len(self.exemplars) else 1
+                    if scope is None:
+                        rows, distances = self.index.search_batch(encodings, k=candidates)
+                    else:
+                        rows, distances = self._search_scoped(encodings, scope, candidates)
+                    rows, distances = self._rerank(encodings, rows, distances, 1)
+                    if scope is not None:
+                        missed = ~(distances[:, 0] <= tolerance)
+                        self.scope_counts['scoped'] += int((~missed).sum())
+                        if fallback and missed.any():
+                            self.scope_counts['fallback'] += int(missed.sum())
+                            global_rows, global_distances = self.index.search_batch(encodings[missed], k=candidates)
+                            global_rows, global_distances = self._rerank(encodings[missed], global_rows, global_distances, 1)
+                            rows[missed], distances[missed] = global_rows, global_distances
+            else:
+                rows = np.full((len(encodings), 1), -1)
+                distances = np.full((len(encodings), 1), np.inf)
+            
+            # Still under the read lock, so no compaction renumbers the rows before they become ids
+            matches = []
+            for row, distance in zip(rows[:, 0], distances[:, 0]):
+                if row >= 0 and distance <= tolerance:
+                    matches.append((self.gallery.ids[row], float(distance)))
+                else:
+                    matches.append((None, None))
+            return matches
@@ -0,0 +1,31 @@
+"""Production launch configuration for both servers.
+
+WSGI (Flask, one thread per in-flight request):
+    gunicorn -c gunicorn.conf.py app:app
+
+ASGI (Starlette + Motor, one event loop per worker):
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:app
+
+Every worker process loads its own face gallery and starts its own
+inference pool, so set INFERENCE_WORKERS to roughly cpu_count / WEB_WORKERS
+to avoid oversubscribing the CPUs.
+"""
+import os
+
+bind = os.getenv('BIND', '0.0.0.0:5000')
+workers = int(os.getenv('WEB_WORKERS', '2'))
+
+# Used by the WSGI server only; UvicornWorker (-k on the command line) takes precedence
+worker_class = 'gthread'
+threads = int(os.getenv('WEB_THREADS', '16'))
+
+# Each worker builds its gallery index on start-up, which can take a while for large galleries
+timeout = int(os.getenv('WEB_TIMEOUT', '120'))
+graceful_timeout = 30
+keepalive = 5
+
+# Recycle workers now and then so fragmentation in long-lived numpy/dlib buffers cannot build up
+max_requests = int(os.getenv('WEB_MAX_REQUESTS', '10000'))
+max_requests_jitter = max_requests // 10
+
+accesslog = '-'
@@ -0,0 +1,211 @@
+import base64
+import os
+import struct
+
+import cv2
+import numpy as np
+from flask import request
+
+from metrics import timer
+
+# Fields that arrive as strings in forms and query strings but are stored as numbers
+INT_FIELDS = ('period',)
+
+# Larger uploads are rejected before any decoding or inference
+MAX_IMAGE_BYTES = int(os.getenv('MAX_IMAGE_BYTES', 10 * 1024 * 1024))
+MAX_IMAGE_PIXELS = int(os.getenv('MAX_IMAGE_PIXELS', 40_000_000))
+
+# JPEGs whose longest side is well above this are decoded at 1/2, 1/4 or 1/8 scale
+INGEST_MAX_SIDE = int(os.getenv('INGEST_MAX_SIDE', 1280))
+
+REDUCED_MODES = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+
+class ImageRejected(Exception):
+    """The uploaded image cannot be used; carries the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def request_fields():
+    """Request parameters from a JSON body, a multipart form or the query string (raw image bodies)"""
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        return data
+
+    fields = request.args.to_dict()
+    fields.update(request.form.to_dict())
+    for name in INT_FIELDS:
+        if isinstance(fields.get(name), str) and fields[name].isdigit():
+            fields[name] = int(fields[name])
+    return fields
+
+
+def check_size(size):
+    """Reject images over MAX_IMAGE_BYTES with a 413"""
+    if size > MAX_IMAGE_BYTES:
+        raise ImageRejected(f"Image is larger than {MAX_IMAGE_BYTES} bytes", 413)
+
+
+def _read_limited(stream):
+    # Read one byte past the limit so oversized bodies are caught without buffering them whole
+    data = stream.read(MAX_IMAGE_BYTES + 1)
+    check_size(len(data))
+    return data
+
+
+def decode_data_url(image_data):
+    """Image bytes of a "data:image/jpeg;base64,<data>" URL or of bare base64"""
+    if not isinstance(image_data, str):
+        raise ImageRejected("Image must be a base64 string")
+    encoded_data = image_data.split(',', 1)[1] if ',' in image_data else image_data
+    check_size(len(encoded_data) * 3 // 4)
+    with timer('b64decode'):
+        try:
+            return base64.b64decode(encoded_data)
+        except ValueError:
+            raise ImageRejected("Image is not valid base64")
+
+
+def read_image_bytes(field='image'):
+    """Encoded image bytes from a raw image/* body, a multipart file or a base64 JSON field"""
+    with timer('read'):
+        if request.mimetype.startswith('image/') or request.mimetype == 'application/octet-stream':
+            # Read straight from the request stream, no JSON or base64 in between
+            return _read_limited(request.stream) or None
+
+        if field in request.files:
+            return _read_limited(request.files[field]) or None
+
+        image_data = request_fields().get(field)
+    return decode_data_url(image_data) if image_data else None
+
+
+def image_fields(fields, field='images', single='image'):
+    """The base64 images of a JSON body: a list of strings in `field`, or one string in `single`"""
+    images = fields.get(field)
+    if images:
+        if not isinstance(images, list) or not all(isinstance(image, str) for image in images):
+            raise ImageRejected(f"'{field}' must be a list of base64 images")
+        return [image for image in images if image]
+    image = fields.get(single)
+    if image:
+        if not isinstance(image, str):
+            raise ImageRejected(f"'{single}' must be a base64 image")
+        return [image]
+    return []
+
+
+def read_images_bytes(field='images'):
+    """Every image of a batch request: multipart files or a JSON list, falling back to a single image"""
+    if request.files:
+        with timer('read'):
+            files = request.files.getlist(field) or request.files.getlist('image')
+            return [_read_limited(f) for f in files]
+
+    images_data = image_fields(request_fields(), field)
+    if images_data:
+        return [decode_data_url(image_data) for image_data in images_data]
+
+    image_bytes = read_image_bytes()
+    return [image_bytes] if image_bytes else []
+
+
+class JpegFrameSplitter:
+    """Split a chunked MJPEG upload into JPEG frames by their SOI/EOI markers.
+
+    Works for back-to-back JPEGs and for multipart/x-mixed-replace bodies alike,
+    since part headers and boundaries between the frames are skipped.
+    """
+
+    def __init__(self):
+        self.buffer = b''
+
+    def feed(self, chunk):
+        """Add received bytes; returns the frames they completed"""
+        self.buffer += chunk
+        frames = []
+        while True:
+            start = self.buffer.find(b'\xff\xd8')
+            if start < 0:
+                # Keep a trailing 0xFF, it may be the first half of the next SOI
+                self.buffer = self.buffer[-1:]
+                return frames
+            end = self.buffer.find(b'\xff\xd9', start + 2)
+            if end < 0:
+                self.buffer = self.buffer[start:]
+                check_size(len(self.buffer))
+                return frames
+            frames.append(self.buffer[start:end + 2])
+            self.buffer = self.buffer[end + 2:]
+
+
+def iter_jpeg_frames(stream, chunk_size=64 * 1024):
+    """JPEG frames of an MJPEG request stream, as they arrive"""
+    splitter = JpegFrameSplitter()
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        yield from splitter.feed(chunk)
+
+
+def image_size(image_bytes):
+    """(width, height) from a JPEG or PNG header without decoding, or None"""
+    if image_bytes[:8] == b'\x89PNG\r\n\x1a\n' and len(image_bytes) >= 24:
+        return struct.unpack('>II', image_bytes[16:24])
+
+    if image_bytes[:2] != b'\xff\xd8':
+        return None
+    offset = 2
+    while offset + 9 <= len(image_bytes):
+        if image_bytes[offset] != 0xFF:
+            return None
+        marker = image_bytes[offset + 1]
+        if marker == 0xFF:
+            # Fill byte
+            offset += 1
+            continue
+        length = struct.unpack('>H', image_bytes[offset + 2:offset + 4])[0]
+        # SOF0..SOF15 carry the frame size; C4 (DHT), C8 (JPG) and CC (DAC) share the range
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>HH', image_bytes[offset + 5:offset + 9])
+            return width, height
+        offset += 2 + length
+    return None
+
+
+def decode_image(image_bytes, max_side=INGEST_MAX_SIDE):
+    """Decode encoded image bytes to an RGB image, at reduced scale when the JPEG is much larger than needed"""
+    if not image_bytes:
+        raise ImageRejected("No image provided")
+    check_size(len(image_bytes))
+
+    # Other formats are left to OpenCV without the pre-checks
+    size = image_size(image_bytes)
+    if size and size[0] * size[1] > MAX_IMAGE_PIXELS:
+        raise ImageRejected(f"Image has more than {MAX_IMAGE_PIXELS} pixels", 413)
+
+    flags = cv2.IMREAD_COLOR
+    if size and max_side and image_bytes[:2] == b'\xff\xd8':
+        width, height = size
+        # libjpeg scales during the DCT, so a reduced decode does a fraction of the work
+        for factor, mode in REDUCED_MODES:
+            if max(width, height) // factor >= max_side:
+                flags = mode
+                break
+
+    with timer('imdecode'):
+        img = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), flags)
+    if img is None:
+        raise ImageRejected("Could not decode image")
+
+    # OpenCV decodes to BGR; face_recognition (dlib) expects RGB
+    with timer('to_rgb'):
+        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
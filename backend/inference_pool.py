@@ -0,0 +1,88 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+
+class InferencePoolBusy(Exception):
+    """The job queue is full or a job did not finish in time; the client should retry later"""
+    pass
+
+
+def _init_worker():
+    # Importing face_recognition loads the dlib models, once per worker process
+    import face_recognition  # noqa: F401
+
+
+class InferencePool:
+    """Pool of worker processes for the CPU-heavy face detection and encoding.
+
+    At most `max_pending` jobs may be queued or running; further submissions
+    raise InferencePoolBusy instead of piling up behind slow detections.
+    """
+
+    def __init__(self, workers=None, max_pending=None, timeout=30):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.workers * 4
+        self.timeout = timeout
+        self.pending = 0
+        self._lock = threading.Lock()
+        # Workers start on the first job, when the server's threads (batcher, gallery watcher, change
+        # stream, pymongo monitors) are running; a forked child could inherit a lock one of them held,
+        # so they come from a clean forkserver process instead
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                             mp_context=multiprocessing.get_context('forkserver'))
+
+    def _acquire(self, count):
+        with self._lock:
+            if self.pending + count > self.max_pending:
+                raise InferencePoolBusy(f"Inference queue is full ({self.pending} jobs pending)")
+            self.pending += count
+
+    def _release(self, _future=None):
+        with self._lock:
+            self.pending -= 1
+
+    def submit(self, fn, *args):
+        """Queue a job and return its future, or raise InferencePoolBusy"""
+        self._acquire(1)
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            self._release()
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def run(self, fn, *args):
+        """Run a job in a worker and wait for its result"""
+        future = self.submit(fn, *args)
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise InferencePoolBusy(f"Inference job did not finish within {self.timeout}s")
+
+    def run_many(self, fn, items, *args):
+        """Run fn(item, *args) for every item in parallel; all jobs are admitted together or not at all"""
+        items = list(items)
+        self._acquire(len(items))
+        futures = []
+        try:
+            for item in items:
+                future = self._executor.submit(fn, item, *args)
+                future.add_done_callback(self._release)
+                futures.append(future)
+        except Exception:
+            for _ in range(len(items) - len(futures)):
+                self._release()
+            raise
+        try:
+            return [future.result(timeout=self.timeout) for future in futures]
+        except TimeoutError:
+            for future in futures:
+                future.cancel()
+            raise InferencePoolBusy(f"Inference jobs did not finish within {self.timeout}s")
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
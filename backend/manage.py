@@ -0,0 +1,121 @@
+"""Maintenance commands for the attendance backend.
+
+Usage:
+    python manage.py rebuild-rollups [--month YYYY-MM]
+    python manage.py check-rollups [--month YYYY-MM]
+    python manage.py reconcile [--gallery PATH] [--delete]
+    python manage.py compact-gallery [--gallery PATH]
+    python manage.py import-students SOURCE [--workers N] [--progress PATH] [--dry-run]
+"""
+import argparse
+import os
+import sys
+
+from bulk_import import ManifestError, run_import
+from database import Database
+from embedding_store import MappedFaceGallery, exemplars_path
+
+
+def rebuild_rollups(db, args):
+    count = db.rebuild_monthly_rollups(args.month)
+    print(f"Rebuilt {count} monthly attendance counters")
+    return 0
+
+
+def check_rollups(db, args):
+    mismatches = db.check_monthly_rollups(args.month)
+    for mismatch in mismatches:
+        print(f"{mismatch['month']} {mismatch['user_id']}: rollup={mismatch['rollup']} "
+              f"attendance={mismatch['attendance']}")
+    print(f"{len(mismatches)} monthly counters out of sync")
+    return 1 if mismatches else 0
+
+
+def reconcile(db, args):
+    gallery = MappedFaceGallery(args.gallery, readonly=not args.delete)
+    exemplars = MappedFaceGallery(exemplars_path(args.gallery), readonly=not args.delete)
+
+    # One set difference each way instead of a database lookup per recognition
+    user_ids = db.get_user_ids()
+    enrolled = gallery.live_ids()
+    stale = sorted(enrolled - user_ids)
+    missing = sorted(user_ids - enrolled)
+
+    for user_id in stale:
+        print(f"stale encoding: {user_id}")
+    for user_id in missing:
+        print(f"no encoding: {user_id}")
+    print(f"{len(enrolled)} enrolled, {len(user_ids)} users, {len(stale)} stale encodings, "
+          f"{len(missing)} users without encodings")
+
+    if args.delete and stale:
+        removed = len(gallery.remove(stale)) + len(exemplars.remove(stale))
+        print(f"Tombstoned {removed} rows; running servers drop them on their next reload")
+        return 0
+    return 1 if stale else 0
+
+
+def compact_gallery(db, args):
+    dropped = 0
+    for path in (args.gallery, exemplars_path(args.gallery)):
+        dropped += MappedFaceGallery(path).compact()
+    print(f"Dropped {dropped} deleted face encodings")
+    return 0
+
+
+def import_students(db, args):
+    try:
+        summary = run_import(db, args.source, gallery_path=args.gallery, progress_path=args.progress,
+                             workers=args.workers, detection=args.detection, tolerance=args.tolerance,
+                             max_exemplars=args.exemplars, dry_run=args.dry_run)
+    except ManifestError as e:
+        print(e)
+        return 2
+
+    for student, reason in summary['skipped']:
+        print(f"skipped {student['email']}: {reason}")
+    action = "Would import" if args.dry_run else "Imported"
+    print(f"{action} {summary['imported']} of {summary['students']} students, finished {summary['resumed']} "
+          f"from an interrupted run, {summary['already_imported']} imported before, skipped {len(summary['skipped'])}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Attendance backend maintenance commands")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    rebuild = commands.add_parser('rebuild-rollups', help="Backfill/rebuild the monthly attendance rollups")
+    rebuild.add_argument('--month', help="Only this month (YYYY-MM)")
+    rebuild.set_defaults(handler=rebuild_rollups)
+
+    check = commands.add_parser('check-rollups', help="Compare the rollups with the raw attendance records")
+    check.add_argument('--month', help="Only this month (YYYY-MM)")
+    check.set_defaults(handler=check_rollups)
+
+    reconcile_parser = commands.add_parser('reconcile', help="Compare the face gallery with the users collection")
+    reconcile_parser.add_argument('--gallery', default='face_gallery', help="Gallery path prefix")
+    reconcile_parser.add_argument('--delete', action='store_true', help="Tombstone encodings of users that no longer exist")
+    reconcile_parser.set_defaults(handler=reconcile)
+
+    compact = commands.add_parser('compact-gallery', help="Rewrite the gallery files without deleted encodings")
+    compact.add_argument('--gallery', default='face_gallery', help="Gallery path prefix")
+    compact.set_defaults(handler=compact_gallery)
+
+    importer = commands.add_parser('import-students', help="Enrol a new intake from a CSV or a directory of photos")
+    importer.add_argument('source', help="CSV of name,email,department,image or <root>/<department>/<name> <email>.jpg")
+    importer.add_argument('--gallery', default='face_gallery', help="Gallery path prefix")
+    importer.add_argument('--progress', help="Progress file to resume from (default: SOURCE.progress.jsonl)")
+    importer.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Encoding processes")
+    importer.add_argument('--detection', default=os.getenv('DETECTION_PRESET', 'balanced'), help="Detection preset")
+    importer.add_argument('--tolerance', type=float, default=0.4, help="Distance under which two faces are the same person")
+    importer.add_argument('--exemplars', type=int, default=int(os.getenv('ENROL_EXEMPLARS', '4')),
+                          help="Exemplars kept per student")
+    importer.add_argument('--dry-run', action='store_true', help="Encode and check for duplicates without enrolling anyone")
+    importer.set_defaults(handler=import_students)
+
+    args = parser.parse_args()
+    sys.exit(args.handler(Database(), args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+"""Per-stage latency histograms and gauges in the Prometheus text format.
+
+Stages are timed with `timer(stage)` or the `@timed(stage)` decorator; with
+METRICS_ENABLED=0 both hand back a shared no-op (the decorator returns the
+function itself), so the hot path pays nothing. Timings also accumulate per
+request for the Server-Timing header.
+
+Every process keeps its own registry, so with several gunicorn workers each
+scrape of /metrics reports the worker that answered it.
+"""
+import contextvars
+import functools
+import inspect
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+
+ENABLED = os.getenv('METRICS_ENABLED', '1') != '0'
+
+# Add the stages of each request as a Server-Timing response header
+SERVER_TIMING = ENABLED and os.getenv('SERVER_TIMING', '1') != '0'
+
+# Seconds; fine at the low end for decoding and matching, up to slow CNN detections
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_request_timings = contextvars.ContextVar('request_timings', default=None)
+_NO_TIMER = nullcontext()
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count of observed values"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        """(le, cumulative count) per bucket, then the sum and count"""
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        cumulative = 0
+        buckets = []
+        for le, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            buckets.append((le, cumulative))
+        return buckets, total, count
+
+
+class HistogramFamily:
+    """One histogram per value of a single label"""
+
+    def __init__(self, name, help, label, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def labels(self, value):
+        histogram = self.histograms.get(value)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(value, Histogram(self.buckets))
+        return histogram
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for value, histogram in sorted(self.histograms.items()):
+            buckets, total, count = histogram.samples()
+            label = f'{self.label}="{_escape(value)}"'
+            for le, cumulative in buckets:
+                lines.append(f'{self.name}_bucket{{{label},le="{_format(le)}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{label}}} {_format(total)}")
+            lines.append(f"{self.name}_count{{{label}}} {count}")
+        return lines
+
+
+class Collector:
+    """Gauges or counters read from the live objects at scrape time.
+
+    `collect` returns a number, or a dict of label value -> number when
+    `label` is set.
+    """
+
+    def __init__(self, name, help, collect, kind='gauge', label=None):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.kind = kind
+        self.label = label
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        values = self.collect()
+        if self.label is None:
+            lines.append(f"{self.name} {_format(values)}")
+        else:
+            for value, number in sorted(values.items()):
+                lines.append(f'{self.name}{{{self.label}="{_escape(value)}"}} {_format(number)}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.stages = HistogramFamily('face_stage_seconds', "Time spent in each stage of request handling", 'stage')
+        self.requests = HistogramFamily('http_request_seconds', "Time to handle a request, by endpoint", 'endpoint')
+        self.collectors = {}
+
+    def register(self, name, help, collect, kind='gauge', label=None):
+        """Add (or replace) a collector read on every scrape"""
+        self.collectors[name] = Collector(name, help, collect, kind, label)
+
+    def render(self):
+        lines = self.stages.render() + self.requests.render()
+        for collector in list(self.collectors.values()):
+            try:
+                lines.extend(collector.render())
+            except Exception as e:
+                print(f"Error collecting metric {collector.name}: {e}")
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format(number):
+    if number == float('inf'):
+        return '+Inf'
+    if isinstance(number, bool):
+        return str(int(number))
+    return repr(float(number)) if isinstance(number, float) else str(number)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def observe(stage, seconds):
+    """Record the duration of a stage that was timed elsewhere (e.g. in an inference worker)"""
+    if not ENABLED:
+        return
+    REGISTRY.stages.labels(stage).observe(seconds)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+class _Timer:
+    __slots__ = ('stage', 'stats', 'started')
+
+    def __init__(self, stage, stats):
+        self.stage = stage
+        self.stats = stats
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.started
+        if self.stats is not None:
+            self.stats.record(self.stage, elapsed)
+        observe(self.stage, elapsed)
+
+
+def timer(stage, stats=None):
+    """Context manager timing a stage; also records into a StageStats when given"""
+    if not ENABLED and stats is None:
+        return _NO_TIMER
+    return _Timer(stage, stats)
+
+
+def timed(stage):
+    """Decorator timing every call of a function or coroutine function as a stage"""
+    def decorate(fn):
+        if not ENABLED:
+            return fn
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def timed_coroutine(*args, **kwargs):
+                with _Timer(stage, None):
+                    return await fn(*args, **kwargs)
+            return timed_coroutine
+
+        @functools.wraps(fn)
+        def timed_function(*args, **kwargs):
+            with _Timer(stage, None):
+                return fn(*args, **kwargs)
+        return timed_function
+    return decorate
+
+
+def begin_request():
+    """Start collecting stage timings for the current request; returns the start time"""
+    if SERVER_TIMING:
+        _request_timings.set({})
+    return time.perf_counter()
+
+
+def end_request(endpoint, started):
+    """Record the request's total time under its endpoint"""
+    if ENABLED and endpoint:
+        REGISTRY.requests.labels(endpoint).observe(time.perf_counter() - started)
+
+
+def server_timing_header():
+    """Server-Timing value for the stages of the current request, or None"""
+    timings = _request_timings.get() if SERVER_TIMING else None
+    if not timings:
+        return None
+    return ', '.join(f"{name};dur={seconds * 1000:.2f}" for name, seconds in timings.items())
+
+
+def render():
+    return REGISTRY.render()
+
+
+def register_server(face_module, db, inference_pool=None, stream_sessions=None):
+    """Gallery size, cache and queue gauges of a running server (app.py or asgi.py)"""
+    register = REGISTRY.register
+    register('face_gallery_rows', "Rows in the face stores, tombstoned rows included",
+             lambda: {'centroids': len(face_module.gallery), 'exemplars': len(face_module.exemplars)}, label='store')
+    register('face_gallery_deleted_rows', "Tombstoned rows awaiting compaction",
+             lambda: {'centroids': len(face_module.gallery.deleted_rows),
+                      'exemplars': len(face_module.exemplars.deleted_rows)}, label='store')
+
+    caches = {'encoding': face_module.encoding_cache, 'user': db.user_cache, 'departments': db.departments_cache}
+    register('cache_entries', "Entries held in each cache", lambda: {name: len(cache) for name, cache in caches.items()},
+             label='cache')
+    register('cache_hits_total', "Cache lookups that found a live entry",
+             lambda: {name: cache.hits for name, cache in caches.items()}, kind='counter', label='cache')
+    register('cache_misses_total', "Cache lookups that missed or found an expired entry",
+             lambda: {name: cache.misses for name, cache in caches.items()}, kind='counter', label='cache')
+    register('cache_hit_ratio', "Hits over lookups since start",
+             lambda: {name: cache.snapshot()['hit_rate'] for name, cache in caches.items()}, label='cache')
+
+    register('scoped_recognitions_total', "Scoped matches found among the scope's members, or falling back to everyone",
+             lambda: dict(face_module.scope_counts), kind='counter', label='outcome')
+    register('scope_shards_loaded', "Recognition scopes whose members are cached", lambda: len(face_module.shards))
+
+    if face_module.batcher is not None:
+        register('recognize_batch_queue_depth', "Searches waiting for the next micro-batch",
+                 lambda: face_module.batcher.queue_depth)
+    if inference_pool is not None:
+        register('inference_pending_jobs', "Detection jobs queued or running in the inference pool",
+                 lambda: inference_pool.pending)
+        register('inference_max_pending_jobs', "Pending jobs above which requests are shed with 503",
+                 lambda: inference_pool.max_pending)
+    if stream_sessions is not None:
+        register('stream_sessions', "Open stream sessions", lambda: len(stream_sessions))
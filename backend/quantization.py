@@ -0,0 +1,168 @@
+"""Compressed encodings for large galleries.
+
+Each codec turns float32 encodings into compact codes and computes
+approximate squared distances from a full-precision query to the codes
+(asymmetric: the query itself is never quantized). Per-row `norms` are the
+squared norms of the decoded rows where the distance needs them, so a row
+can be masked by setting its norm to infinity.
+"""
+import numpy as np
+
+
+def assign_labels(data, centroids, c_sq, chunk=8192):
+    """Index of the nearest centroid of every row"""
+    # Chunked so the (chunk x nlist) score matrix stays small
+    labels = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), chunk):
+        part = data[start:start + chunk]
+        labels[start:start + chunk] = np.argmin(c_sq[None, :] - 2.0 * (part @ centroids.T), axis=1)
+    return labels
+
+
+def kmeans(data, k, iterations=10, seed=0):
+    """Lloyd's k-means; returns the (k x dim) centroids"""
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    data_sq = np.einsum('ij,ij->i', data, data)
+    for _ in range(iterations):
+        c_sq = np.einsum('ij,ij->i', centroids, centroids)
+        assign = assign_labels(data, centroids, c_sq)
+        counts = np.bincount(assign, minlength=k)
+        empty = counts == 0
+        # Sum each cell's members with one sorted reduceat instead of a scatter-add
+        order = np.argsort(assign, kind='stable')
+        starts = np.cumsum(counts) - counts
+        sums = np.add.reduceat(data[order], starts[~empty], axis=0)
+        centroids[~empty] = sums / counts[~empty, None]
+        if empty.any():
+            # Re-seed empty cells from the points furthest from their centroid
+            residual = data_sq + c_sq[assign] - 2.0 * np.einsum('ij,ij->i', data, centroids[assign])
+            far = np.argsort(residual)[::-1][:int(empty.sum())]
+            centroids[empty] = data[far]
+    return centroids
+
+
+class Float16Codec:
+    """Half-precision copy of each encoding: 2 bytes per dimension"""
+
+    def __init__(self, dim):
+        self.dim = dim
+        self.code_size = dim
+        self.code_dtype = np.float16
+
+    def train(self, data):
+        pass
+
+    def encode(self, vectors):
+        return np.asarray(vectors, dtype=np.float16)
+
+    def decode(self, codes):
+        return codes.astype(np.float32)
+
+    def norms(self, codes):
+        decoded = self.decode(codes)
+        return np.einsum('ij,ij->i', decoded, decoded)
+
+    def prepare(self, query):
+        return query, float(np.dot(query, query))
+
+    def sq_distances(self, state, codes, norms):
+        query, q_sq = state
+        return norms - 2.0 * (self.decode(codes) @ query) + q_sq
+
+
+class Int8Codec(Float16Codec):
+    """One byte per dimension, scaled between the per-dimension minimum and maximum of the training rows"""
+
+    def __init__(self, dim):
+        super().__init__(dim)
+        self.code_dtype = np.uint8
+        self.offset = np.zeros(dim, dtype=np.float32)
+        self.scale = np.ones(dim, dtype=np.float32)
+
+    def train(self, data):
+        low = data.min(axis=0)
+        high = data.max(axis=0)
+        self.offset = low.astype(np.float32)
+        self.scale = np.where(high > low, (high - low) / 255.0, 1.0).astype(np.float32)
+
+    def encode(self, vectors):
+        codes = np.rint((np.asarray(vectors, dtype=np.float32) - self.offset) / self.scale)
+        return np.clip(codes, 0, 255).astype(np.uint8)
+
+    def decode(self, codes):
+        return codes.astype(np.float32) * self.scale + self.offset
+
+    def prepare(self, query):
+        # q.x = q.offset + (q * scale).code, so the scan multiplies the raw codes
+        return query * self.scale, float(np.dot(query, self.offset)), float(np.dot(query, query))
+
+    def sq_distances(self, state, codes, norms):
+        scaled_query, q_offset, q_sq = state
+        return norms - 2.0 * (codes.astype(np.float32) @ scaled_query + q_offset) + q_sq
+
+
+class ProductQuantizer:
+    """Product quantization: each of `subspaces` slices of the encoding is one byte, the index of
+    its nearest of 256 trained centroids. Distances are summed from a per-query lookup table."""
+
+    def __init__(self, dim, subspaces=16, iterations=10, seed=0):
+        if dim % subspaces:
+            raise ValueError(f"{dim} dimensions do not split into {subspaces} subspaces")
+        self.dim = dim
+        self.subspaces = subspaces
+        self.sub_dim = dim // subspaces
+        self.iterations = iterations
+        self.seed = seed
+        self.code_size = subspaces
+        self.code_dtype = np.uint8
+        self.centroids = None
+
+    def _slices(self, vectors):
+        return np.asarray(vectors, dtype=np.float32).reshape(len(vectors), self.subspaces, self.sub_dim)
+
+    def train(self, data):
+        if len(data) < 256:
+            raise ValueError("Product quantization needs at least 256 training rows")
+        data = self._slices(data)
+        self.centroids = np.stack([
+            kmeans(np.ascontiguousarray(data[:, j]), 256, self.iterations, self.seed + j)
+            for j in range(self.subspaces)
+        ])
+        self.centroid_sq_norms = np.einsum('mkd,mkd->mk', self.centroids, self.centroids)
+
+    def encode(self, vectors):
+        data = self._slices(vectors)
+        codes = np.empty((len(data), self.subspaces), dtype=np.uint8)
+        for j in range(self.subspaces):
+            codes[:, j] = assign_labels(np.ascontiguousarray(data[:, j]), self.centroids[j], self.centroid_sq_norms[j])
+        return codes
+
+    def decode(self, codes):
+        return self.centroids[np.arange(self.subspaces), codes].reshape(len(codes), self.dim)
+
+    def norms(self, codes):
+        # Distances come straight from the tables; the norm column only carries the masking
+        return np.zeros(len(codes), dtype=np.float32)
+
+    def prepare(self, query):
+        sub_queries = self._slices(query[None, :])[0]
+        # ||q_j - c||^2 for every subspace j and centroid c
+        return (np.einsum('md,md->m', sub_queries, sub_queries)[:, None] + self.centroid_sq_norms
+                - 2.0 * np.einsum('md,mkd->mk', sub_queries, self.centroids)).astype(np.float32)
+
+    def sq_distances(self, table, codes, norms):
+        return table[np.arange(self.subspaces), codes].sum(axis=1) + norms
+
+
+CODECS = {
+    'fp16': Float16Codec,
+    'int8': Int8Codec,
+    'pq': ProductQuantizer,
+}
+
+
+def create_codec(kind, dim, **options):
+    if kind not in CODECS:
+        raise ValueError(f"Unknown encoding codec: {kind}")
+    return CODECS[kind](dim, **options)
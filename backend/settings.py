@@ -0,0 +1,76 @@
+"""Environment configuration shared by the WSGI (app.py) and ASGI (asgi.py) servers"""
+import os
+
+from face_recognition_module import FaceRecognitionModule
+from inference_pool import InferencePool
+
+# User documents and the department list are cached for METADATA_CACHE_TTL seconds
+# (USER_CACHE_SIZE=0 disables the cache)
+DATABASE_OPTIONS = {
+    'cache_size': int(os.getenv('USER_CACHE_SIZE', '10000')),
+    'cache_ttl': float(os.getenv('METADATA_CACHE_TTL', '60')),
+}
+
+# Registration accepts up to MAX_ENROL_IMAGES images of the student, compacted to a centroid
+# plus ENROL_EXEMPLARS exemplars
+MAX_ENROL_IMAGES = int(os.getenv('MAX_ENROL_IMAGES', '10'))
+
+# Live camera streams: full detection on every STREAM_DETECT_EVERY-th frame, tracking in between;
+# sessions idle for STREAM_SESSION_TTL seconds are dropped
+STREAM_DETECT_EVERY = int(os.getenv('STREAM_DETECT_EVERY', '5'))
+STREAM_MAX_SESSIONS = int(os.getenv('STREAM_MAX_SESSIONS', '64'))
+STREAM_SESSION_TTL = float(os.getenv('STREAM_SESSION_TTL', '120'))
+
+
+def create_inference_pool():
+    """The inference process pool, or None to run detection inline"""
+    # Detection and encoding run in a pool of worker processes (INFERENCE_WORKERS=0 runs them inline);
+    # INFERENCE_QUEUE_SIZE bounds the jobs waiting for a worker
+    inference_workers = int(os.getenv('INFERENCE_WORKERS', os.cpu_count() or 1))
+    if inference_workers <= 0:
+        return None
+    return InferencePool(
+        inference_workers,
+        max_pending=int(os.getenv('INFERENCE_QUEUE_SIZE', inference_workers * 4))
+    )
+
+
+def create_face_module(db, inference_pool):
+    """The face recognition module configured from the environment"""
+    # FACE_INDEX=ivf switches to the approximate index for large galleries,
+    # FACE_INDEX_NPROBE trades recall for latency (unset: 1/32 of the cells, at least 16)
+    index_type = os.getenv('FACE_INDEX', 'brute')
+    index_options = {}
+    if index_type == 'ivf' and os.getenv('FACE_INDEX_NPROBE'):
+        index_options['nprobe'] = int(os.getenv('FACE_INDEX_NPROBE'))
+    # FACE_INDEX=fp16/int8/pq scans compressed encodings for memory-bound galleries and re-scores
+    # the FACE_INDEX_REFINE best candidates in full precision; FACE_PQ_SUBSPACES bytes per pq code
+    if index_type in ('fp16', 'int8', 'pq'):
+        index_options['refine'] = int(os.getenv('FACE_INDEX_REFINE', '32'))
+    if index_type == 'pq':
+        index_options['subspaces'] = int(os.getenv('FACE_PQ_SUBSPACES', '16'))
+    # Concurrent recognitions are matched together: RECOGNIZE_BATCH_WINDOW_MS is how long the first
+    # request waits for others (empty disables batching), RECOGNIZE_MAX_BATCH caps the batch
+    batch_window = os.getenv('RECOGNIZE_BATCH_WINDOW_MS', '2')
+    return FaceRecognitionModule(
+        db, index_type,
+        pool=inference_pool,
+        batch_window_ms=float(batch_window) if batch_window else None,
+        max_batch_size=int(os.getenv('RECOGNIZE_MAX_BATCH', '32')),
+        # DETECTION_PRESET picks the downscale/model/upsample/jitter settings (see detection.PRESETS)
+        detection=os.getenv('DETECTION_PRESET', 'balanced'),
+        # GROUP_DETECTION_PRESET is used for /api/recognize/batch, whose group photos must not be
+        # shrunk as far as single-face frames
+        group_detection=os.getenv('GROUP_DETECTION_PRESET', 'group'),
+        # Detections are cached per frame content: ENCODING_CACHE_SIZE entries for ENCODING_CACHE_TTL seconds
+        cache_size=int(os.getenv('ENCODING_CACHE_SIZE', '256')),
+        cache_ttl=float(os.getenv('ENCODING_CACHE_TTL', '300')),
+        max_exemplars=int(os.getenv('ENROL_EXEMPLARS', '4')),
+        # Enrolments by other workers or import scripts show up after at most GALLERY_RELOAD_INTERVAL seconds
+        reload_interval=float(os.getenv('GALLERY_RELOAD_INTERVAL', '0.5')),
+        # Members of up to SCOPE_CACHE_SIZE recognition scopes (departments, rosters) are kept
+        # for SCOPE_TTL seconds before being reloaded from the database
+        scope_cache_size=int(os.getenv('SCOPE_CACHE_SIZE', '64')),
+        scope_ttl=float(os.getenv('SCOPE_TTL', '60')),
+        **index_options
+    )
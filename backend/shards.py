@@ -0,0 +1,108 @@
+import threading
+
+import numpy as np
+
+# A scope is '<kind>:<name>': every student of a department, or the members of a roster (class, section)
+SCOPE_KINDS = ('department', 'roster')
+
+
+class ScopeError(ValueError):
+    """The requested recognition scope is malformed"""
+
+
+def parse_scope(scope):
+    """Split a scope into (kind, name)"""
+    kind, _, name = str(scope).partition(':')
+    if kind not in SCOPE_KINDS or not name:
+        raise ScopeError(f"Scope must be one of {', '.join(kind + ':<name>' for kind in SCOPE_KINDS)}")
+    return kind, name
+
+
+class GalleryShard:
+    """The gallery rows of one scope's members, searched instead of the whole gallery.
+
+    Rows appended to the gallery are picked up incrementally. Rows appended
+    after `since` whose user is not a member are kept aside, their users
+    listed in `newcomers`: students enrolled by other workers or the
+    importer, whose scope only the database knows. Those that turn out to be
+    members join the shard with their rows, without a rescan. A compaction
+    (new gallery generation) renumbers the rows, so the shard is then
+    `expired` and should be reloaded. Tombstoned rows keep an infinite norm
+    in the gallery, so they never match.
+    """
+
+    def __init__(self, members, since=0, generation=None, version=None):
+        self.members = set(members)
+        # The roster's updated_at when the members were read (None for a department)
+        self.version = version
+        self.rows = np.empty(0, dtype=np.int64)
+        self.scanned = 0
+        self.since = since
+        self.generation = generation
+        self.newcomers = set()
+        self.newcomer_rows = {}
+        self.expired = False
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, user_id):
+        """Add a member enrolled after the shard was loaded; rows not scanned yet are collected on the next search"""
+        with self._lock:
+            if user_id not in self.members:
+                self.members.add(user_id)
+                self.newcomers.discard(user_id)
+                rows = self.newcomer_rows.pop(user_id, None)
+                if rows:
+                    self.rows = np.concatenate([self.rows, np.asarray(rows, dtype=np.int64)])
+
+    def take_newcomers(self):
+        """The newcomers seen so far, forgotten once handed out"""
+        with self._lock:
+            newcomers, self.newcomers = self.newcomers, set()
+            return newcomers
+
+    def refresh(self, gallery):
+        """Bring the shard's rows up to date with the gallery; returns them"""
+        with self._lock:
+            size = len(gallery)
+            if self.generation != gallery.generation:
+                self.expired = self.generation is not None
+                self.rows = np.empty(0, dtype=np.int64)
+                self.scanned = 0
+                self.since = size
+                self.newcomers.clear()
+                self.newcomer_rows.clear()
+                self.generation = gallery.generation
+            if size > self.scanned:
+                ids = gallery.ids
+                new = [row for row in range(self.scanned, size) if ids[row] in self.members]
+                if new:
+                    self.rows = np.concatenate([self.rows, np.asarray(new, dtype=np.int64)])
+                for row in range(max(self.scanned, self.since), size):
+                    if ids[row] not in self.members:
+                        self.newcomers.add(ids[row])
+                        self.newcomer_rows.setdefault(ids[row], []).append(row)
+                self.scanned = size
+            return self.rows
+
+    def search_batch(self, gallery, queries, k=1):
+        """Top-k gallery rows and distances among the members for every query, padded with -1 / inf"""
+        rows = self.refresh(gallery)
+        result_rows = np.full((len(queries), k), -1, dtype=np.int64)
+        result_distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        found = min(k, len(rows))
+        if found <= 0:
+            return result_rows, result_distances
+
+        distances = gallery.distances(queries, rows)
+        if found < len(rows):
+            top = np.argpartition(distances, found - 1, axis=1)[:, :found]
+        else:
+            top = np.broadcast_to(np.arange(len(rows)), distances.shape)
+        top_distances = np.take_along_axis(distances, top, axis=1)
+        order = np.argsort(top_distances, axis=1)
+        result_rows[:, :found] = rows[np.take_along_axis(top, order, axis=1)]
+        result_distances[:, :found] = np.take_along_axis(top_distances, order, axis=1)
+        return result_rows, result_distances
@@ -0,0 +1,86 @@
+import threading
+import time
+import uuid
+
+from tracking import FaceTracker
+
+
+class StreamSession:
+    """Recognition state of one camera stream.
+
+    Full detection runs on every `detect_every`-th frame only; the frames in
+    between are not even decoded and report the tracks of the last detection.
+    Each track is encoded and matched on the detections until it is
+    confirmed (or gives up after `max_attempts`), and attendance is marked
+    once per confirmed user for the whole session. With a `scope`, tracks are
+    matched against its members first (see FaceRecognitionModule.match).
+    """
+
+    def __init__(self, face_module, period, subject, detect_every=5, tolerance=0.4, max_attempts=3,
+                 scope=None, fallback=True):
+        self.session_id = uuid.uuid4().hex
+        self.face_module = face_module
+        self.period = period
+        self.subject = subject
+        self.detect_every = max(1, detect_every)
+        self.tolerance = tolerance
+        self.max_attempts = max_attempts
+        self.scope = scope
+        self.fallback = fallback
+        self.tracker = FaceTracker()
+        self.frames = 0
+        self.detections = 0
+        self.encodings = 0
+        # user_id -> attendance_id of everyone marked present by this stream
+        self.marked = {}
+        self.started = time.time()
+        # Frames of one session are handled in order, even if a client sends them concurrently
+        self.lock = threading.Lock()
+
+    def needs_detection(self):
+        """Count a new frame; True when it should be decoded and run through detection"""
+        self.frames += 1
+        return (self.frames - 1) % self.detect_every == 0
+
+    def detect(self, image):
+        """Detect faces, follow them with the tracker and match the tracks not yet confirmed.
+
+        Returns the tracks that were confirmed by this frame.
+        """
+        self.detections += 1
+        boxes = self.face_module.detect_faces(image)
+        tracks = self.tracker.update(boxes)
+
+        pending = [track for track in tracks if track.state == 'pending']
+        if not pending:
+            return []
+
+        encodings = self.face_module.encode_faces(image, [track.box for track in pending])
+        self.encodings += len(encodings)
+
+        confirmed = []
+        matches = self.face_module.match(encodings, self.tolerance, self.scope, self.fallback)
+        for track, (user_id, distance) in zip(pending, matches):
+            track.attempts += 1
+            if user_id is not None:
+                track.state = 'confirmed'
+                track.user_id = user_id
+                track.distance = distance
+                confirmed.append(track)
+            elif track.attempts >= self.max_attempts:
+                track.state = 'unknown'
+        return confirmed
+
+    def snapshot(self):
+        return {
+            "session_id": self.session_id,
+            "period": self.period,
+            "subject": self.subject,
+            "detect_every": self.detect_every,
+            "scope": self.scope,
+            "frames": self.frames,
+            "detections": self.detections,
+            "encodings": self.encodings,
+            "marked": len(self.marked),
+            "tracks": [track.to_dict() for track in self.tracker.tracks],
+        }
@@ -0,0 +1,37 @@
+import numpy as np
+
+# dlib's own same-person threshold; samples further than this from the rest are a different face
+OUTLIER_DISTANCE = 0.6
+
+
+def compact_templates(encodings, max_exemplars=4, outlier_distance=OUTLIER_DISTANCE):
+    """Reduce the enrolment samples of one user to (centroid, exemplars).
+
+    The centroid is the mean of the samples after dropping outliers (a wrong
+    face picked up in one of the images). The exemplars are up to
+    `max_exemplars` samples chosen by farthest-point sampling, so they cover
+    the poses and lighting the centroid averages away. A single sample is its
+    own centroid and needs no exemplars.
+    """
+    samples = np.asarray(encodings, dtype=np.float32).reshape(len(encodings), -1)
+    centroid = samples.mean(axis=0)
+
+    if len(samples) > 2:
+        inliers = np.linalg.norm(samples - centroid, axis=1) <= outlier_distance
+        if inliers.any():
+            samples = samples[inliers]
+            centroid = samples.mean(axis=0)
+
+    if len(samples) == 1:
+        return centroid, samples[:0]
+    if len(samples) <= max_exemplars:
+        return centroid, samples
+
+    # Greedily pick the sample furthest from the centroid and the exemplars chosen so far
+    nearest = np.linalg.norm(samples - centroid, axis=1)
+    chosen = []
+    for _ in range(max_exemplars):
+        pick = int(np.argmax(nearest))
+        chosen.append(pick)
+        nearest = np.minimum(nearest, np.linalg.norm(samples - samples[pick], axis=1))
+    return centroid, samples[chosen]
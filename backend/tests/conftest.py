@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The backend modules are imported directly, as the servers and benchmarks do
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(BACKEND_DIR, 'benchmarks'))
+sys.path.insert(0, BACKEND_DIR)
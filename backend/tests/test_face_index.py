@@ -0,0 +1,122 @@
+import numpy as np
+import pytest
+
+from face_gallery import FaceGallery
+from face_index import create_index
+from synthetic import make_identities, make_samples
+
+TOLERANCE = 0.4
+
+
+@pytest.fixture(scope='module')
+def gallery():
+    identities = make_identities(20000)
+    gallery = FaceGallery()
+    gallery.extend(list(range(len(identities))), identities)
+    return gallery
+
+
+@pytest.fixture(scope='module')
+def queries(gallery):
+    samples, _ = make_samples(gallery.encodings, 500)
+    return samples
+
+
+@pytest.fixture(scope='module')
+def exact(gallery, queries):
+    rows, distances = gallery.search_batch(queries, 1)
+    return rows[:, 0], distances[:, 0]
+
+
+def test_ivf_recall_against_brute_force(gallery, queries, exact):
+    index = create_index('ivf', gallery)
+    rows, _ = index.search_batch(queries, 1)
+    assert np.mean(rows[:, 0] == exact[0]) >= 0.99
+
+
+def test_ivf_default_nprobe_grows_with_nlist():
+    index = create_index('ivf', FaceGallery())
+    assert index.probes(400) == 16
+    assert index.probes(4000) == 125
+    index.nprobe = 8
+    assert index.probes(4000) == 8
+
+
+def test_ivf_search_during_retrain_uses_previous_cells(gallery, queries, exact):
+    index = create_index('ivf', gallery)
+    assign = index._assign
+    during = []
+
+    def assign_with_search(*args, **kwargs):
+        # Searches while the new lists are being filled
+        during.append(index.search(queries[0], 1))
+        return assign(*args, **kwargs)
+
+    index._assign = assign_with_search
+    index.rebuild()
+    rows, _ = during[0]
+    assert len(rows) and rows[0] == exact[0][0]
+
+
+def test_ivf_rebuild_leaves_out_tombstoned_rows():
+    identities = make_identities(3000, seed=4)
+    gallery = FaceGallery()
+    gallery.extend(list(range(len(identities))), identities)
+    # Tombstoned rows keep their encoding but get an infinite norm
+    gallery.sq_norms[:2500] = np.inf
+    index = create_index('ivf', gallery)
+    assert not index.is_trained
+
+    gallery.sq_norms[:2500] = np.einsum('ij,ij->i', identities[:2500], identities[:2500])
+    gallery.sq_norms[:1000] = np.inf
+    index.rebuild()
+    assert sum(lst.size for lst in index.lists) == 2000
+    assert all(np.all(lst.rows[:lst.size] >= 1000) for lst in index.lists)
+
+
+def test_ivf_add_leaves_retraining_to_the_owner():
+    identities = make_identities(4000, seed=5)
+    gallery = FaceGallery()
+    gallery.extend(list(range(1000)), identities[:1000])
+    index = create_index('ivf', gallery)
+    assert index.trained_on == 1000 and not index.needs_rebuild
+
+    rows = gallery.extend(list(range(1000, 4000)), identities[1000:])
+    index.add(rows)
+    # Rows go into the current cells; the retrain waits for the background watcher
+    assert index.trained_on == 1000 and index.needs_rebuild
+    assert sum(lst.size for lst in index.lists) == 4000
+    index.rebuild()
+    assert index.trained_on == 4000 and not index.needs_rebuild
+
+
+@pytest.mark.parametrize('codec', ['fp16', 'int8', 'pq'])
+def test_quantized_recall_and_distance_within_tolerance(codec, gallery, queries, exact):
+    strangers = make_identities(200, seed=3)
+    exact_strangers = gallery.search_batch(strangers, 1)[1][:, 0]
+    index = create_index(codec, gallery)
+
+    rows, distances = index.search_batch(queries, 1)
+    matchable = exact[1] <= TOLERANCE
+    assert matchable.mean() > 0.9
+    assert np.mean(rows[matchable, 0] == exact[0][matchable]) >= 0.99
+    assert np.abs(distances[matchable, 0] - exact[1][matchable]).max() <= 1e-4
+
+    # Strangers may get a looser nearest row, but never one within tolerance
+    _, stranger_distances = index.search_batch(strangers, 1)
+    assert np.all((stranger_distances[:, 0] <= TOLERANCE) == (exact_strangers <= TOLERANCE))
+
+
+def test_quantized_search_during_retrain_uses_previous_codes(gallery, queries, exact):
+    index = create_index('int8', gallery)
+    encode = index._encode
+    during = []
+
+    def encode_with_search(*args):
+        during.append(index.search(queries[0], 1))
+        return encode(*args)
+
+    index._encode = encode_with_search
+    index.rebuild()
+    rows, _ = during[0]
+    assert len(rows) and rows[0] == exact[0][0]
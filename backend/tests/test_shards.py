@@ -0,0 +1,38 @@
+import numpy as np
+
+from embedding_store import MappedFaceGallery
+from shards import GalleryShard
+
+
+def test_shard_collects_newcomers_appended_after_loading(tmp_path):
+    gallery = MappedFaceGallery(str(tmp_path / 'gallery'))
+    gallery.extend(['a', 'b'], np.eye(2, 128, dtype=np.float32))
+    shard = GalleryShard({'a'}, since=len(gallery), generation=gallery.generation)
+    assert list(shard.refresh(gallery)) == [0]
+    assert shard.take_newcomers() == set()
+
+    # Enrolled by another worker after the members were read
+    gallery.extend(['c'], np.eye(1, 128, 2, dtype=np.float32))
+    shard.refresh(gallery)
+    assert shard.take_newcomers() == {'c'}
+    assert shard.take_newcomers() == set()
+
+    # Joins with the rows already seen, without scanning the gallery again
+    shard.add('c')
+    assert list(shard.rows) == [0, 2]
+    assert shard.scanned == len(gallery)
+    assert list(shard.refresh(gallery)) == [0, 2]
+    assert shard.take_newcomers() == set()
+
+
+def test_shard_expires_after_compaction(tmp_path):
+    gallery = MappedFaceGallery(str(tmp_path / 'gallery'))
+    gallery.extend(['a', 'b'], np.eye(2, 128, dtype=np.float32))
+    shard = GalleryShard({'b'}, since=len(gallery), generation=gallery.generation)
+    shard.refresh(gallery)
+    assert not shard.expired
+
+    gallery.remove(['a'])
+    gallery.compact()
+    assert list(shard.refresh(gallery)) == [0]
+    assert shard.expired
@@ -0,0 +1,108 @@
+import itertools
+
+import numpy as np
+
+
+class Track:
+    """A face followed across frames of a stream.
+
+    state is 'pending' until the face is matched to a user ('confirmed'), or
+    'unknown' once it failed to match `max_attempts` times.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, box):
+        self.track_id = next(self._ids)
+        self.box = box
+        self.state = 'pending'
+        self.user_id = None
+        self.distance = None
+        self.attempts = 0
+        self.missed = 0
+        self.attendance_id = None
+
+    def to_dict(self):
+        top, right, bottom, left = self.box
+        return {
+            "track_id": self.track_id,
+            "box": {"top": top, "right": right, "bottom": bottom, "left": left},
+            "state": self.state,
+            "user_id": self.user_id,
+            "distance": self.distance,
+            "attendance_id": self.attendance_id,
+        }
+
+
+def iou_matrix(boxes_a, boxes_b):
+    """Intersection over union of every (top, right, bottom, left) box in a with every box in b"""
+    a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 1, 4)
+    b = np.asarray(boxes_b, dtype=np.float64).reshape(1, -1, 4)
+    height = np.clip(np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None)
+    width = np.clip(np.minimum(a[..., 1], b[..., 1]) - np.maximum(a[..., 3], b[..., 3]), 0, None)
+    intersection = height * width
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 1] - a[..., 3])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 1] - b[..., 3])
+    return intersection / np.maximum(area_a + area_b - intersection, 1e-9)
+
+
+def centroid_shift(boxes_a, boxes_b):
+    """Distance between box centres, relative to the size of the box in a"""
+    a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 1, 4)
+    b = np.asarray(boxes_b, dtype=np.float64).reshape(1, -1, 4)
+    centre_a = np.stack([(a[..., 0] + a[..., 2]) / 2, (a[..., 1] + a[..., 3]) / 2], axis=-1)
+    centre_b = np.stack([(b[..., 0] + b[..., 2]) / 2, (b[..., 1] + b[..., 3]) / 2], axis=-1)
+    size = np.maximum(a[..., 2] - a[..., 0], a[..., 1] - a[..., 3])
+    return np.linalg.norm(centre_a - centre_b, axis=-1) / np.maximum(size, 1.0)
+
+
+class FaceTracker:
+    """Associates the faces of each detection with the tracks of earlier ones.
+
+    Boxes are matched greedily by IoU; a face that moved too far for its boxes
+    to overlap still continues its track when its centre shifted by less than
+    `max_shift` box sizes. Tracks not seen for more than `max_missed`
+    detections are dropped.
+    """
+
+    def __init__(self, iou_threshold=0.3, max_shift=0.5, max_missed=2):
+        self.iou_threshold = iou_threshold
+        self.max_shift = max_shift
+        self.max_missed = max_missed
+        self.tracks = []
+
+    def update(self, boxes):
+        """Feed the boxes of a new detection; returns the track of each box, in order"""
+        assigned = [None] * len(boxes)
+        unmatched = list(range(len(self.tracks)))
+
+        if boxes and self.tracks:
+            track_boxes = [track.box for track in self.tracks]
+            # Overlap first, then centre distance for faces that moved quickly
+            score = iou_matrix(track_boxes, boxes)
+            shift = centroid_shift(track_boxes, boxes)
+            score = np.where(score >= self.iou_threshold, score, np.where(shift <= self.max_shift, -shift, -np.inf))
+
+            for flat in np.argsort(-score, axis=None):
+                t, b = np.unravel_index(flat, score.shape)
+                if not np.isfinite(score[t, b]):
+                    break
+                if assigned[b] is not None or t not in unmatched:
+                    continue
+                assigned[b] = self.tracks[t]
+                unmatched.remove(t)
+
+        for track_index in unmatched:
+            self.tracks[track_index].missed += 1
+
+        for b, box in enumerate(boxes):
+            track = assigned[b]
+            if track is None:
+                track = Track(box)
+                self.tracks.append(track)
+            track.box = box
+            track.missed = 0
+            assigned[b] = track
+
+        self.tracks = [track for track in self.tracks if track.missed <= self.max_missed]
+        return assigned